@@ -1,12 +1,22 @@
 import apt.defaultserver as apt_default_server
+import apt.productionserver as apt_production_server
 import apt.services.config as CONFIG
+import apt.services.log as apt_log
+import logging
 import sys
 
+log = logging.getLogger("apt")
+
 if __name__ == '__main__':
     
+    apt_log.setup()
     if CONFIG.has_required_parameters():
         CONFIG.display_banner()
-        print("Create default server", flush=True)
-        apt_default_server.create_server(__name__, "8080")
+        if CONFIG.SERVER_MODE == "development":
+            log.info("Create default server")
+            apt_default_server.create_server(__name__, "8080")
+        else:
+            log.info("Create production server")
+            apt_production_server.create_server(__name__, "8080")
     else:
         sys.exit(1)
\ No newline at end of file
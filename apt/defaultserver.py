@@ -1,17 +1,204 @@
-from flask import Flask, request, abort
+import os
+import json
+import time
+import mimetypes
+import shutil
+import logging
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, Request, Response, request, abort, g
 from flask import send_file
+from werkzeug.utils import send_file as send_local_file
 import apt.services.security as apt_security
+import apt.services.admission as apt_admission
 import apt.services.dataset as apt_dataset
+import apt.services.archive as apt_archive
+import apt.services.catalog as apt_catalog
+import apt.services.tiering as apt_tiering
+import apt.services.cluster as apt_cluster
+import apt.services.jobs as apt_jobs
+import apt.services.leader as apt_leader
 import apt.services.registry as apt_registry
 import apt.services.reporting as apt_reporting
+import apt.services.metrics as apt_metrics
 import apt.services.config as CONFIG
 
-def create_server(server_name, port):
+log = logging.getLogger(__name__)
+
+# Traffic class of the endpoints under admission control
+TRAFFIC_CLASSES = {
+    "get_dataset": "download",
+    "list_dataset_files": "download",
+    "get_dataset_file": "download",
+    "post_dataset": "upload",
+    "post_datasets": "upload",
+    "list_datasets": "admin",
+    "list_dataset_versions": "admin",
+    "delete_dataset": "admin",
+    "delete_datasets": "admin",
+    "rollback_dataset": "admin",
+    "list_registered_datasets": "admin",
+    "list_deleted_datasets": "admin",
+    "report_reconciliation": "admin",
+    "report_crawls": "admin",
+    "report_failed_jobs": "admin",
+    "get_job": "admin"
+}
+
+#
+# Request whose uploaded files can be streamed to a custom destination
+#
+class UploadRequest(Request):
+
+    # Function(filename) returning the stream receiving an uploaded file,
+    # or None for the default one (set by the endpoint before reading the files)
+    upload_factory = None
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        stream = self.upload_factory(filename) if self.upload_factory else None
+        if stream is None:
+            stream = super()._get_file_stream(total_content_length, content_type, filename, content_length)
+        return stream
+
+#
+# Create the APT application (WSGI app factory)
+#
+# The catalog and the GBIF registry state are loaded once, before the
+# server workers are forked. Background services are started afterwards
+# (see start_services), in the leader process only
+#
+def create_app(server_name):
 
     app = Flask(server_name)
+    app.request_class = UploadRequest
+    # Admission slots are released once the responses are sent
+    app.wsgi_app = apt_admission.OnCloseMiddleware(app.wsgi_app)
+    # Dataset files sent by the fronting server (X-Sendfile header)
+    app.config["USE_X_SENDFILE"] = CONFIG.DOWNLOAD_MODE == "x-sendfile"
+    # Metrics of a previous server are obsolete
+    apt_metrics.reset()
 
+    catalog = apt_catalog.Catalog()
+    # Cluster mode: the catalog is shared, only the datasets of this node are synchronized
+    cluster = apt_cluster.Cluster() if CONFIG.CLUSTER_PATH else None
+    if cluster:
+        cluster.join(catalog)
+    else:
+        catalog.rebuild()
     registry = apt_registry.Registry()
-    reporting = apt_reporting.Reporting(registry)
+    reporting = apt_reporting.Reporting(registry, catalog)
+
+    #
+    # GBIF registry jobs, executed by the job queue workers
+    #
+    def update_registry(id, crawl=True):
+        # Update GBIF registry (register or crawl)
+        gbif_key = registry.update(id, catalog.get_metadata(id), crawl)
+        if not gbif_key:
+            raise Exception(f"No GBIF key returned for dataset {id}")
+        return {"gbif_key": gbif_key}
+
+    def register_registry(id):
+        # Register only, never crawl (unchanged uploads)
+        return update_registry(id, crawl=False)
+
+    def delete_registry(id):
+        return {"gbif_key": registry.delete(id)}
+
+    jobs = apt_jobs.JobQueue({
+        "update": update_registry,
+        "register": register_registry,
+        "delete": delete_registry
+    }, is_alive=cluster.is_alive if cluster else None)
+    app.extensions["apt.jobs"] = jobs
+
+    #
+    # Background services, run by the leader process only
+    # (GBIF registry services by the cluster leader only in cluster mode)
+    #
+    def start_leader_services():
+        if registry.loaded_from_snapshot:
+            registry.reload_snapshot_if_changed()
+            registry.refresh_in_background()
+        registry.start_sync(leadership.is_leader)
+        jobs.start(active=leadership.is_leader)
+
+    def start_node_services():
+        if cluster:
+            cluster.start_heartbeat()
+        catalog.start_garbage_collection()
+        apt_dataset.start_layout_migration()
+        if CONFIG.COLD_STORAGE_PATH:
+            tiering.start()
+
+    tiering = apt_tiering.Tiering(catalog)
+    app.extensions["apt.catalog"] = catalog
+
+    leadership = apt_leader.Leadership(start_leader_services, start_node_services, cluster)
+    app.extensions["apt.leadership"] = leadership
+
+    admission = apt_admission.Admission()
+
+    @app.before_request
+    def start_timer():
+        g.start = time.perf_counter()
+
+    #
+    # Admission control of the requests by traffic class: rejected at once
+    # (429 or 503 with Retry-After) or admitted, their slot being released
+    # once the response is sent (streamed bodies included)
+    #
+    @app.before_request
+    def admit_request():
+        traffic_class = TRAFFIC_CLASSES.get(request.endpoint)
+        if not traffic_class:
+            return None
+        release, rejection = admission.admit(traffic_class, apt_security.client_id(request))
+        if rejection:
+            status, retry_after = rejection
+            error = {}
+            error["error"] = "too many requests" if status == 429 else f"too many {traffic_class} requests running"
+            error["retry_after"] = retry_after
+            return error, status, {"Retry-After": str(retry_after)}
+        request.environ[apt_admission.ON_CLOSE].append(release)
+        return None
+
+    #
+    # Request metrics: duration until the response is ready (the body of
+    # downloads and streamed lists is sent afterwards), bytes received and sent
+    #
+    @app.after_request
+    def record_metrics(response):
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        duration = time.perf_counter() - g.get("start", time.perf_counter())
+        apt_metrics.observe("apt_http_request_duration_seconds", duration, method=request.method, route=route, status=response.status_code)
+        if request.content_length:
+            apt_metrics.inc("apt_http_received_bytes_total", request.content_length, route=route)
+        if response.content_length:
+            apt_metrics.inc("apt_http_sent_bytes_total", response.content_length, route=route)
+        return response
+
+    @app.route('/metrics', methods=['GET'])
+    def get_metrics():
+        gauges = []
+        catalog_stats = catalog.stats()
+        gauges.append(("apt_catalog_datasets", {}, catalog_stats["datasets"]))
+        gauges.append(("apt_catalog_bytes", {}, catalog_stats["size"]))
+        gauges.append(("apt_registry_datasets", {"status": "published"}, len(registry.gbif_published_datasets)))
+        gauges.append(("apt_registry_datasets", {"status": "deleted"}, len(registry.gbif_deleted_datasets)))
+        job_counts = jobs.count_by_status()
+        for status in ("pending", "running", "done", "failed"):
+            gauges.append(("apt_jobs", {"status": status}, job_counts.get(status, 0)))
+        gauges.append(("apt_jobs", {"status": "delayed"}, jobs.coalescing_stats("update")["pending"]))
+        gauges.append(("apt_leader", {}, 1 if leadership.is_leader() else 0))
+        if cluster:
+            gauges.append(("apt_cluster_nodes", {}, cluster.count_nodes()))
+        return Response(apt_metrics.render(gauges), mimetype="text/plain; version=0.0.4")
+
+    @app.before_request
+    def reload_registry():
+        # Registry state may have been updated by the leader process
+        registry.reload_snapshot_if_changed()
 
     @app.route('/', methods=['GET'])
     def home():
@@ -22,25 +209,56 @@ def create_server(server_name, port):
         # Retrieve gbif attribute if set
         args = request.args
         include_gbif = args.get("gbif", default="").lower() in ('true', 'on')
-        # Retrieve dataset list
-        datasets = apt_dataset.list_all()
+        # Retrieve paging and filtering attributes if set
+        prefix = args.get("prefix", default="")
+        cursor = args.get("cursor", default="")
+        offset = parse_positive_int(args.get("offset"), 0)
+        limit = parse_positive_int(args.get("limit"), None)
+        if not apt_dataset.checkAuthorizedChars(prefix) or not apt_dataset.checkAuthorizedChars(cursor):
+            abort(400)
+        # GBIF registration information, if gbif attribute set
+        gbif_keys = reporting.gbif_keys_by_id() if include_gbif else None
+        # Streamed NDJSON mode: one dataset per line, constant memory
+        stream = args.get("format", default="").lower() == "ndjson" or request.accept_mimetypes.best == "application/x-ndjson"
+        if stream:
+            def generate():
+                for id in catalog.iter_ids(prefix, cursor, offset, limit):
+                    yield json.dumps(enhance_dataset(id, gbif_keys)) + "\n"
+            return Response(generate(), mimetype="application/x-ndjson")
+        # Full list: precomputed until the catalog or the registry changes
+        if not (prefix or cursor or offset or limit is not None):
+            generation = (catalog.generation(), registry.generation if include_gbif else None)
+            report = reporting.cached(("datasets", include_gbif), generation,
+                lambda: apt_reporting.serialize([enhance_dataset(id, gbif_keys) for id in catalog.iter_ids()]))
+            return Response(report, mimetype="application/json")
+        # Retrieve dataset list from catalog
+        datasets = catalog.list_ids(prefix, cursor, offset, limit)
         enhanced_datasets = []
         for id in datasets:
-            dataset = {}
-            dataset["id"] = id
-            # Enhance result with APT URL of the dataset
-            dataset["url"] = CONFIG.APT_PUBLIC_URL + "/dataset/"+id
-            # If gbif attribute set, enhance result with GBIF registration information
-            if include_gbif:
-                if registry.check_already_registered(id):
-                    dataset["gbif_key"] = registry.get_gbif_key(id)
-                    dataset["registered"] = True
-                else:
-                    dataset["gbif_key"] = None
-                    dataset["registered"] = False
-            enhanced_datasets.append(dataset)
-        # Return enhanced dataset list
-        return enhanced_datasets
+            enhanced_datasets.append(enhance_dataset(id, gbif_keys))
+        # Return enhanced dataset list, with the cursor of the next page if any
+        headers = {}
+        if limit and len(datasets) == limit:
+            headers["X-Next-Cursor"] = datasets[-1]
+        return enhanced_datasets, headers
+
+    def enhance_dataset(id, gbif_keys):
+        dataset = {}
+        dataset["id"] = id
+        # Enhance result with APT URL of the dataset
+        dataset["url"] = CONFIG.APT_PUBLIC_URL + "/dataset/"+id
+        # If gbif attribute set, enhance result with GBIF registration information
+        if gbif_keys is not None:
+            dataset["gbif_key"] = gbif_keys.get(id)
+            dataset["registered"] = dataset["gbif_key"] != None
+        return dataset
+
+    def parse_positive_int(value, default):
+        if value is None or value == "":
+            return default
+        if not value.isdigit():
+            abort(400)
+        return int(value)
 
     @app.route('/dataset/<string:id>', methods=['GET'])
     def get_dataset(id):
@@ -48,61 +266,422 @@ def create_server(server_name, port):
         dataset_path = apt_dataset.get_path(id)
         if not dataset_path:
             abort(400)
+        # Cluster mode: dataset of the catalog, pulled from another node if needed
+        # (the other nodes only get the datasets held, sent by APT itself)
+        replica_request = cluster is not None and apt_cluster.REPLICA_HEADER in request.headers
+        if cluster:
+            dataset_path = get_cluster_dataset_path(id, not replica_request)
         # If dataset exists, return file
-        if apt_dataset.check_file_exist(dataset_path):
-            return send_file(dataset_path)
+        # (conditional response: ETag / Last-Modified validators and Range requests)
+        if dataset_path and apt_dataset.check_file_exist(dataset_path):
+            if replica_request:
+                return send_local_file(dataset_path, request.environ, mimetype="application/zip")
+            record_access(id, dataset_path)
+            # Sent by the fronting nginx (conditional and Range requests included)
+            if CONFIG.DOWNLOAD_MODE == "x-accel":
+                response = Response(mimetype="application/zip")
+                if apt_dataset.is_cold_path(dataset_path):
+                    response.headers["X-Accel-Redirect"] = CONFIG.DOWNLOAD_ACCEL_COLD_PREFIX + os.path.relpath(dataset_path, CONFIG.COLD_STORAGE_PATH)
+                else:
+                    response.headers["X-Accel-Redirect"] = CONFIG.DOWNLOAD_ACCEL_PREFIX + os.path.relpath(dataset_path, CONFIG.RESOURCES_PATH)
+                return response
+            entry = catalog.get(id)
+            return send_file(dataset_path, conditional=True, etag=dataset_etag(entry, dataset_path),
+                last_modified=entry["installed"] if entry else None)
         # Else return 404 error
         else:
             abort(404)
 
+    #
+    # Record a download of a dataset (storage tiering): a cold dataset is
+    # sent from the cold storage, and moved back to the hot one in background
+    #
+    def record_access(id, dataset_path):
+        catalog.record_access(id)
+        if CONFIG.TIERING_PROMOTE and apt_dataset.is_cold_path(dataset_path):
+            tiering.promote_in_background(id)
+
+    #
+    # Path of a dataset held by this node, in cluster mode (None if not in
+    # the catalog). The current content is pulled from another node if this
+    # node does not hold it (503 error if no node can send it)
+    #
+    def get_cluster_dataset_path(id, pull):
+        entry = catalog.get(id)
+        if not entry:
+            return None
+        if not cluster.holds(id, entry["checksum"]):
+            if not pull:
+                return None
+            if not cluster.pull(id, entry):
+                abort(503)
+        return apt_dataset.get_path(id)
+
+    #
+    # Stable ETag of a dataset (catalog entry): its checksum if known and still
+    # matching the file (or held by this node in cluster mode, the file being
+    # possibly a content stored before with another date), else the default
+    # one (modification date and size)
+    #
+    def dataset_etag(entry, dataset_path):
+        if entry and entry["checksum"]:
+            stat = os.stat(dataset_path)
+            if (entry["size"], entry["mtime"]) == (stat.st_size, stat.st_mtime):
+                return entry["checksum"]
+            if cluster and cluster.holds(entry["id"], entry["checksum"]):
+                return entry["checksum"]
+        return True
+
     @app.route('/report/registered', methods=['GET'])
     def list_registered_datasets():
-        datasets = []
-        for url in registry.gbif_published_datasets:
-            dataset = {}
-            dataset["url"] = url
-            dataset["key"] = registry.gbif_published_datasets[url]
-            datasets.append(dataset)
-        return datasets
+        return Response(reporting.registered_report(), mimetype="application/json")
 
     @app.route('/report/deleted', methods=['GET'])
     def list_deleted_datasets():
-        datasets = []
-        for url in registry.gbif_deleted_datasets:
-            dataset = {}
-            dataset["url"] = url
-            dataset["key"] = registry.gbif_deleted_datasets[url]
-            datasets.append(dataset)
-        return datasets
+        return Response(reporting.deleted_report(), mimetype="application/json")
+
+    @app.route('/report/reconciliation', methods=['GET'])
+    def report_reconciliation():
+        return reporting.build_reconciliation()
+
+    @app.route('/report/crawls', methods=['GET'])
+    def report_crawls():
+        report = jobs.coalescing_stats("update")
+        report["window"] = CONFIG.CRAWL_COALESCE_WINDOW
+        return report
+
+    #
+    # GBIF registry jobs failed for good (rejected or too many attempts)
+    #
+    @app.route('/report/failed_jobs', methods=['GET'])
+    def report_failed_jobs():
+        return jobs.list_failed()
 
     @app.route('/dataset/<string:id>', methods=['POST'])
     def post_dataset(id):
         # Secured endpoint
         apt_security.verify(request)
-        # Get server path for dataset
-        dataset_path = apt_dataset.get_path(id)
-        if not dataset_path:
-            print(f"Dataset path not correct "+dataset_path, flush=True)
+        # Check dataset id
+        if not apt_dataset.is_valid_id(id):
+            log.warning(f"Dataset path not correct "+id)
             abort(400)
-        apt_dataset.init_path(id)
-        # Save uploaded file to correct server path
-        uploaded_file = request.files['file']
-        if uploaded_file.filename == '':
-            print(f"Missing dataset file in POST", flush=True)
-            abort(400)
-        uploaded_file.save(dataset_path)
-        # Update GBIF registry (register or crawl)
-        gbif_key = registry.update(id)
-        if not gbif_key:
-            abort(500)
-        # Return success message
+        # Stream uploaded files to temporary files next to the dataset path
+        uploads = []
+        def open_upload(filename):
+            upload = apt_dataset.DatasetUpload(id)
+            uploads.append(upload)
+            return upload
+        request.upload_factory = open_upload
+        try:
+            with apt_metrics.timed("apt_upload_phase_duration_seconds", phase="receive"):
+                uploaded_file = request.files['file']
+            if uploaded_file.filename == '':
+                log.warning(f"Missing dataset file in POST")
+                abort(400)
+            stored = store_dataset(uploaded_file.stream)
+        except apt_archive.ArchiveError as e:
+            log.warning(f"Invalid dataset archive {id}: {e}")
+            error = {}
+            error["id"] = id
+            error["error"] = "invalid dataset archive: " + str(e)
+            return error, 400
+        finally:
+            for upload in uploads:
+                upload.discard()
+        # Queue GBIF registry update if needed
+        job_request = registry_job_request(id, stored)
+        job = jobs.enqueue(*job_request) if job_request else None
+        return upload_result(id, job, not stored), 202 if job else 200
+
+    @app.route('/bulk/dataset', methods=['POST'])
+    def post_datasets():
+        # Secured endpoint
+        apt_security.verify(request)
+        # Manifest of dataset ids, files taken from the staging area
+        if request.is_json:
+            ids = list(dict.fromkeys(get_manifest_ids()))
+            with ThreadPoolExecutor(max_workers=CONFIG.BULK_WORKERS) as executor:
+                outcomes = list(executor.map(catch_errors(store_staged_dataset), ids))
+        # Multipart upload, one file per dataset named <id>.zip
+        else:
+            uploads = []
+            def open_upload(filename):
+                id = os.path.basename(filename or "")[:-len(".zip")]
+                if not filename.endswith(".zip") or not apt_dataset.is_valid_id(id):
+                    return None
+                upload = apt_dataset.DatasetUpload(id)
+                uploads.append(upload)
+                return upload
+            request.upload_factory = open_upload
+            try:
+                # Dataset id -> upload (the last file of an id wins)
+                uploads_by_id = {}
+                for name, uploaded_file in request.files.items(multi=True):
+                    upload = uploaded_file.stream
+                    if isinstance(upload, apt_dataset.DatasetUpload):
+                        uploads_by_id[upload.id] = upload
+                    else:
+                        uploads_by_id[uploaded_file.filename] = None
+                ids = list(uploads_by_id)
+                def store_upload(id):
+                    if not uploads_by_id[id]:
+                        return "invalid dataset file name"
+                    return store_dataset(uploads_by_id[id])
+                with ThreadPoolExecutor(max_workers=CONFIG.BULK_WORKERS) as executor:
+                    outcomes = list(executor.map(catch_errors(store_upload), ids))
+            finally:
+                for upload in uploads:
+                    upload.discard()
+        # Queue all GBIF registry updates at once
+        job_requests = []
+        for id, outcome in zip(ids, outcomes):
+            job_request = registry_job_request(id, outcome) if isinstance(outcome, bool) else None
+            if job_request:
+                job_requests.append(job_request)
+        queued_jobs = dict((job["dataset_id"], job) for job in jobs.enqueue_many(job_requests))
+        # Return result of each dataset
+        results = []
+        for id, outcome in zip(ids, outcomes):
+            if isinstance(outcome, bool):
+                result = upload_result(id, queued_jobs.get(id), not outcome)
+                result["status"] = "stored" if outcome else "unchanged"
+            else:
+                result = {"id": id, "status": "error", "error": outcome}
+            results.append(result)
+        return bulk_report(results)
+
+    #
+    # Store a dataset file of the staging area (bulk upload)
+    # Return True if stored, False if unchanged, or an error message
+    #
+    def store_staged_dataset(id):
+        if not apt_dataset.is_valid_id(id):
+            return "invalid dataset id"
+        staged_path = os.path.join(CONFIG.STAGING_PATH, id + ".zip")
+        if not apt_dataset.check_file_exist(staged_path):
+            return "dataset file not found in staging area"
+        upload = apt_dataset.DatasetUpload(id)
+        try:
+            with open(staged_path, "rb") as f:
+                shutil.copyfileobj(f, upload, 1024 * 1024)
+            stored = store_dataset(upload)
+        finally:
+            upload.discard()
+        apt_dataset.delete_file(staged_path)
+        return stored
+
+    #
+    # Store an uploaded dataset file, unless it is the same as the stored one
+    # Return True if stored, False if unchanged
+    # Raise ArchiveError if the file is not a valid Darwin Core Archive
+    #
+    def store_dataset(upload):
+        id = upload.id
+        # Same file as the stored one: nothing to write or crawl
+        dataset_path = apt_dataset.get_path(id)
+        if is_unchanged(id, dataset_path, upload):
+            log.info(f"Dataset {id} unchanged, upload skipped")
+            return False
+        # Validate the archive and read its metadata (descriptor files only)
+        with apt_metrics.timed("apt_upload_phase_duration_seconds", phase="validate"):
+            upload.flush()
+            metadata = apt_archive.read_metadata(upload.tmp_path)
+        # Keep the stored file as previous version, then replace it by uploaded file
+        with apt_metrics.timed("apt_upload_phase_duration_seconds", phase="commit"):
+            keep_current_version(id, dataset_path)
+            upload.commit()
+        with apt_metrics.timed("apt_upload_phase_duration_seconds", phase="catalog"):
+            catalog.add(id, upload.path, upload.hexdigest(), metadata, time.time())
+            catalog.add_version(id, upload.hexdigest(), upload.size)
+            if cluster:
+                cluster.add_replica(id, upload.hexdigest())
+        return True
+
+    #
+    # Add the stored file of a dataset to its versions, if it has none yet
+    # (file stored before the blob store existed)
+    #
+    def keep_current_version(id, dataset_path):
+        if catalog.list_versions(id) or not apt_dataset.check_file_exist(dataset_path):
+            return
+        entry = catalog.get(id)
+        if not entry or not entry["checksum"]:
+            catalog.add(id, dataset_path)
+            entry = catalog.get(id)
+        # Cluster mode: the file of this node may be an older content
+        if cluster and not cluster.holds(id, entry["checksum"]):
+            return
+        apt_dataset.add_blob(dataset_path, entry["checksum"])
+        catalog.add_version(id, entry["checksum"], entry["size"])
+
+    def is_unchanged(id, dataset_path, upload):
+        entry = catalog.get(id)
+        if not entry or entry["size"] != upload.size or not apt_dataset.check_file_exist(dataset_path):
+            return False
+        # Checksum unknown (file found at startup): compute it once
+        if not entry["checksum"]:
+            catalog.add(id, dataset_path)
+            entry = catalog.get(id)
+        # Cluster mode: the file of this node may be an older content
+        if cluster and not cluster.holds(id, entry["checksum"]):
+            return False
+        return entry["checksum"] == upload.hexdigest()
+
+    #
+    # GBIF registry update job needed after an upload (action, id, delay):
+    # register now, or crawl after the coalescing window (re-uploads within
+    # the window trigger a single crawl). An unchanged dataset is only
+    # registered if it is not already, never crawled (its registration may
+    # be running)
+    #
+    def registry_job_request(id, stored):
+        if registry.check_already_registered(id):
+            if stored:
+                return ("update", id, CONFIG.CRAWL_COALESCE_WINDOW)
+            return None
+        return ("update" if stored else "register", id, 0)
+
+    def upload_result(id, job, unchanged=False):
         success = {}
         success["id"] = id
         success["url"] = CONFIG.APT_PUBLIC_URL + "/dataset/"+id
-        success["gbif_key"] = gbif_key
-        success["registered"] = True
+        success["gbif_key"] = registry.get_gbif_key(id)
+        success["registered"] = success["gbif_key"] != None
+        success["unchanged"] = unchanged
+        if job:
+            success["job"] = job["id"]
+            success["job_url"] = CONFIG.APT_PUBLIC_URL + "/job/"+job["id"]
         return success
 
+    @app.route('/dataset/<string:id>/versions', methods=['GET'])
+    def list_dataset_versions(id):
+        if not apt_dataset.is_valid_id(id):
+            abort(400)
+        versions = catalog.list_versions(id)
+        if not versions:
+            abort(404)
+        entry = catalog.get(id)
+        for version in versions:
+            version["current"] = entry is not None and entry["checksum"] == version["checksum"]
+        return versions
+
+    #
+    # List the files of a dataset archive (zip central directory only)
+    #
+    @app.route('/dataset/<string:id>/files', methods=['GET'])
+    def list_dataset_files(id):
+        dataset_path = get_readable_dataset_path(id)
+        files = []
+        for info in read_members(dataset_path):
+            if info.is_dir():
+                continue
+            file = {}
+            file["name"] = info.filename
+            file["size"] = info.file_size
+            file["compressed_size"] = info.compress_size
+            file["modified"] = "%04d-%02d-%02dT%02d:%02d:%02d" % info.date_time
+            file["url"] = CONFIG.APT_PUBLIC_URL + "/dataset/" + id + "/files/" + quote(info.filename)
+            files.append(file)
+        return files
+
+    #
+    # Send a file of a dataset archive, uncompressed on the fly
+    # (only this member of the archive is read)
+    #
+    @app.route('/dataset/<string:id>/files/<path:name>', methods=['GET'])
+    def get_dataset_file(id, name):
+        dataset_path = get_readable_dataset_path(id)
+        info = next((info for info in read_members(dataset_path) if info.filename == name and not info.is_dir()), None)
+        if not info:
+            abort(404)
+        try:
+            member = apt_archive.open_member(dataset_path, info)
+        except apt_archive.ArchiveError as e:
+            log.warning(f"Invalid dataset archive {id}: {e}")
+            abort(404)
+        def generate():
+            with member:
+                for chunk in iter(lambda: member.read(1024 * 1024), b""):
+                    yield chunk
+        mimetype = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        response = Response(generate(), mimetype=mimetype)
+        response.content_length = info.file_size
+        entry = catalog.get(id)
+        if entry and entry["checksum"]:
+            response.set_etag(f"{entry['checksum']}-{info.CRC:08x}")
+        return response.make_conditional(request)
+
+    #
+    # Path of a stored dataset to read (400 if invalid id, 404 if not found)
+    #
+    def get_readable_dataset_path(id):
+        dataset_path = apt_dataset.get_path(id)
+        if not dataset_path:
+            abort(400)
+        if cluster:
+            dataset_path = get_cluster_dataset_path(id, True)
+        if not dataset_path or not apt_dataset.check_file_exist(dataset_path):
+            abort(404)
+        record_access(id, dataset_path)
+        return dataset_path
+
+    #
+    # Members of a dataset archive (404 if not a zip archive)
+    #
+    def read_members(dataset_path):
+        try:
+            return apt_archive.list_members(dataset_path)
+        except apt_archive.ArchiveError as e:
+            log.warning(f"Invalid dataset archive {dataset_path}: {e}")
+            abort(404)
+
+    #
+    # Restore a previous version of a dataset (by default the one before
+    # the current content), then queue the GBIF registry update
+    #
+    @app.route('/dataset/<string:id>/rollback', methods=['POST'])
+    def rollback_dataset(id):
+        # Secured endpoint
+        apt_security.verify(request)
+        dataset_path = apt_dataset.get_storage_path(id)
+        if not dataset_path:
+            abort(400)
+        version_arg = request.args.get("version")
+        if version_arg:
+            version = catalog.get_version(id, parse_positive_int(version_arg, None))
+        else:
+            entry = catalog.get(id)
+            current_checksum = entry["checksum"] if entry else None
+            versions = [v for v in catalog.list_versions(id) if v["checksum"] != current_checksum]
+            version = versions[0] if versions else None
+        if not version:
+            abort(404)
+        blob_path = apt_dataset.find_blob(version["checksum"])
+        if not blob_path:
+            log.error(f"Content of dataset {id} version {version['version']} not found")
+            abort(404)
+        apt_dataset.install_dataset(id, blob_path)
+        catalog.add(id, dataset_path, version["checksum"], read_metadata(dataset_path), time.time())
+        catalog.add_version(id, version["checksum"], version["size"])
+        if cluster:
+            cluster.add_replica(id, version["checksum"])
+        log.info(f"Dataset {id} rolled back to version {version['version']}")
+        # Queue GBIF registry update
+        job = jobs.enqueue(*registry_job_request(id, True))
+        result = upload_result(id, job)
+        result["version"] = version["version"]
+        return result, 202
+
+    #
+    # Metadata of a stored dataset archive (None if not a valid archive)
+    #
+    def read_metadata(dataset_path):
+        try:
+            return apt_archive.read_metadata(dataset_path)
+        except apt_archive.ArchiveError as e:
+            log.warning(f"Invalid dataset archive {dataset_path}: {e}")
+            return None
+
     @app.route('/dataset/<string:id>', methods=['DELETE'])
     def delete_dataset(id):
         # Secured endpoint
@@ -110,19 +689,118 @@ def create_server(server_name, port):
         # Get server path for dataset
         dataset_path = apt_dataset.get_path(id)
         if not dataset_path:
-            print(f"Dataset path not correct "+dataset_path, flush=True)
+            log.warning(f"Dataset path not correct "+id)
             abort(400)
-        # If dataset exists, delete file and update registry
-        if apt_dataset.check_file_exist(dataset_path):
-            apt_dataset.delete_file(dataset_path)
-            registry.delete(id)
+        # If dataset exists, delete file and queue registry update
+        if dataset_exists(id, dataset_path):
+            apt_dataset.delete_dataset_file(id)
+            catalog.remove(id)
+            if cluster:
+                cluster.remove_replicas(id)
+            job = jobs.enqueue("delete", id)
         # Else return 404 error
         else:
             abort(404)
-        # Return success message
+        # Return accepted message
+        return delete_result(id, job), 202
+
+    @app.route('/bulk/dataset', methods=['DELETE'])
+    def delete_datasets():
+        # Secured endpoint
+        apt_security.verify(request)
+        results = []
+        deleted_ids = []
+        for id in dict.fromkeys(get_manifest_ids()):
+            dataset_path = apt_dataset.get_path(id)
+            if not dataset_path:
+                results.append({"id": id, "status": "error", "error": "invalid dataset id"})
+            elif not dataset_exists(id, dataset_path):
+                results.append({"id": id, "status": "error", "error": "dataset not found"})
+            else:
+                apt_dataset.delete_dataset_file(id)
+                catalog.remove(id)
+                if cluster:
+                    cluster.remove_replicas(id)
+                deleted_ids.append(id)
+                results.append({"id": id, "status": "deleted"})
+        # Queue all GBIF registry deletions at once
+        queued_jobs = jobs.enqueue_many([("delete", id, 0) for id in deleted_ids])
+        for result, job in zip([r for r in results if r["status"] == "deleted"], queued_jobs):
+            result.update(delete_result(result["id"], job))
+        return bulk_report(results)
+
+    #
+    # Check if a dataset exists (in cluster mode, it may be held by other nodes only)
+    #
+    def dataset_exists(id, dataset_path):
+        if apt_dataset.check_file_exist(dataset_path):
+            return True
+        return cluster is not None and catalog.get(id) is not None
+
+    def delete_result(id, job):
         success = {}
         success["id"] = id
         success["deleted"] = "done"
+        success["job"] = job["id"]
+        success["job_url"] = CONFIG.APT_PUBLIC_URL + "/job/"+job["id"]
         return success
 
+    #
+    # Dataset ids of a bulk request manifest: {"ids": [...]}
+    #
+    def get_manifest_ids():
+        manifest = request.get_json(silent=True)
+        if not isinstance(manifest, dict) or not isinstance(manifest.get("ids"), list):
+            abort(400)
+        return [str(id) for id in manifest["ids"]]
+
+    #
+    # Wrap a bulk item function to return its error message instead of failing
+    #
+    def catch_errors(function):
+        def call(id):
+            try:
+                return function(id)
+            except Exception as e:
+                log.error(f"Bulk operation failed for dataset {id}: {e}")
+                return str(e)
+        return call
+
+    def bulk_report(results):
+        summary = {}
+        for result in results:
+            summary[result["status"]] = summary.get(result["status"], 0) + 1
+        report = {}
+        report["summary"] = summary
+        report["results"] = results
+        return report
+
+    @app.route('/job/<string:job_id>', methods=['GET'])
+    def get_job(job_id):
+        job = jobs.get(job_id)
+        if not job:
+            abort(404)
+        return job
+
+    # Metrics of the startup (catalog and registry state loading),
+    # forgotten by the forked workers
+    apt_metrics.save()
+
+    return app
+
+#
+# Start the background services of a server process
+# (to be called in each worker process, after fork)
+#
+def start_services(app):
+    apt_metrics.start()
+    app.extensions["apt.catalog"].start_access_flush()
+    app.extensions["apt.leadership"].start()
+
+#
+# Run APT with the Flask development server
+#
+def create_server(server_name, port):
+    app = create_app(server_name)
+    start_services(app)
     app.run(port=port, host="0.0.0.0", debug=False)
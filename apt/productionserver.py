@@ -0,0 +1,49 @@
+from gunicorn.app.base import BaseApplication
+import apt.defaultserver as apt_default_server
+import apt.services.config as CONFIG
+
+#
+# Production WSGI server (Gunicorn): several worker processes,
+# each serving requests with a pool of threads
+#
+# The application is created once in the master process (preload), so
+# the catalog and the GBIF registry state are loaded once and shared by
+# all workers
+#
+class ProductionServer(BaseApplication):
+
+    def __init__(self, server_name, port):
+        self.server_name = server_name
+        self.options = {
+            "bind": f"0.0.0.0:{port}",
+            "workers": CONFIG.SERVER_WORKERS,
+            "worker_class": "gthread",
+            "threads": CONFIG.SERVER_THREADS,
+            "timeout": CONFIG.SERVER_TIMEOUT,
+            "graceful_timeout": CONFIG.SERVER_TIMEOUT,
+            "keepalive": CONFIG.SERVER_KEEPALIVE,
+            # Dataset files sent with the kernel sendfile (no copy in the worker)
+            "sendfile": True,
+            "preload_app": True,
+            "post_worker_init": post_worker_init
+        }
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return apt_default_server.create_app(self.server_name)
+
+#
+# Start the background services in each worker, after fork
+#
+def post_worker_init(worker):
+    apt_default_server.start_services(worker.wsgi)
+
+#
+# Run APT with the production server
+#
+def create_server(server_name, port):
+    ProductionServer(server_name, port).run()
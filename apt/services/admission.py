@@ -0,0 +1,177 @@
+import math
+import time
+import threading
+import logging
+import apt.services.metrics as apt_metrics
+import apt.services.config as CONFIG
+
+log = logging.getLogger(__name__)
+
+# Buckets of the clients kept (the full ones are forgotten beyond)
+MAX_BUCKETS = 10000
+
+#
+# Admission control of the requests of a traffic class (download, upload, admin)
+#
+# - concurrency: at most `limit` requests at a time in the process, the next
+#   ones wait for a free slot (at most ADMISSION_QUEUE_SIZE of them, for at most
+#   ADMISSION_QUEUE_TIMEOUT seconds) or are rejected (503)
+# - rate: each client (API key or IP address) has a token bucket of `burst`
+#   requests, refilled at `rate` requests per second, else rejected (429)
+#
+class TrafficClass:
+
+    def __init__(self, name, limit, rate, burst):
+        self.name = name
+        self.limit = limit
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.slots = threading.BoundedSemaphore(limit) if limit > 0 else None
+        self.lock = threading.Lock()
+        self.waiting = 0
+        # Client -> [tokens, time of the last refill]
+        self.buckets = {}
+
+    #
+    # Take a token of the client bucket
+    # Return 0 if taken, else the delay (seconds) until the next token
+    #
+    def take_token(self, client):
+        if self.rate <= 0:
+            return 0
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(client)
+            if bucket is None:
+                if len(self.buckets) >= MAX_BUCKETS:
+                    self.forget_full_buckets(now)
+                bucket = self.buckets[client] = [self.burst, now]
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0
+            return (1 - bucket[0]) / self.rate
+
+    def forget_full_buckets(self, now):
+        for client, (tokens, refilled) in list(self.buckets.items()):
+            if tokens + (now - refilled) * self.rate >= self.burst:
+                del self.buckets[client]
+
+    #
+    # Take a slot, waiting for a free one if the queue is not full
+    # Return True if taken
+    #
+    def acquire(self):
+        if not self.slots:
+            return True
+        if self.slots.acquire(blocking=False):
+            return True
+        with self.lock:
+            if self.waiting >= CONFIG.ADMISSION_QUEUE_SIZE:
+                return False
+            self.waiting += 1
+        try:
+            with apt_metrics.timed("apt_admission_wait_seconds", traffic_class=self.name):
+                return self.slots.acquire(timeout=CONFIG.ADMISSION_QUEUE_TIMEOUT)
+        finally:
+            with self.lock:
+                self.waiting -= 1
+
+    def release(self):
+        if self.slots:
+            self.slots.release()
+
+#
+# Admission control of the server requests, by traffic class
+#
+class Admission:
+
+    def __init__(self):
+        self.traffic_classes = {}
+        self.traffic_classes["download"] = TrafficClass("download",
+            CONFIG.ADMISSION_DOWNLOAD_CONCURRENCY, CONFIG.ADMISSION_DOWNLOAD_RATE, CONFIG.ADMISSION_DOWNLOAD_BURST)
+        self.traffic_classes["upload"] = TrafficClass("upload",
+            CONFIG.ADMISSION_UPLOAD_CONCURRENCY, CONFIG.ADMISSION_UPLOAD_RATE, CONFIG.ADMISSION_UPLOAD_BURST)
+        self.traffic_classes["admin"] = TrafficClass("admin",
+            CONFIG.ADMISSION_ADMIN_CONCURRENCY, CONFIG.ADMISSION_ADMIN_RATE, CONFIG.ADMISSION_ADMIN_BURST)
+
+    #
+    # Admit a request of a traffic class from a client
+    #
+    # Return (release, None) if admitted, the slot taken being released by
+    # calling release, else (None, (status, retry after seconds))
+    #
+    def admit(self, name, client):
+        traffic_class = self.traffic_classes[name]
+        delay = traffic_class.take_token(client)
+        if delay:
+            apt_metrics.inc("apt_admission_rejected_total", traffic_class=name, reason="rate")
+            return None, (429, math.ceil(delay))
+        if not traffic_class.acquire():
+            apt_metrics.inc("apt_admission_rejected_total", traffic_class=name, reason="saturated")
+            log.warning(f"Request of traffic class {name} rejected: {traffic_class.limit} requests running")
+            return None, (503, max(1, math.ceil(CONFIG.ADMISSION_QUEUE_TIMEOUT)))
+        return traffic_class.release, None
+
+#
+# WSGI middleware calling the functions registered in the request environment
+# (ON_CLOSE key) once the response is sent, streamed bodies included
+#
+# File responses are still sent with the server file wrapper (sendfile):
+# a subclass of it calling the functions on close is given to the application
+#
+ON_CLOSE = "apt.on_close"
+
+class OnCloseMiddleware:
+
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        callbacks = environ[ON_CLOSE] = []
+        def close():
+            while callbacks:
+                callbacks.pop()()
+        file_wrapper = environ.get("wsgi.file_wrapper")
+        if file_wrapper:
+            environ["wsgi.file_wrapper"] = closing_file_wrapper(file_wrapper, close)
+        try:
+            iterable = self.app(environ, start_response)
+        except BaseException:
+            close()
+            raise
+        if file_wrapper and isinstance(iterable, environ["wsgi.file_wrapper"]):
+            return iterable
+        return ClosingIterable(iterable, close)
+
+class ClosingIterable:
+
+    def __init__(self, iterable, close):
+        self.iterable = iterable
+        self.close_callback = close
+
+    def __iter__(self):
+        return iter(self.iterable)
+
+    def close(self):
+        try:
+            if hasattr(self.iterable, "close"):
+                self.iterable.close()
+        finally:
+            self.close_callback()
+
+def closing_file_wrapper(file_wrapper, close):
+    class ClosingFileWrapper(file_wrapper):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            # The close function of the wrapper may be set on the instance
+            close_file = getattr(self, "close", None)
+            def close_all():
+                try:
+                    if close_file:
+                        close_file()
+                finally:
+                    close()
+            self.close = close_all
+    return ClosingFileWrapper
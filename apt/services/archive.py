@@ -0,0 +1,266 @@
+import os
+import struct
+import zipfile
+import threading
+import collections
+import xml.etree.ElementTree as ET
+import apt.services.metrics as apt_metrics
+import apt.services.config as CONFIG
+
+# Maximum size of the descriptor files read from an archive (meta.xml, eml.xml)
+DESCRIPTOR_MAX_SIZE = 10 * 1024 * 1024
+
+# Licenses accepted by the GBIF registry (the first matching one is used)
+GBIF_LICENSES = [
+    ("publicdomain/zero/1.0", "http://creativecommons.org/publicdomain/zero/1.0/legalcode"),
+    ("licenses/by-nc/4.0", "http://creativecommons.org/licenses/by-nc/4.0/legalcode"),
+    ("licenses/by/4.0", "http://creativecommons.org/licenses/by/4.0/legalcode")
+]
+
+# Languages accepted by the GBIF registry (ISO 639-2 code), with their
+# ISO 639-1 code, bibliographic ISO 639-2 code and names found in EML
+# metadata (English and native)
+GBIF_LANGUAGES = [
+    ("ara", "ar", None, ["arabic", "العربية"]),
+    ("bul", "bg", None, ["bulgarian", "български"]),
+    ("cat", "ca", None, ["catalan", "català"]),
+    ("ces", "cs", "cze", ["czech", "čeština"]),
+    ("dan", "da", None, ["danish", "dansk"]),
+    ("deu", "de", "ger", ["german", "deutsch"]),
+    ("ell", "el", "gre", ["greek", "ελληνικά"]),
+    ("eng", "en", None, ["english"]),
+    ("est", "et", None, ["estonian", "eesti"]),
+    ("eus", "eu", "baq", ["basque", "euskara"]),
+    ("fas", "fa", "per", ["persian", "فارسی"]),
+    ("fin", "fi", None, ["finnish", "suomi"]),
+    ("fra", "fr", "fre", ["french", "français", "francais"]),
+    ("glg", "gl", None, ["galician", "galego"]),
+    ("heb", "he", None, ["hebrew", "עברית"]),
+    ("hin", "hi", None, ["hindi", "हिन्दी"]),
+    ("hrv", "hr", None, ["croatian", "hrvatski"]),
+    ("hun", "hu", None, ["hungarian", "magyar"]),
+    ("ind", "id", None, ["indonesian", "bahasa indonesia"]),
+    ("isl", "is", "ice", ["icelandic", "íslenska"]),
+    ("ita", "it", None, ["italian", "italiano"]),
+    ("jpn", "ja", None, ["japanese", "日本語"]),
+    ("kor", "ko", None, ["korean", "한국어"]),
+    ("lav", "lv", None, ["latvian", "latviešu"]),
+    ("lit", "lt", None, ["lithuanian", "lietuvių"]),
+    ("msa", "ms", "may", ["malay", "bahasa melayu"]),
+    ("nld", "nl", "dut", ["dutch", "nederlands"]),
+    ("nor", "no", None, ["norwegian", "norsk"]),
+    ("pol", "pl", None, ["polish", "polski"]),
+    ("por", "pt", None, ["portuguese", "português", "portugues"]),
+    ("ron", "ro", "rum", ["romanian", "română"]),
+    ("rus", "ru", None, ["russian", "русский"]),
+    ("slk", "sk", "slo", ["slovak", "slovenčina"]),
+    ("slv", "sl", None, ["slovenian", "slovene", "slovenščina"]),
+    ("spa", "es", None, ["spanish", "castilian", "español", "espanol", "castellano"]),
+    ("swe", "sv", None, ["swedish", "svenska"]),
+    ("tha", "th", None, ["thai", "ไทย"]),
+    ("tur", "tr", None, ["turkish", "türkçe"]),
+    ("ukr", "uk", None, ["ukrainian", "українська"]),
+    ("vie", "vi", None, ["vietnamese", "tiếng việt"]),
+    ("zho", "zh", "chi", ["chinese", "中文"])
+]
+
+#
+# Invalid Darwin Core Archive
+#
+class ArchiveError(Exception):
+    pass
+
+#
+# Validate a Darwin Core Archive and extract its metadata
+# (title, description, license, language, None if unknown)
+#
+# Only the zip central directory and the descriptor files (meta.xml and
+# the EML metadata file) are read, the data files are never unpacked
+#
+def read_metadata(file):
+    try:
+        with zipfile.ZipFile(file) as archive:
+            names = set(archive.namelist())
+            if "meta.xml" not in names:
+                # Archive without descriptor: a single data file
+                data_files = [name for name in names if not name.endswith("/")]
+                if len(data_files) != 1:
+                    raise ArchiveError("meta.xml not found")
+                return {}
+
+            meta = read_xml(archive, "meta.xml")
+            cores = [e for e in meta if local_name(e.tag) == "core"]
+            if len(cores) != 1:
+                raise ArchiveError("meta.xml must declare a single core")
+            for element in meta:
+                if local_name(element.tag) in ("core", "extension"):
+                    check_data_files(element, names)
+
+            eml_name = meta.get("metadata")
+            if not eml_name:
+                return {}
+            if eml_name not in names:
+                raise ArchiveError(f"metadata file {eml_name} not found")
+            return read_eml(read_xml(archive, eml_name))
+    except zipfile.BadZipFile as e:
+        raise ArchiveError(f"invalid zip file: {e}")
+
+#
+# Members of a zip archive (ZipInfo list, in archive order)
+#
+# The central directory of the archives read recently is cached, keyed by
+# the identity of the file (inode, size and modification date): a member is
+# read without parsing the archive again, and a new upload is read again
+#
+def list_members(path):
+    stat = os.stat(path)
+    key = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    members = index_cache.get(path, key)
+    if members is None:
+        apt_metrics.inc("apt_archive_index_cache_total", result="miss")
+        try:
+            with zipfile.ZipFile(path) as archive:
+                members = archive.infolist()
+        except zipfile.BadZipFile as e:
+            raise ArchiveError(f"invalid zip file: {e}")
+        index_cache.put(path, key, members)
+    else:
+        apt_metrics.inc("apt_archive_index_cache_total", result="hit")
+    return members
+
+#
+# Open a member of a zip archive (ZipInfo of list_members) for reading its
+# uncompressed content: the local header of the member is read at its offset,
+# the rest of the archive is not read
+#
+def open_member(path, info):
+    if info.flag_bits & 0x1:
+        raise ArchiveError(f"{info.filename} is encrypted")
+    f = open(path, "rb")
+    try:
+        f.seek(info.header_offset)
+        header = f.read(zipfile.sizeFileHeader)
+        if len(header) != zipfile.sizeFileHeader or header[0:4] != zipfile.stringFileHeader:
+            raise ArchiveError(f"invalid local header of {info.filename}")
+        name_length, extra_length = struct.unpack("<HH", header[26:30])
+        f.seek(name_length + extra_length, os.SEEK_CUR)
+        return zipfile.ZipExtFile(f, "r", info, None, True)
+    except BaseException:
+        f.close()
+        raise
+
+#
+# LRU cache of archive central directories: path -> (file key, members)
+#
+class IndexCache:
+
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+
+    def get(self, path, key):
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is None or entry[0] != key:
+                return None
+            self.entries.move_to_end(path)
+            return entry[1]
+
+    def put(self, path, key, members):
+        if self.size <= 0:
+            return
+        with self.lock:
+            self.entries[path] = (key, members)
+            self.entries.move_to_end(path)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+index_cache = IndexCache(CONFIG.ARCHIVE_INDEX_CACHE_SIZE)
+
+###################################
+#
+#   Internal Functions
+#
+###################################
+
+#
+# Parse an XML file of the archive (size limited)
+#
+def read_xml(archive, name):
+    with archive.open(name) as f:
+        content = f.read(DESCRIPTOR_MAX_SIZE + 1)
+    if len(content) > DESCRIPTOR_MAX_SIZE:
+        raise ArchiveError(f"{name} is too large")
+    try:
+        return ET.fromstring(content)
+    except ET.ParseError as e:
+        raise ArchiveError(f"invalid {name}: {e}")
+
+#
+# Check that the data files of a core or an extension exist in the archive
+#
+def check_data_files(element, names):
+    locations = [e.text.strip() for e in element.iter() if local_name(e.tag) == "location" and e.text and e.text.strip()]
+    if not locations:
+        raise ArchiveError(f"no data file declared for {element.get('rowType')}")
+    for location in locations:
+        if location not in names:
+            raise ArchiveError(f"data file {location} not found")
+
+#
+# Extract the dataset metadata of an EML document
+#
+def read_eml(eml):
+    dataset = first_child(eml, "dataset")
+    if dataset is None:
+        raise ArchiveError("no dataset in EML metadata")
+    metadata = {}
+    metadata["title"] = text_of(first_child(dataset, "title"))
+    metadata["description"] = text_of(first_child(dataset, "abstract"))
+    metadata["license"] = read_license(first_child(dataset, "intellectualRights"))
+    metadata["language"] = text_of(first_child(dataset, "language"))
+    return metadata
+
+def read_license(rights):
+    if rights is None:
+        return None
+    urls = [e.get("url", "") for e in rights.iter() if local_name(e.tag) == "ulink"]
+    for url in urls + [text_of(rights) or ""]:
+        for pattern, license in GBIF_LICENSES:
+            if pattern in url:
+                return license
+    return None
+
+#
+# ISO 639-2 code of the language of an EML document: code (ISO 639-1 or
+# 639-2, with or without region, e.g. "en_US") or name, e.g. "English" or
+# "français" (None if unknown)
+#
+def gbif_language(language):
+    if not language:
+        return None
+    language = language.strip().lower()
+    code = language.replace("_", "-").split("-")[0]
+    for gbif_code, iso1_code, bibliographic_code, names in GBIF_LANGUAGES:
+        if code in (gbif_code, iso1_code, bibliographic_code) or language in names:
+            return gbif_code
+    return None
+
+def first_child(element, name):
+    for child in element:
+        if local_name(child.tag) == name:
+            return child
+    return None
+
+#
+# Normalized text of an element and its sub-elements (paragraphs, ...)
+#
+def text_of(element):
+    if element is None:
+        return None
+    text = " ".join(" ".join(element.itertext()).split())
+    return text or None
+
+def local_name(tag):
+    return tag.rsplit("}", 1)[-1]
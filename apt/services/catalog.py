@@ -0,0 +1,310 @@
+import os
+import json
+import time
+import threading
+import logging
+import apt.services.dataset as apt_dataset
+import apt.services.database as apt_database
+import apt.services.config as CONFIG
+
+log = logging.getLogger(__name__)
+
+class Catalog(apt_database.Database):
+
+    def __init__(self, path=None):
+        super().__init__(path or CONFIG.CATALOG_PATH)
+        with self.connection() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS datasets ("
+                "id TEXT PRIMARY KEY, "
+                "size INTEGER NOT NULL, "
+                "mtime REAL NOT NULL, "
+                "checksum TEXT)")
+            # Generation: incremented on each change of the catalog
+            connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            connection.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('generation', 0)")
+            # Versions of each dataset (content stored in the blob store)
+            connection.execute("CREATE TABLE IF NOT EXISTS versions ("
+                "id TEXT NOT NULL, "
+                "version INTEGER NOT NULL, "
+                "checksum TEXT NOT NULL, "
+                "size INTEGER NOT NULL, "
+                "created REAL NOT NULL, "
+                "PRIMARY KEY (id, version))")
+        # Metadata of the dataset archive (JSON: title, description, license, language)
+        self.ensure_column("datasets", "metadata", "TEXT")
+        # Downloads of the dataset: count and date of the last one (storage tiering)
+        self.ensure_column("datasets", "accesses", "INTEGER NOT NULL DEFAULT 0")
+        self.ensure_column("datasets", "last_access", "REAL")
+        # Date the current content was uploaded or restored (the file is a link
+        # to a shared blob: its modification date is the one of the first
+        # upload of this content). Unknown for the files found on disk
+        self.ensure_column("datasets", "installed", "REAL")
+        self.reset_accesses()
+        # Accesses not saved yet are those of the parent process
+        os.register_at_fork(after_in_child=self.reset_accesses)
+
+    def reset_accesses(self):
+        self.access_lock = threading.Lock()
+        # Id -> [accesses, date of the last one], not saved yet
+        self.accesses = {}
+
+    #
+    # Synchronize the catalog with the file system
+    #
+    # Only new or modified files (size or modification date changed)
+    # are updated, checksums of unchanged files are kept
+    #
+    def rebuild(self):
+        log.info("Rebuilding dataset catalog...")
+        indexed = {}
+        for row in self.connection().execute("SELECT id, size, mtime FROM datasets"):
+            indexed[row["id"]] = (row["size"], row["mtime"])
+
+        updated = []
+        for id in apt_dataset.list_all():
+            dataset_path = apt_dataset.get_path(id)
+            if not dataset_path:
+                continue
+            try:
+                stat = os.stat(dataset_path)
+            except FileNotFoundError:
+                continue
+            if indexed.pop(id, None) != (stat.st_size, stat.st_mtime):
+                updated.append((id, stat.st_size, stat.st_mtime, None))
+
+        with self.connection() as connection:
+            connection.executemany("INSERT OR REPLACE INTO datasets (id, size, mtime, checksum) VALUES (?, ?, ?, ?)", updated)
+            connection.executemany("DELETE FROM datasets WHERE id = ?", [(id,) for id in indexed])
+            if updated or indexed:
+                increment_generation(connection)
+
+        log.info(f"Dataset catalog rebuilt: {len(updated)} updated, {len(indexed)} removed")
+
+    #
+    # Add or update a dataset in the catalog
+    # (the metadata and the install date of the dataset are kept if not given)
+    #
+    def add(self, id, dataset_path, checksum=None, metadata=None, installed=None):
+        stat = os.stat(dataset_path)
+        if not checksum:
+            checksum = apt_dataset.compute_checksum(dataset_path)
+        with self.connection() as connection:
+            connection.execute("INSERT INTO datasets (id, size, mtime, checksum, metadata, installed) VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (id) DO UPDATE SET size = excluded.size, mtime = excluded.mtime, checksum = excluded.checksum, "
+                "metadata = COALESCE(excluded.metadata, datasets.metadata), installed = COALESCE(excluded.installed, datasets.installed)",
+                (id, stat.st_size, stat.st_mtime, checksum, json.dumps(metadata) if metadata is not None else None, installed))
+            increment_generation(connection)
+
+    #
+    # Remove a dataset from the catalog
+    #
+    def remove(self, id):
+        with self.connection() as connection:
+            if connection.execute("DELETE FROM datasets WHERE id = ?", (id,)).rowcount:
+                increment_generation(connection)
+
+    #
+    # Get the catalog generation (changes whenever the catalog changes,
+    # in any process)
+    #
+    def generation(self):
+        return self.connection().execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()["value"]
+
+    #
+    # Get the metadata of a dataset archive (None if unknown)
+    #
+    def get_metadata(self, id):
+        row = self.connection().execute("SELECT metadata FROM datasets WHERE id = ?", (id,)).fetchone()
+        if row and row["metadata"]:
+            return json.loads(row["metadata"])
+        return None
+
+    #
+    # Count the datasets and their total size
+    #
+    def stats(self):
+        row = self.connection().execute("SELECT COUNT(*) AS datasets, COALESCE(SUM(size), 0) AS size FROM datasets").fetchone()
+        return dict(row)
+
+    #
+    # Get a dataset entry (id, size, mtime, checksum, installed)
+    #
+    # mtime is the one of the file (to check it is unchanged), installed
+    # the date of the upload of its content (the file one if unknown)
+    #
+    def get(self, id):
+        row = self.connection().execute("SELECT " + ENTRY_COLUMNS + " FROM datasets WHERE id = ?", (id,)).fetchone()
+        if row:
+            return dict(row)
+        return None
+
+    #
+    # List dataset ids, ordered by id
+    #
+    # - prefix: only ids starting with prefix (index range scan, like
+    #   browsing the a/b/c shard directories)
+    # - after: only ids strictly greater than this cursor (keyset paging)
+    # - offset / limit: classic paging
+    #
+    def list_ids(self, prefix="", after="", offset=0, limit=None):
+        query = "SELECT id FROM datasets WHERE 1 = 1"
+        parameters = []
+        if prefix:
+            # Ids only contain [A-Za-z0-9-_.], all lower than \x7f
+            query += " AND id >= ? AND id < ?"
+            parameters += [prefix, prefix + "\x7f"]
+        if after:
+            query += " AND id > ?"
+            parameters.append(after)
+        query += " ORDER BY id LIMIT ? OFFSET ?"
+        parameters += [limit if limit is not None else -1, offset]
+        return [row["id"] for row in self.connection().execute(query, parameters)]
+
+    #
+    # Iterate over dataset ids chunk by chunk (constant memory)
+    #
+    def iter_ids(self, prefix="", after="", offset=0, limit=None, chunk_size=1000):
+        while limit is None or limit > 0:
+            size = chunk_size if limit is None else min(chunk_size, limit)
+            ids = self.list_ids(prefix, after, offset, size)
+            for id in ids:
+                yield id
+            if len(ids) < size:
+                break
+            after = ids[-1]
+            offset = 0
+            if limit is not None:
+                limit -= len(ids)
+
+    #
+    # List all dataset entries (id, size, mtime, checksum, installed)
+    #
+    def list_entries(self):
+        return [dict(row) for row in self.connection().execute("SELECT " + ENTRY_COLUMNS + " FROM datasets ORDER BY id")]
+
+    #
+    # Add a new version of a dataset (unless it has the same content as
+    # the latest one), then remove the versions beyond VERSION_RETENTION
+    #
+    # Return the version number
+    #
+    def add_version(self, id, checksum, size):
+        with self.connection() as connection:
+            latest = connection.execute("SELECT version, checksum FROM versions WHERE id = ? ORDER BY version DESC LIMIT 1", (id,)).fetchone()
+            if latest and latest["checksum"] == checksum:
+                return latest["version"]
+            version = latest["version"] + 1 if latest else 1
+            connection.execute("INSERT INTO versions (id, version, checksum, size, created) VALUES (?, ?, ?, ?, ?)",
+                (id, version, checksum, size, time.time()))
+            connection.execute("DELETE FROM versions WHERE id = ? AND version <= ?", (id, version - CONFIG.VERSION_RETENTION))
+        return version
+
+    #
+    # List the versions of a dataset (version, checksum, size, created), latest first
+    #
+    def list_versions(self, id):
+        return [dict(row) for row in self.connection().execute("SELECT version, checksum, size, created FROM versions WHERE id = ? ORDER BY version DESC", (id,))]
+
+    #
+    # Get a version of a dataset (version, checksum, size, created)
+    #
+    def get_version(self, id, version):
+        row = self.connection().execute("SELECT version, checksum, size, created FROM versions WHERE id = ? AND version = ?", (id, version)).fetchone()
+        if row:
+            return dict(row)
+        return None
+
+    #
+    # Record a download of a dataset (saved in the catalog in background,
+    # without changing the catalog generation)
+    #
+    def record_access(self, id):
+        now = time.time()
+        with self.access_lock:
+            access = self.accesses.setdefault(id, [0, now])
+            access[0] += 1
+            access[1] = now
+
+    #
+    # Save the recorded accesses of this process
+    #
+    def save_accesses(self):
+        with self.access_lock:
+            accesses = self.accesses
+            self.accesses = {}
+        if accesses:
+            with self.connection() as connection:
+                connection.executemany("UPDATE datasets SET accesses = accesses + ?, last_access = MAX(COALESCE(last_access, 0), ?) WHERE id = ?",
+                    [(count, last_access, id) for id, (count, last_access) in accesses.items()])
+
+    #
+    # Save the recorded accesses every ACCESS_FLUSH_INTERVAL seconds
+    #
+    def start_access_flush(self):
+        def run():
+            while True:
+                time.sleep(CONFIG.ACCESS_FLUSH_INTERVAL)
+                try:
+                    self.save_accesses()
+                except Exception as e:
+                    log.error(f"Dataset accesses saving failed: {e}")
+        threading.Thread(target=run, name="access-flush", daemon=True).start()
+
+    #
+    # List the dataset entries (id, size, mtime, checksum, installed) neither
+    # downloaded nor uploaded for days, least recently used first
+    #
+    def list_unused(self, days):
+        limit = time.time() - days * 86400
+        return [dict(row) for row in self.connection().execute("SELECT " + ENTRY_COLUMNS + " FROM datasets "
+            "WHERE MAX(COALESCE(last_access, 0), COALESCE(installed, mtime)) < ? "
+            "ORDER BY MAX(COALESCE(last_access, 0), COALESCE(installed, mtime))", (limit,))]
+
+    #
+    # Checksums of the contents only used by kept versions (not current)
+    #
+    def list_version_checksums(self):
+        return set(row["checksum"] for row in self.connection().execute("SELECT checksum FROM versions "
+            "EXCEPT SELECT checksum FROM datasets WHERE checksum IS NOT NULL"))
+
+    #
+    # Remove the blobs used neither by a dataset nor by a kept version
+    #
+    # Recent blobs (linked less than an hour ago) are kept: they may be
+    # used by an upload not yet added to the catalog. A content in both blob
+    # stores (promoted back to the hot storage) is removed from the cold one
+    #
+    def collect_garbage(self):
+        connection = self.connection()
+        used = set(row["checksum"] for row in connection.execute("SELECT checksum FROM versions UNION SELECT checksum FROM datasets WHERE checksum IS NOT NULL"))
+        removed = 0
+        freed = 0
+        for checksum, blob_path in apt_dataset.list_blobs():
+            if checksum in used and not (apt_dataset.is_cold_path(blob_path) and os.path.exists(apt_dataset.get_blob_path(checksum))):
+                continue
+            stat = os.stat(blob_path)
+            if stat.st_ctime > time.time() - 3600:
+                continue
+            os.remove(blob_path)
+            removed += 1
+            freed += stat.st_size
+        log.info(f"Blob store garbage collected: {removed} files removed, {freed} bytes freed")
+
+    #
+    # Collect garbage every BLOB_GC_INTERVAL seconds
+    #
+    def start_garbage_collection(self):
+        def run():
+            while True:
+                time.sleep(CONFIG.BLOB_GC_INTERVAL)
+                try:
+                    self.collect_garbage()
+                except Exception as e:
+                    log.error(f"Blob store garbage collection failed: {e}")
+        threading.Thread(target=run, name="blob-gc", daemon=True).start()
+
+# Columns of a dataset entry
+ENTRY_COLUMNS = "id, size, mtime, checksum, COALESCE(installed, mtime) AS installed"
+
+def increment_generation(connection):
+    connection.execute("UPDATE meta SET value = value + 1 WHERE key = 'generation'")
@@ -0,0 +1,238 @@
+import os
+import time
+import zlib
+import threading
+import logging
+import requests
+import apt.services.dataset as apt_dataset
+import apt.services.database as apt_database
+import apt.services.metrics as apt_metrics
+import apt.services.config as CONFIG
+
+log = logging.getLogger(__name__)
+
+# Header of the downloads between nodes: the dataset is only sent if the
+# node holds it (never pulled from another node in turn)
+REPLICA_HEADER = "X-APT-Replica"
+
+# Pulls of a dataset are done one at a time (in a process)
+PULL_LOCK_STRIPES = 64
+
+#
+# Cluster of APT nodes sharing the catalog, the job queue and the GBIF
+# registry state (CLUSTER_PATH), each node having its own datasets storage
+#
+# The cluster store (SQLite, shared) holds:
+# - the nodes, with their URL and last heartbeat (alive peers), sent by
+#   the leader process of the node
+# - the replicas: content (checksum) of the datasets held by each node
+# - the leases: the cluster leader (the only process running the GBIF
+#   registry jobs and synchronization) holds a lease renewed until it stops
+#
+# A node asked for a dataset it does not hold (or holds an older content of)
+# pulls it from a peer holding the current content, checked by its checksum
+#
+class Cluster(apt_database.Database):
+
+    def __init__(self, path=None):
+        super().__init__(path or CONFIG.CLUSTER_DB_PATH)
+        self.node_id = CONFIG.NODE_ID
+        self.pull_locks = [threading.Lock() for i in range(PULL_LOCK_STRIPES)]
+        self.open_session()
+        # Connections of the pool can not be shared with forked processes
+        os.register_at_fork(after_in_child=self.open_session)
+        with self.connection() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS nodes ("
+                "id TEXT PRIMARY KEY, "
+                "url TEXT NOT NULL, "
+                "joined REAL NOT NULL, "
+                "heartbeat REAL NOT NULL)")
+            connection.execute("CREATE TABLE IF NOT EXISTS replicas ("
+                "dataset_id TEXT NOT NULL, "
+                "node TEXT NOT NULL, "
+                "checksum TEXT NOT NULL, "
+                "PRIMARY KEY (dataset_id, node))")
+            connection.execute("CREATE TABLE IF NOT EXISTS leases ("
+                "name TEXT PRIMARY KEY, "
+                "holder TEXT NOT NULL, "
+                "expires REAL NOT NULL)")
+        # Leader process of the node, sending the heartbeats: "<node id>/<pid>"
+        self.ensure_column("nodes", "process", "TEXT")
+
+    def open_session(self):
+        self.session = requests.Session()
+
+    #
+    # Join the cluster: synchronize the shared catalog with the datasets of
+    # this node, instead of a catalog rebuild (the datasets of the other nodes
+    # are kept)
+    #
+    # On the first join, the datasets of the node are added to the catalog.
+    # Afterwards, a dataset missing from the catalog was deleted (on another
+    # node) while this node was stopped: its file is removed
+    #
+    def join(self, catalog):
+        log.info(f"Joining cluster as node {self.node_id}...")
+        connection = self.connection()
+        joined = connection.execute("SELECT 1 FROM nodes WHERE id = ?", (self.node_id,)).fetchone() is not None
+        replicas = dict((row["dataset_id"], row["checksum"]) for row in
+            connection.execute("SELECT dataset_id, checksum FROM replicas WHERE node = ?", (self.node_id,)))
+
+        held = {}
+        added = 0
+        removed = 0
+        for id in apt_dataset.list_all():
+            dataset_path = apt_dataset.get_path(id)
+            if not dataset_path:
+                continue
+            if not catalog.get(id):
+                if joined:
+                    apt_dataset.delete_dataset_file(id)
+                    removed += 1
+                    continue
+                catalog.add(id, dataset_path)
+                added += 1
+                held[id] = catalog.get(id)["checksum"]
+            elif id in replicas:
+                held[id] = replicas[id]
+            else:
+                held[id] = apt_dataset.compute_checksum(dataset_path)
+
+        with connection:
+            connection.execute("DELETE FROM replicas WHERE node = ?", (self.node_id,))
+            connection.executemany("INSERT INTO replicas (dataset_id, node, checksum) VALUES (?, ?, ?)",
+                [(id, self.node_id, checksum) for id, checksum in held.items()])
+        self.heartbeat()
+        log.info(f"Cluster joined: {len(held)} datasets held, {added} added to the catalog, {removed} deleted datasets removed")
+
+    #
+    # Record this node (and process) as alive
+    #
+    def heartbeat(self):
+        now = time.time()
+        process = f"{self.node_id}/{os.getpid()}"
+        with self.connection() as connection:
+            connection.execute("INSERT INTO nodes (id, url, joined, heartbeat, process) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (id) DO UPDATE SET url = excluded.url, heartbeat = excluded.heartbeat, process = excluded.process",
+                (self.node_id, CONFIG.NODE_URL, now, now, process))
+
+    #
+    # Check if a process ("<node id>/<pid>") is alive: the leader process
+    # of a node alive
+    #
+    def is_alive(self, process):
+        node_id = process.rsplit("/", 1)[0]
+        row = self.connection().execute("SELECT process FROM nodes WHERE id = ? AND heartbeat > ?",
+            (node_id, self.heartbeat_limit())).fetchone()
+        return row is not None and row["process"] == process
+
+    #
+    # Send a heartbeat every CLUSTER_HEARTBEAT_INTERVAL seconds
+    #
+    def start_heartbeat(self):
+        def run():
+            while True:
+                try:
+                    self.heartbeat()
+                except Exception as e:
+                    log.error(f"Cluster heartbeat failed: {e}")
+                time.sleep(CONFIG.CLUSTER_HEARTBEAT_INTERVAL)
+        threading.Thread(target=run, name="cluster-heartbeat", daemon=True).start()
+
+    #
+    # Count the nodes alive
+    #
+    def count_nodes(self):
+        return self.connection().execute("SELECT COUNT(*) AS count FROM nodes WHERE heartbeat > ?", (self.heartbeat_limit(),)).fetchone()["count"]
+
+    #
+    # Take or renew a lease for duration seconds
+    # Return False if it is held by another holder and not expired
+    #
+    def acquire_lease(self, name, holder, duration):
+        now = time.time()
+        connection = self.connection()
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute("SELECT holder, expires FROM leases WHERE name = ?", (name,)).fetchone()
+            if row and row["holder"] != holder and row["expires"] > now:
+                return False
+            connection.execute("INSERT OR REPLACE INTO leases (name, holder, expires) VALUES (?, ?, ?)", (name, holder, now + duration))
+        return True
+
+    #
+    # Record the content of a dataset held by this node
+    #
+    def add_replica(self, id, checksum):
+        with self.connection() as connection:
+            connection.execute("INSERT OR REPLACE INTO replicas (dataset_id, node, checksum) VALUES (?, ?, ?)", (id, self.node_id, checksum))
+
+    #
+    # Forget the replicas of a deleted dataset (on all nodes)
+    #
+    def remove_replicas(self, id):
+        with self.connection() as connection:
+            connection.execute("DELETE FROM replicas WHERE dataset_id = ?", (id,))
+
+    #
+    # Check if this node holds the given content of a dataset
+    #
+    def holds(self, id, checksum):
+        row = self.connection().execute("SELECT checksum FROM replicas WHERE dataset_id = ? AND node = ?", (id, self.node_id)).fetchone()
+        if not row or row["checksum"] != checksum:
+            return False
+        return apt_dataset.check_file_exist(apt_dataset.get_path(id))
+
+    #
+    # Alive peers holding the given content of a dataset: (node id, URL),
+    # latest heartbeat first
+    #
+    def find_peers(self, id, checksum):
+        rows = self.connection().execute("SELECT n.id, n.url FROM replicas r JOIN nodes n ON n.id = r.node "
+            "WHERE r.dataset_id = ? AND r.checksum = ? AND r.node != ? AND n.heartbeat > ? ORDER BY n.heartbeat DESC",
+            (id, checksum, self.node_id, self.heartbeat_limit()))
+        return [(row["id"], row["url"]) for row in rows]
+
+    #
+    # Pull the current content of a dataset (catalog entry) from a peer
+    # Return True if this node holds it
+    #
+    def pull(self, id, entry):
+        with self.pull_locks[zlib.crc32(id.encode()) % PULL_LOCK_STRIPES]:
+            if self.holds(id, entry["checksum"]):
+                return True
+            for peer_id, peer_url in self.find_peers(id, entry["checksum"]):
+                try:
+                    with apt_metrics.timed("apt_cluster_pull_duration_seconds"):
+                        self.pull_from(peer_url, id, entry)
+                except Exception as e:
+                    apt_metrics.inc("apt_cluster_pull_errors_total")
+                    log.warning(f"Pull of dataset {id} from node {peer_id} failed: {e}")
+                    continue
+                log.info(f"Dataset {id} pulled from node {peer_id}")
+                return True
+            log.error(f"Dataset {id} held by no alive node")
+            return False
+
+    def pull_from(self, peer_url, id, entry):
+        upload = apt_dataset.DatasetUpload(id)
+        try:
+            with self.session.get(peer_url + "/dataset/" + id, headers={REPLICA_HEADER: self.node_id}, stream=True,
+                    timeout=(CONFIG.REGISTRY_CONNECT_TIMEOUT, CONFIG.CLUSTER_PULL_TIMEOUT)) as response:
+                response.raise_for_status()
+                for chunk in response.iter_content(1024 * 1024):
+                    upload.write(chunk)
+            if upload.hexdigest() != entry["checksum"]:
+                raise Exception(f"checksum mismatch ({upload.size} bytes received)")
+            # Same modification date as on the other nodes, if the content is
+            # new on this node (a stored content shared with other datasets is
+            # kept as is: their catalog entries match its date)
+            upload.flush()
+            os.utime(upload.tmp_path, (entry["mtime"], entry["mtime"]))
+            upload.commit()
+        finally:
+            upload.discard()
+        self.add_replica(id, entry["checksum"])
+
+    def heartbeat_limit(self):
+        return time.time() - 3 * CONFIG.CLUSTER_HEARTBEAT_INTERVAL
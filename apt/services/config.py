@@ -1,7 +1,43 @@
 import os
+import socket
+
+#
+# Directory path ending with a separator (empty if not set): the paths of
+# the dataset files and of the stored contents are built by concatenation
+#
+def directory_path(path):
+    if path and not path.endswith(os.sep):
+        return path + os.sep
+    return path
 
 # Local path for datasets storage
-RESOURCES_PATH = "/usr/data/"
+RESOURCES_PATH = directory_path(os.environ.get("RESOURCES_PATH", "/usr/data/"))
+
+# Storage layout of the dataset files: directory levels (depth) and id characters
+# per level (width, the fan-out of a directory growing with it), e.g. depth 3 and
+# width 1: a/b/c/abcdef.zip. Ids shorter than the layout are padded with "_"
+DATASET_SHARD_DEPTH = int(os.environ.get("DATASET_SHARD_DEPTH", "3"))
+DATASET_SHARD_WIDTH = int(os.environ.get("DATASET_SHARD_WIDTH", "1"))
+
+# Previous storage layout ("<depth>x<width>", e.g. "3x1") while its files are moved
+# to the current one by the leader process (files not moved yet are still found),
+# and files moved per second
+DATASET_PREVIOUS_LAYOUT = os.environ.get("DATASET_PREVIOUS_LAYOUT", "")
+DATASET_MIGRATION_RATE = float(os.environ.get("DATASET_MIGRATION_RATE", "100"))
+
+# Local path for APT internal state (catalog index, ...)
+STATE_PATH = directory_path(os.environ.get("STATE_PATH", os.path.join(RESOURCES_PATH, ".apt", "")))
+
+# Cluster mode: directory shared by all the APT nodes (catalog, job queue, GBIF
+# registry state, nodes and leader lease), each node having its own datasets
+# storage. Empty for a single node
+CLUSTER_PATH = directory_path(os.environ.get("CLUSTER_PATH", ""))
+
+# Path of the state shared by the server processes (and by the nodes in cluster mode)
+SHARED_STATE_PATH = CLUSTER_PATH or STATE_PATH
+
+# Dataset catalog index (SQLite)
+CATALOG_PATH = os.environ.get("CATALOG_PATH", os.path.join(SHARED_STATE_PATH, "catalog.db"))
 
 # Public URL to access the APT server (required)
 APT_PUBLIC_URL = os.environ.get("APT_PUBLIC_URL", None)
@@ -9,6 +45,149 @@ APT_PUBLIC_URL = os.environ.get("APT_PUBLIC_URL", None)
 # GBIF Registry URL (production or UAT)
 GBIF_REGISTRY_URL = os.environ.get("GBIF_REGISTRY_URL", "https://api.gbif-uat.org")
 
+# Content-addressed store of the dataset files: one file per content (SHA-256),
+# the dataset paths being hard links to it
+BLOBS_PATH = directory_path(os.environ.get("BLOBS_PATH", os.path.join(STATE_PATH, "blobs", "")))
+
+# Versions kept per dataset (rollback), and delay (seconds) between two
+# garbage collections of the stored files no longer used
+VERSION_RETENTION = int(os.environ.get("VERSION_RETENTION", "5"))
+BLOB_GC_INTERVAL = float(os.environ.get("BLOB_GC_INTERVAL", "3600"))
+
+# Cold storage tier (cheaper mount, empty to disable): archives not downloaded
+# for TIERING_COLD_AFTER_DAYS days are moved there, with its own blob store
+COLD_STORAGE_PATH = directory_path(os.environ.get("COLD_STORAGE_PATH", ""))
+COLD_BLOBS_PATH = directory_path(os.environ.get("COLD_BLOBS_PATH", os.path.join(COLD_STORAGE_PATH, ".blobs", "")))
+TIERING_COLD_AFTER_DAYS = float(os.environ.get("TIERING_COLD_AFTER_DAYS", "90"))
+
+# Delay (seconds) between two runs of the storage tier mover, its I/O rate
+# (bytes per second, 0 for no limit), and promotion of a cold archive back to
+# the hot storage when downloaded (else served from the cold storage)
+TIERING_INTERVAL = float(os.environ.get("TIERING_INTERVAL", "3600"))
+TIERING_RATE = float(os.environ.get("TIERING_RATE", str(50 * 1024 * 1024)))
+TIERING_PROMOTE = os.environ.get("TIERING_PROMOTE", "true").lower() == "true"
+
+# Delay (seconds) before the cold copy of a promoted archive is removed: the
+# downloads started before, sent by the fronting server, may still open it
+TIERING_PROMOTE_GRACE = float(os.environ.get("TIERING_PROMOTE_GRACE", "300"))
+
+# Delay (seconds) between two saves of the dataset accesses in the catalog
+ACCESS_FLUSH_INTERVAL = float(os.environ.get("ACCESS_FLUSH_INTERVAL", "10"))
+
+# Staging area of the bulk uploads by manifest (files named <id>.zip)
+STAGING_PATH = directory_path(os.environ.get("STAGING_PATH", os.path.join(STATE_PATH, "staging", "")))
+
+# Datasets stored in parallel by a bulk upload
+BULK_WORKERS = int(os.environ.get("BULK_WORKERS", "4"))
+
+# Queue of GBIF registry jobs (SQLite)
+JOBS_PATH = os.environ.get("JOBS_PATH", os.path.join(SHARED_STATE_PATH, "jobs.db"))
+
+# Job workers, poll interval and retry delays (seconds), attempts before a job
+# is failed for good (0: retried until it succeeds), retention of finished jobs (days)
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "4"))
+JOB_POLL_INTERVAL = float(os.environ.get("JOB_POLL_INTERVAL", "5"))
+JOB_RETRY_DELAY = float(os.environ.get("JOB_RETRY_DELAY", "30"))
+JOB_RETRY_MAX_DELAY = float(os.environ.get("JOB_RETRY_MAX_DELAY", "3600"))
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", "50"))
+JOB_RETENTION_DAYS = float(os.environ.get("JOB_RETENTION_DAYS", "7"))
+
+# Crawl requests of an already registered dataset received within this window
+# (seconds) are coalesced into a single GBIF crawl, triggered after the last one
+CRAWL_COALESCE_WINDOW = float(os.environ.get("CRAWL_COALESCE_WINDOW", "120"))
+
+# Server mode: "production" (Gunicorn, multi-process) or "development" (Flask)
+SERVER_MODE = os.environ.get("SERVER_MODE", "production")
+
+# Production server: worker processes, threads per worker, timeouts (seconds)
+SERVER_WORKERS = int(os.environ.get("SERVER_WORKERS", "4"))
+SERVER_THREADS = int(os.environ.get("SERVER_THREADS", "8"))
+SERVER_TIMEOUT = int(os.environ.get("SERVER_TIMEOUT", "300"))
+SERVER_KEEPALIVE = int(os.environ.get("SERVER_KEEPALIVE", "5"))
+
+# Admission control by traffic class (download: dataset files, upload: dataset uploads,
+# admin: dataset lists, deletions, rollbacks, reports and jobs), in each server process:
+# - concurrent requests (0: unlimited), the next ones waiting for a free slot
+#   (ADMISSION_QUEUE_SIZE at most, for ADMISSION_QUEUE_TIMEOUT seconds) or rejected (503).
+#   By default the SERVER_THREADS threads are shared: half for the downloads, a quarter
+#   for the uploads, the rest for the admin requests but one thread, left for the other
+#   requests (home page, metrics). Limits adding up to more than SERVER_THREADS let a
+#   class take the threads of the others
+# - requests per second and burst of each client (API key or IP address, rate 0:
+#   unlimited), the next ones rejected (429)
+ADMISSION_DOWNLOAD_CONCURRENCY = int(os.environ.get("ADMISSION_DOWNLOAD_CONCURRENCY", str(max(1, SERVER_THREADS // 2))))
+ADMISSION_UPLOAD_CONCURRENCY = int(os.environ.get("ADMISSION_UPLOAD_CONCURRENCY", str(max(1, SERVER_THREADS // 4))))
+ADMISSION_ADMIN_CONCURRENCY = int(os.environ.get("ADMISSION_ADMIN_CONCURRENCY",
+    str(max(1, SERVER_THREADS - SERVER_THREADS // 2 - SERVER_THREADS // 4 - 1))))
+ADMISSION_QUEUE_SIZE = int(os.environ.get("ADMISSION_QUEUE_SIZE", "0"))
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get("ADMISSION_QUEUE_TIMEOUT", "1"))
+ADMISSION_DOWNLOAD_RATE = float(os.environ.get("ADMISSION_DOWNLOAD_RATE", "0"))
+ADMISSION_DOWNLOAD_BURST = int(os.environ.get("ADMISSION_DOWNLOAD_BURST", "20"))
+ADMISSION_UPLOAD_RATE = float(os.environ.get("ADMISSION_UPLOAD_RATE", "0"))
+ADMISSION_UPLOAD_BURST = int(os.environ.get("ADMISSION_UPLOAD_BURST", "10"))
+ADMISSION_ADMIN_RATE = float(os.environ.get("ADMISSION_ADMIN_RATE", "0"))
+ADMISSION_ADMIN_BURST = int(os.environ.get("ADMISSION_ADMIN_BURST", "10"))
+
+# Download mode: "sendfile" (sent by APT, with the kernel sendfile when possible),
+# "x-accel" (sent by a fronting nginx, X-Accel-Redirect header) or "x-sendfile"
+# (sent by a fronting server supporting the X-Sendfile header)
+DOWNLOAD_MODE = os.environ.get("DOWNLOAD_MODE", "sendfile")
+
+# Archives whose zip central directory is kept in memory (member listing and reading)
+ARCHIVE_INDEX_CACHE_SIZE = int(os.environ.get("ARCHIVE_INDEX_CACHE_SIZE", "1000"))
+
+# Internal nginx locations of the datasets storage, hot and cold (x-accel mode)
+DOWNLOAD_ACCEL_PREFIX = os.environ.get("DOWNLOAD_ACCEL_PREFIX", "/protected-datasets/")
+DOWNLOAD_ACCEL_COLD_PREFIX = os.environ.get("DOWNLOAD_ACCEL_COLD_PREFIX", "/protected-cold-datasets/")
+
+# Lock file electing the leader process (running background services),
+# and delay (seconds) between two election attempts of the other processes
+LEADER_LOCK_PATH = os.environ.get("LEADER_LOCK_PATH", os.path.join(STATE_PATH, "leader.lock"))
+LEADER_RETRY_INTERVAL = float(os.environ.get("LEADER_RETRY_INTERVAL", "10"))
+
+# Cluster mode: id of this node, URL of this node for the other nodes (required),
+# store of the nodes, replicas and leases (SQLite), delay (seconds) between two
+# heartbeats of a node (a node missing 3 is not used as peer anymore), duration
+# (seconds) of the cluster leader lease, and read timeout (seconds) of the pulls
+NODE_ID = os.environ.get("NODE_ID", socket.gethostname())
+NODE_URL = os.environ.get("NODE_URL", None)
+CLUSTER_DB_PATH = os.environ.get("CLUSTER_DB_PATH", os.path.join(SHARED_STATE_PATH, "cluster.db"))
+CLUSTER_HEARTBEAT_INTERVAL = float(os.environ.get("CLUSTER_HEARTBEAT_INTERVAL", "10"))
+LEADER_LEASE_DURATION = float(os.environ.get("LEADER_LEASE_DURATION", "30"))
+CLUSTER_PULL_TIMEOUT = float(os.environ.get("CLUSTER_PULL_TIMEOUT", "60"))
+
+# Snapshot of the GBIF registry state, to start without waiting for GBIF
+REGISTRY_SNAPSHOT_PATH = os.environ.get("REGISTRY_SNAPSHOT_PATH", os.path.join(SHARED_STATE_PATH, "registry.json"))
+
+# Delay (seconds) between two synchronizations of the GBIF registry state
+# with the datasets modified in GBIF (0 to disable)
+REGISTRY_SYNC_INTERVAL = float(os.environ.get("REGISTRY_SYNC_INTERVAL", "300"))
+
+# Number of GBIF registry pages fetched concurrently at startup
+REGISTRY_BOOTSTRAP_WORKERS = int(os.environ.get("REGISTRY_BOOTSTRAP_WORKERS", "8"))
+
+# GBIF registry HTTP client: connection pool size, timeouts (seconds) and retries
+REGISTRY_POOL_SIZE = int(os.environ.get("REGISTRY_POOL_SIZE", "10"))
+REGISTRY_CONNECT_TIMEOUT = float(os.environ.get("REGISTRY_CONNECT_TIMEOUT", "10"))
+REGISTRY_READ_TIMEOUT = float(os.environ.get("REGISTRY_READ_TIMEOUT", "60"))
+REGISTRY_RETRIES = int(os.environ.get("REGISTRY_RETRIES", "3"))
+REGISTRY_RETRY_BACKOFF = float(os.environ.get("REGISTRY_RETRY_BACKOFF", "0.5"))
+
+# Reconciliation report: GBIF keys per occurrence count call, concurrent
+# GBIF calls, and cache duration (seconds) of the GBIF information
+REPORT_GBIF_BATCH_SIZE = int(os.environ.get("REPORT_GBIF_BATCH_SIZE", "100"))
+REPORT_GBIF_WORKERS = int(os.environ.get("REPORT_GBIF_WORKERS", "8"))
+REPORT_GBIF_TTL = float(os.environ.get("REPORT_GBIF_TTL", "3600"))
+
+# Logs: level (DEBUG, INFO, WARNING, ERROR) and format ("text" or "json")
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text")
+
+# Local directory of the metrics saved by each server process, and delay
+# (seconds) between two saves (metrics of the other processes are that old)
+METRICS_PATH = os.environ.get("METRICS_PATH", "/tmp/apt-metrics/")
+METRICS_FLUSH_INTERVAL = float(os.environ.get("METRICS_FLUSH_INTERVAL", "10"))
+
 # GBIF Publisher Key for this APT (required)
 PUBLISHER_KEY = os.environ.get("PUBLISHER_KEY", None)
 
@@ -48,6 +227,9 @@ def has_required_parameters():
     if not SECURITY_APY_KEY:
         print("SECURITY_APY_KEY is required. APT is closing.")
         return False
+    if CLUSTER_PATH and not NODE_URL:
+        print("NODE_URL is required in cluster mode. APT is closing.")
+        return False
     return True
 
 def display_banner():
@@ -63,6 +245,17 @@ def display_banner():
     print(f"###   GBIF Registry: {GBIF_REGISTRY_URL}")
     print(f"###   GBIF Account: {GBIF_REGISTRY_LOGIN}")
     print("###")
+    if SERVER_MODE == "development":
+        print("###   Development server")
+    else:
+        print(f"###   Production server: {SERVER_WORKERS} workers x {SERVER_THREADS} threads")
+    if CLUSTER_PATH:
+        print(f"###   Cluster node {NODE_ID} ({NODE_URL}), shared state: {CLUSTER_PATH}")
+    print(f"###   Downloads: {DOWNLOAD_MODE}")
+    print(f"###   Storage layout: {DATASET_SHARD_DEPTH}x{DATASET_SHARD_WIDTH}" + (f" (migrating from {DATASET_PREVIOUS_LAYOUT})" if DATASET_PREVIOUS_LAYOUT else ""))
+    if COLD_STORAGE_PATH:
+        print(f"###   Cold storage: {COLD_STORAGE_PATH} (after {TIERING_COLD_AFTER_DAYS:g} days without download)")
+    print("###")
     if SECURITY_APY_KEY:
         print("###   Some APT endpoints are secured by API Key (header X-API-Key)")
     if SECURITY_AUTHORIZED_IP:
@@ -0,0 +1,56 @@
+import os
+import sqlite3
+import threading
+import apt.services.config as CONFIG
+
+#
+# Base class for the local SQLite stores (catalog, jobs, ...)
+#
+# The stores are in WAL mode, except the ones shared by the nodes of a
+# cluster (in CLUSTER_PATH): the WAL index is a shared memory, only seen by
+# the processes of a single host, so they use a rollback journal
+#
+class Database:
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.shared = is_shared_path(path)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+    #
+    # Get the SQLite connection of the current thread
+    # (connections can not be shared between threads or processes)
+    #
+    def connection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None or self.local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30)
+            if self.shared:
+                connection.execute("PRAGMA journal_mode=DELETE")
+                connection.execute("PRAGMA synchronous=FULL")
+            else:
+                connection.execute("PRAGMA journal_mode=WAL")
+                connection.execute("PRAGMA synchronous=NORMAL")
+            connection.row_factory = sqlite3.Row
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return connection
+
+    #
+    # Add a column to an existing table if missing (schema upgrade)
+    #
+    def ensure_column(self, table, column, definition):
+        connection = self.connection()
+        columns = [row["name"] for row in connection.execute(f"PRAGMA table_info({table})")]
+        if column not in columns:
+            with connection:
+                connection.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+#
+# Check if a store is shared by the nodes of a cluster
+#
+def is_shared_path(path):
+    if not CONFIG.CLUSTER_PATH:
+        return False
+    return os.path.abspath(path).startswith(os.path.abspath(CONFIG.CLUSTER_PATH) + os.sep)
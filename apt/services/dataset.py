@@ -1,46 +1,155 @@
 import re
 import os
+import time
+import uuid
+import errno
+import shutil
+import hashlib
+import tempfile
+import threading
+import logging
 import apt.services.config as CONFIG
 
+log = logging.getLogger(__name__)
+
+# Authorized characters of dataset ids and versions
+ID_PATTERN = re.compile(r"[A-Za-z0-9_.\-]*")
+
+# Dataset file name: <id>.zip
+DATASET_FILE_PATTERN = re.compile(r"([A-Za-z0-9_.\-]{3,})\.zip")
+
+# Padding of the ids shorter than the directories of the storage layout
+SHARD_PADDING = "_"
+
 #
-# List all datasets from file system
+# Storage layout of the dataset files: the first characters of the id give
+# the directories of the file (depth levels of width characters each),
+# e.g. depth 3 and width 1: a/b/c/abcdef.zip, depth 2 and width 2: ab/cd/abcdef.zip
+#
+class Layout:
+
+    def __init__(self, depth, width):
+        if depth < 0 or width < 1:
+            raise ValueError(f"Invalid dataset storage layout: depth {depth}, width {width}")
+        self.depth = depth
+        self.width = width
+
+    def __str__(self):
+        return f"{self.depth}x{self.width}"
+
+    def get_directory(self, id, root=None):
+        padded = id.ljust(self.depth * self.width, SHARD_PADDING)
+        directory = root or CONFIG.RESOURCES_PATH
+        for level in range(self.depth):
+            shard = padded[level * self.width:(level + 1) * self.width]
+            # A directory named ".." would be outside of the storage
+            if shard.strip(".") == "" and len(shard) > 1:
+                shard = SHARD_PADDING * len(shard)
+            directory += shard + "/"
+        return directory
+
+    def get_path(self, id, root=None):
+        return self.get_directory(id, root) + id + ".zip"
+
+#
+# Parse a storage layout: "<depth>x<width>" (None if empty)
+#
+def parse_layout(text):
+    if not text:
+        return None
+    depth, separator, width = text.partition("x")
+    return Layout(int(depth), int(width or "1"))
+
+# Current storage layout, and previous one while the files are migrated
+layout = Layout(CONFIG.DATASET_SHARD_DEPTH, CONFIG.DATASET_SHARD_WIDTH)
+previous_layout = parse_layout(CONFIG.DATASET_PREVIOUS_LAYOUT)
+
+#
+# Storage tiers of the dataset files: hot (RESOURCES_PATH) and cold
+# (COLD_STORAGE_PATH, if set), each one with its own blob store
+#
+def get_storage_roots():
+    if CONFIG.COLD_STORAGE_PATH:
+        return [CONFIG.RESOURCES_PATH, CONFIG.COLD_STORAGE_PATH]
+    return [CONFIG.RESOURCES_PATH]
+
+#
+# List all datasets from file system, in all storage tiers
+# (full scan, only used to rebuild the catalog index)
 #
 def list_all():
-    datasets = []
-    for root,d_names,f_names in os.walk(CONFIG.RESOURCES_PATH):
-        for f in f_names:
-            datasets.append(os.path.splitext(f)[0])
-    return datasets
+    datasets = {}
+    for storage_root in get_storage_roots():
+        for root,d_names,f_names in walk_storage(storage_root):
+            for f in f_names:
+                match = DATASET_FILE_PATTERN.fullmatch(f)
+                if match:
+                    # Only the files at the place of their id (current or previous layout)
+                    if is_dataset_location(match.group(1), os.path.join(root, f)):
+                        datasets[match.group(1)] = True
+                elif f.startswith(UPLOAD_PREFIX):
+                    remove_stale_upload(os.path.join(root, f))
+    return list(datasets)
+
+#
+# Check a dataset id (authorized characters, at least 3 characters)
+#
+def is_valid_id(id):
+    return len(id) >= 3 and checkAuthorizedChars(id)
 
 #
 # Compute dataset path from id
+# (path in the previous storage layout if the file is not migrated yet,
+# or in the cold storage if the file was moved there)
 #
 def get_path(id):
     # Check forbidden characters in ID
-    if not checkAuthorizedChars(id) or len(id) < 3:
+    if not is_valid_id(id):
+        return None
+
+    path = layout.get_path(id)
+    if (previous_layout or CONFIG.COLD_STORAGE_PATH) and not os.path.exists(path):
+        for other_path in get_other_paths(id):
+            if os.path.exists(other_path):
+                return other_path
+    return path
+
+#
+# Check if a dataset path is in the cold storage
+#
+def is_cold_path(path):
+    return bool(CONFIG.COLD_STORAGE_PATH) and path.startswith(CONFIG.COLD_STORAGE_PATH)
+
+#
+# Compute the path of a dataset file in the current storage layout
+# (where the dataset files are written)
+#
+def get_storage_path(id):
+    # Check forbidden characters in ID
+    if not is_valid_id(id):
         return None
 
-    return CONFIG.RESOURCES_PATH + id[0] + "/" + id[1] + "/" + id[2] + "/" + id + ".zip"
+    return layout.get_path(id)
 
 #
 # Compute dataset path from id and version
 #
 def get_path_with_version(id, version):
     # Check forbidden characters in ID
-    if not checkAuthorizedChars(id) or len(id) < 3:
+    if not is_valid_id(id):
         return None
 
     # Check forbidden characters in version
     if not checkAuthorizedChars(version) or len(version) < 1:
         return None
 
-    return CONFIG.RESOURCES_PATH + id[0] + "/" + id[1] + "/" + id[2] + "/" + id + ".zip." + version
+    return layout.get_path(id) + "." + version
 
 #
 # Create dataset path on file system
 #
 def init_path(id):
-    os.makedirs(CONFIG.RESOURCES_PATH + id[0] + "/" + id[1] + "/" + id[2], exist_ok=True)
+    os.makedirs(layout.get_directory(id), exist_ok=True)
 
 #
 # Check if path exists on file system
@@ -54,14 +163,350 @@ def check_file_exist(path):
 def delete_file(path):
     return os.remove(path)
 
+#
+# Delete the file of a dataset, in the previous storage layout and in the
+# cold storage first (a file being migrated or moved to another storage tier
+# is then deleted in both places)
+#
+def delete_dataset_file(id):
+    for path in get_other_paths(id) + [layout.get_path(id)]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
 #
 # Get the dataset modification date
 #
 def get_modification_date(path):
     return os.path.getmtime(path)
 
+#
+# Compute the dataset SHA-256 checksum
+#
+def compute_checksum(path):
+    checksum = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+#
+# Upload of a dataset file, written in a temporary file next to the
+# dataset path while its SHA-256 checksum is computed on the fly
+#
+# On commit, the file is added to the blob store (unless the same content
+# is already stored) and the dataset path is replaced (atomically) by a link
+# to it, so downloads never see a half written file
+#
+UPLOAD_PREFIX = ".upload-"
+
+class DatasetUpload:
+
+    def __init__(self, id):
+        init_path(id)
+        self.id = id
+        self.path = get_storage_path(id)
+        fd, self.tmp_path = tempfile.mkstemp(prefix=UPLOAD_PREFIX, suffix=".tmp", dir=os.path.dirname(self.path))
+        self.file = os.fdopen(fd, "w+b")
+        self.checksum = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.checksum.update(data)
+        self.size += len(data)
+        return self.file.write(data)
+
+    def read(self, size=-1):
+        return self.file.read(size)
+
+    def readline(self, size=-1):
+        return self.file.readline(size)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        return self.file.seek(offset, whence)
+
+    def tell(self):
+        return self.file.tell()
+
+    def flush(self):
+        return self.file.flush()
+
+    def hexdigest(self):
+        return self.checksum.hexdigest()
+
+    #
+    # Replace the dataset file by the uploaded file
+    #
+    def commit(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        os.chmod(self.tmp_path, 0o644)
+        blob_path = add_blob(self.tmp_path, self.hexdigest())
+        try:
+            install_dataset(self.id, blob_path)
+        except FileNotFoundError:
+            # Blob moved to the cold storage meanwhile: stored again
+            install_dataset(self.id, add_blob(self.tmp_path, self.hexdigest()))
+
+    #
+    # Remove the uploaded file if not committed
+    #
+    def discard(self):
+        self.file.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+#
+# Compute the blob store path of a dataset content from its checksum
+# (in the blob store of the cold storage if cold)
+#
+def get_blob_path(checksum, cold=False):
+    blobs_path = CONFIG.COLD_BLOBS_PATH if cold else CONFIG.BLOBS_PATH
+    return blobs_path + checksum[0:2] + "/" + checksum[2:4] + "/" + checksum
+
+#
+# Find a stored content, in the hot then in the cold blob store
+# (None if not found)
+#
+def find_blob(checksum):
+    for cold in ([False, True] if CONFIG.COLD_STORAGE_PATH else [False]):
+        blob_path = get_blob_path(checksum, cold)
+        if os.path.exists(blob_path):
+            return blob_path
+    return None
+
+#
+# Add a file to the blob store (of the cold storage if cold), if its content
+# is not already stored
+# (hard link to the file, or copy if the blob store is on another file system)
+#
+def add_blob(path, checksum, cold=False):
+    blob_path = get_blob_path(checksum, cold)
+    if os.path.exists(blob_path):
+        return blob_path
+    os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+    try:
+        os.link(path, blob_path)
+    except FileExistsError:
+        pass
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        copy_file(path, blob_path)
+    return blob_path
+
+#
+# Replace (atomically) a dataset path by a link to a blob
+# (copy if the blob store is on another file system)
+#
+def link_dataset(blob_path, dataset_path):
+    tmp_path = os.path.join(os.path.dirname(dataset_path), UPLOAD_PREFIX + uuid.uuid4().hex + ".tmp")
+    try:
+        os.link(blob_path, tmp_path)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        copy_file(blob_path, dataset_path)
+        return
+    os.replace(tmp_path, dataset_path)
+
+#
+# Create a dataset path as a link to a blob (or a copy of another file),
+# unless it exists. Return False if it exists
+#
+def link_new_dataset(blob_path, dataset_path):
+    tmp_path = os.path.join(os.path.dirname(dataset_path), UPLOAD_PREFIX + uuid.uuid4().hex + ".tmp")
+    try:
+        os.link(blob_path, tmp_path)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        copy_file(blob_path, tmp_path)
+    try:
+        os.link(tmp_path, dataset_path)
+        return True
+    except FileExistsError:
+        return False
+    finally:
+        os.remove(tmp_path)
+
+#
+# Replace the file of a dataset by a link to a blob, in the current storage
+# layout of the hot storage (the file left in the previous layout or in the
+# cold storage, if any, is removed)
+#
+def install_dataset(id, blob_path):
+    init_path(id)
+    link_dataset(blob_path, layout.get_path(id))
+    for path in get_other_paths(id):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+#
+# Copy a file (with its modification date), the target path being replaced
+# atomically. The copy is throttled to rate bytes per second, if given
+#
+def copy_file(path, target_path, rate=0):
+    fd, tmp_path = tempfile.mkstemp(prefix=UPLOAD_PREFIX, suffix=".tmp", dir=os.path.dirname(target_path))
+    try:
+        with os.fdopen(fd, "wb") as f, open(path, "rb") as source:
+            if rate > 0:
+                copy_throttled(source, f, rate)
+            else:
+                shutil.copyfileobj(source, f, 1024 * 1024)
+            f.flush()
+            os.fsync(f.fileno())
+            stat = os.fstat(source.fileno())
+        os.chmod(tmp_path, 0o644)
+        os.utime(tmp_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        os.replace(tmp_path, target_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+def copy_throttled(source, target, rate):
+    start = time.monotonic()
+    copied = 0
+    for chunk in iter(lambda: source.read(1024 * 1024), b""):
+        target.write(chunk)
+        copied += len(chunk)
+        delay = start + copied / rate - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+#
+# Remove a file, unless it was replaced since its stat was taken
+# (by an upload). Return True if removed
+#
+# The file is renamed first: a file replacing it afterwards is kept,
+# and a replaced file taken by mistake is put back
+#
+def remove_if_unchanged(path, stat):
+    tmp_path = os.path.join(os.path.dirname(path), UPLOAD_PREFIX + uuid.uuid4().hex + ".tmp")
+    try:
+        os.rename(path, tmp_path)
+    except FileNotFoundError:
+        return False
+    if os.stat(tmp_path).st_ino == stat.st_ino:
+        os.remove(tmp_path)
+        return True
+    try:
+        os.link(tmp_path, path)
+    except FileExistsError:
+        pass
+    os.remove(tmp_path)
+    return False
+
+#
+# List the blob stores (hot and cold): (checksum, path) of each stored content
+#
+def list_blobs():
+    for blobs_path in ([CONFIG.BLOBS_PATH, CONFIG.COLD_BLOBS_PATH] if CONFIG.COLD_STORAGE_PATH else [CONFIG.BLOBS_PATH]):
+        for root,d_names,f_names in os.walk(blobs_path):
+            for f in f_names:
+                if not f.startswith(UPLOAD_PREFIX):
+                    yield f, os.path.join(root, f)
+
+#
+# Remove a temporary upload file left by an interrupted upload
+#
+def remove_stale_upload(path):
+    if os.path.getmtime(path) < time.time() - 86400:
+        os.remove(path)
+
+#
+# Move the dataset files of the previous storage layout to the current one,
+# while the server runs (at most DATASET_MIGRATION_RATE files per second)
+#
+# A file is linked at its new path then removed from the previous one, so it
+# is always found by get_path. A file uploaded or deleted meanwhile wins:
+# the new path is never overwritten, and a deleted file is not linked again
+#
+def migrate_layout():
+    if not previous_layout:
+        return
+    log.info(f"Migrating dataset files from storage layout {previous_layout} to {layout}...")
+    moved = 0
+    for storage_root in get_storage_roots():
+        for root,d_names,f_names in walk_storage(storage_root):
+            for f in f_names:
+                match = DATASET_FILE_PATTERN.fullmatch(f)
+                if not match:
+                    continue
+                id = match.group(1)
+                path = os.path.join(root, f)
+                new_path = layout.get_path(id, storage_root)
+                if not is_dataset_location(id, path, previous_layout, storage_root) or is_dataset_location(id, path, layout, storage_root):
+                    continue
+                try:
+                    os.makedirs(os.path.dirname(new_path), exist_ok=True)
+                    os.link(path, new_path)
+                except FileExistsError:
+                    pass
+                except FileNotFoundError:
+                    continue
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                moved += 1
+                if moved % 1000 == 0:
+                    log.info(f"Dataset storage layout migration: {moved} files moved")
+                if CONFIG.DATASET_MIGRATION_RATE > 0:
+                    time.sleep(1 / CONFIG.DATASET_MIGRATION_RATE)
+    log.info(f"Dataset storage layout migration done: {moved} files moved")
+
+#
+# Migrate the dataset files in background (leader process)
+#
+def start_layout_migration():
+    if not previous_layout:
+        return
+    def run():
+        try:
+            migrate_layout()
+        except Exception as e:
+            log.error(f"Dataset storage layout migration failed: {e}")
+    threading.Thread(target=run, name="layout-migration", daemon=True).start()
+
+#
+# Other places of a dataset file than the current layout of the hot storage:
+# previous layout (while migrated), cold storage (current and previous layout)
+#
+def get_other_paths(id):
+    paths = []
+    for storage_root in get_storage_roots():
+        for dataset_layout in (layout, previous_layout):
+            if dataset_layout and (storage_root, dataset_layout) != (CONFIG.RESOURCES_PATH, layout):
+                paths.append(dataset_layout.get_path(id, storage_root))
+    return paths
+
+#
+# Check if a path is the place of a dataset file (current or previous layout,
+# in any storage tier, or in the given layout and storage tier)
+#
+def is_dataset_location(id, path, dataset_layout=None, storage_root=None):
+    path = os.path.normpath(path)
+    if dataset_layout:
+        return path == os.path.normpath(dataset_layout.get_path(id, storage_root))
+    candidates = [layout.get_path(id)] + get_other_paths(id)
+    return path in [os.path.normpath(candidate) for candidate in candidates]
+
+#
+# Walk a storage tier, without the APT internal directories (state, blobs)
+#
+def walk_storage(storage_root):
+    skipped = (CONFIG.STATE_PATH, CONFIG.COLD_BLOBS_PATH)
+    for root,d_names,f_names in os.walk(storage_root):
+        d_names[:] = [d for d in d_names if os.path.join(root, d, "") not in skipped]
+        yield root, d_names, f_names
+
 #
 # Check if text contains only authorized characters
 #
 def checkAuthorizedChars(text):
-    return re.match("^[A-Za-z0-9-_.]*$", text)
\ No newline at end of file
+    return ID_PATTERN.fullmatch(text)
\ No newline at end of file
@@ -0,0 +1,263 @@
+import os
+import json
+import time
+import uuid
+import threading
+import logging
+import apt.services.database as apt_database
+import apt.services.metrics as apt_metrics
+import apt.services.config as CONFIG
+
+log = logging.getLogger(__name__)
+
+# Delay (seconds) between two checks of the jobs of stopped processes
+REQUEUE_INTERVAL = 30
+
+#
+# Durable queue of GBIF registry jobs (SQLite)
+#
+# Jobs of a dataset are executed in order, one at a time. Failed jobs are
+# retried with an exponential backoff until they succeed, including after
+# a restart of APT (running jobs are then executed again)
+#
+# A job is failed for good (status failed, no longer blocking the next jobs
+# of its dataset) when the GBIF registry rejects its request (client error)
+# or after JOB_MAX_ATTEMPTS attempts
+#
+# A running job is executed again only if its holder (process running it)
+# is dead: is_alive(holder) tells if a process of another node still runs
+# (in cluster mode, a leader that lost its lease may finish its jobs)
+#
+# A job can be delayed: the same job added again for the dataset before
+# it starts is coalesced with it and postponed, so a burst of uploads
+# results in a single execution after the last one
+#
+class JobQueue(apt_database.Database):
+
+    def __init__(self, handlers, path=None, is_alive=None):
+        super().__init__(path or CONFIG.JOBS_PATH)
+        # Job action -> function(dataset_id) returning the job result
+        self.handlers = handlers
+        self.is_alive = is_alive
+        self.wakeup = threading.Event()
+        self.last_purge = 0
+        self.last_requeue = 0
+        self.active = None
+        with self.connection() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS jobs ("
+                "seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "id TEXT NOT NULL UNIQUE, "
+                "action TEXT NOT NULL, "
+                "dataset_id TEXT NOT NULL, "
+                "status TEXT NOT NULL, "
+                "attempts INTEGER NOT NULL DEFAULT 0, "
+                "result TEXT, "
+                "error TEXT, "
+                "created REAL NOT NULL, "
+                "updated REAL NOT NULL, "
+                "next_attempt REAL NOT NULL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, next_attempt)")
+            connection.execute("CREATE INDEX IF NOT EXISTS jobs_dataset ON jobs (dataset_id, status)")
+        self.ensure_column("jobs", "coalesced", "INTEGER NOT NULL DEFAULT 0")
+        # Process running the job: "<node id>/<pid>"
+        self.ensure_column("jobs", "holder", "TEXT")
+
+    #
+    # Add a job for a dataset, executed after delay seconds
+    #
+    # If the same job is already waiting for this dataset (not yet started),
+    # it is postponed and returned instead of adding a new one
+    #
+    def enqueue(self, action, dataset_id, delay=0):
+        return self.enqueue_many([(action, dataset_id, delay)])[0]
+
+    #
+    # Add several jobs (action, dataset_id, delay) in a single transaction
+    #
+    def enqueue_many(self, job_requests):
+        now = time.time()
+        job_ids = []
+        connection = self.connection()
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            for action, dataset_id, delay in job_requests:
+                row = connection.execute("SELECT * FROM jobs WHERE dataset_id = ? AND status = 'pending' ORDER BY seq DESC LIMIT 1",
+                    (dataset_id,)).fetchone()
+                if row and row["action"] == action:
+                    job_id = row["id"]
+                    connection.execute("UPDATE jobs SET coalesced = coalesced + 1, updated = ?, next_attempt = ? WHERE id = ?",
+                        (now, now + delay, job_id))
+                else:
+                    job_id = str(uuid.uuid4())
+                    connection.execute("INSERT INTO jobs (id, action, dataset_id, status, created, updated, next_attempt) VALUES (?, ?, ?, 'pending', ?, ?, ?)",
+                        (job_id, action, dataset_id, now, now, now + delay))
+                job_ids.append(job_id)
+        self.wakeup.set()
+        return [self.get(job_id) for job_id in job_ids]
+
+    #
+    # Get a job by id
+    #
+    def get(self, job_id):
+        row = self.connection().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row:
+            return to_job(row)
+        return None
+
+    #
+    # Count jobs by status
+    #
+    def count_by_status(self):
+        counts = {}
+        for row in self.connection().execute("SELECT status, COUNT(*) AS count FROM jobs GROUP BY status"):
+            counts[row["status"]] = row["count"]
+        return counts
+
+    #
+    # List the failed jobs, latest first
+    #
+    def list_failed(self):
+        rows = self.connection().execute("SELECT * FROM jobs WHERE status = 'failed' ORDER BY seq DESC")
+        return [to_job(row) for row in rows]
+
+    #
+    # Count delayed jobs of an action (waiting for their execution time)
+    # and jobs coalesced with them, as number of executions saved
+    #
+    def coalescing_stats(self, action):
+        row = self.connection().execute("SELECT "
+            "COALESCE(SUM(status = 'pending' AND next_attempt > ?), 0) AS pending, "
+            "COALESCE(SUM(coalesced), 0) AS coalesced "
+            "FROM jobs WHERE action = ?", (time.time(), action)).fetchone()
+        return dict(row)
+
+    #
+    # Start the worker threads
+    # (jobs are only taken while active() returns True, if given)
+    #
+    def start(self, workers=None, active=None):
+        self.active = active
+        # Jobs left running by a stopped process are executed again
+        self.requeue_abandoned()
+        for i in range(workers or CONFIG.JOB_WORKERS):
+            threading.Thread(target=self.work, name=f"job-worker-{i}", daemon=True).start()
+
+    def work(self):
+        while True:
+            active = not self.active or self.active()
+            job = self.claim() if active else None
+            if not job:
+                if active:
+                    self.requeue_abandoned(REQUEUE_INTERVAL)
+                self.purge()
+                self.wakeup.wait(CONFIG.JOB_POLL_INTERVAL)
+                self.wakeup.clear()
+                continue
+            self.execute(job)
+
+    #
+    # Take the next job to execute: the oldest due pending job
+    # whose dataset has no older unfinished job
+    #
+    def claim(self):
+        now = time.time()
+        connection = self.connection()
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute("SELECT * FROM jobs j WHERE j.status = 'pending' AND j.next_attempt <= ? "
+                "AND NOT EXISTS (SELECT 1 FROM jobs o WHERE o.dataset_id = j.dataset_id AND o.seq < j.seq AND o.status IN ('pending', 'running')) "
+                "ORDER BY j.seq LIMIT 1", (now,)).fetchone()
+            if not row:
+                return None
+            connection.execute("UPDATE jobs SET status = 'running', attempts = attempts + 1, updated = ?, holder = ? WHERE seq = ?",
+                (now, job_holder(), row["seq"]))
+        return self.get(row["id"])
+
+    #
+    # Set back to pending the running jobs whose holder is dead
+    # (at most once per interval seconds)
+    #
+    def requeue_abandoned(self, interval=0):
+        now = time.time()
+        if now - self.last_requeue < interval:
+            return
+        self.last_requeue = now
+        connection = self.connection()
+        for row in connection.execute("SELECT DISTINCT holder FROM jobs WHERE status = 'running'").fetchall():
+            if self.is_holder_alive(row["holder"]):
+                continue
+            with connection:
+                count = connection.execute("UPDATE jobs SET status = 'pending', holder = NULL WHERE status = 'running' AND holder IS ?",
+                    (row["holder"],)).rowcount
+            if count:
+                log.warning(f"{count} running jobs of stopped process {row['holder']} executed again")
+
+    #
+    # Check if the holder of running jobs still runs
+    #
+    # The process holding the node leader lock is the only one running jobs
+    # on its node: the other processes of this node are dead
+    #
+    def is_holder_alive(self, holder):
+        if holder == job_holder():
+            return True
+        if not holder or holder.startswith(CONFIG.NODE_ID + "/") or not self.is_alive:
+            return False
+        return self.is_alive(holder)
+
+    def execute(self, job):
+        log.info(f"Job {job['id']}: {job['action']} dataset {job['dataset_id']} (attempt {job['attempts']})")
+        start = time.perf_counter()
+        try:
+            result = self.handlers[job["action"]](job["dataset_id"])
+        except Exception as e:
+            apt_metrics.inc("apt_job_failures_total", action=job["action"])
+            now = time.time()
+            if is_rejected(e) or (CONFIG.JOB_MAX_ATTEMPTS and job["attempts"] >= CONFIG.JOB_MAX_ATTEMPTS):
+                log.error(f"Job {job['id']} failed after {job['attempts']} attempts, not retried: {e}")
+                with self.connection() as connection:
+                    connection.execute("UPDATE jobs SET status = 'failed', error = ?, updated = ? WHERE id = ?",
+                        (str(e), now, job["id"]))
+                return
+            delay = min(CONFIG.JOB_RETRY_MAX_DELAY, CONFIG.JOB_RETRY_DELAY * 2 ** (job["attempts"] - 1))
+            log.error(f"Job {job['id']} failed, retry in {delay}s: {e}")
+            with self.connection() as connection:
+                connection.execute("UPDATE jobs SET status = 'pending', error = ?, updated = ?, next_attempt = ? WHERE id = ?",
+                    (str(e), now, now + delay, job["id"]))
+            return
+        apt_metrics.observe("apt_job_duration_seconds", time.perf_counter() - start, action=job["action"])
+        with self.connection() as connection:
+            connection.execute("UPDATE jobs SET status = 'done', result = ?, error = NULL, updated = ? WHERE id = ?",
+                (json.dumps(result), time.time(), job["id"]))
+
+    #
+    # Remove old finished jobs (at most once per hour)
+    #
+    def purge(self):
+        now = time.time()
+        if now - self.last_purge < 3600:
+            return
+        self.last_purge = now
+        with self.connection() as connection:
+            connection.execute("DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated < ?", (now - CONFIG.JOB_RETENTION_DAYS * 86400,))
+
+#
+# Holder of the jobs run by this process
+#
+def job_holder():
+    return f"{CONFIG.NODE_ID}/{os.getpid()}"
+
+#
+# Check if a job error is a request rejected by the GBIF registry: client
+# error, except a timeout or rate limiting (never successful if retried)
+#
+def is_rejected(error):
+    status = getattr(getattr(error, "response", None), "status_code", None)
+    return status is not None and 400 <= status < 500 and status not in (408, 429)
+
+def to_job(row):
+    job = dict(row)
+    del job["seq"]
+    if job["result"] is not None:
+        job["result"] = json.loads(job["result"])
+    return job
@@ -0,0 +1,102 @@
+import os
+import time
+import fcntl
+import threading
+import logging
+import apt.services.config as CONFIG
+
+log = logging.getLogger(__name__)
+
+#
+# Election of the leader process among the APT server workers
+#
+# The leader is the process holding an exclusive lock on a local file.
+# It runs the background services (GBIF registry jobs, refresh, ...) while
+# the other workers only serve requests. If the leader dies, its lock is
+# released by the system and another worker takes over
+#
+# In cluster mode, the process holding the lock is the leader of its node
+# (running the services of the node), and the leaders of the nodes compete
+# for a lease in the cluster store: its holder is the cluster leader. A lease
+# not renewed in time (stopped or stalled node) is taken by another node
+#
+class Leadership:
+
+    def __init__(self, on_elected, on_node_elected=None, cluster=None, path=None):
+        self.path = path or CONFIG.LEADER_LOCK_PATH
+        self.on_elected = on_elected
+        self.on_node_elected = on_node_elected
+        self.cluster = cluster
+        self.lock_file = None
+        self.elected = threading.Event()
+        self.started = False
+        # End of the cluster leader lease (renewed before)
+        self.lease_expires = 0
+
+    #
+    # Check if this process is the leader (of the cluster in cluster mode)
+    #
+    def is_leader(self):
+        if self.cluster and time.time() >= self.lease_expires:
+            return False
+        return self.elected.is_set()
+
+    #
+    # Try to become leader now, then periodically in background
+    #
+    def start(self):
+        if not self.try_acquire():
+            threading.Thread(target=self.campaign, name="leader-election", daemon=True).start()
+
+    def campaign(self):
+        while not self.try_acquire():
+            time.sleep(CONFIG.LEADER_RETRY_INTERVAL)
+
+    def try_acquire(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        lock_file = open(self.path, "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        # Keep the file open (and locked) as long as the process lives
+        self.lock_file = lock_file
+        if self.on_node_elected:
+            self.on_node_elected()
+        if self.cluster:
+            log.info(f"Process {os.getpid()} elected as leader of node {CONFIG.NODE_ID}")
+            threading.Thread(target=self.hold_lease, name="leader-lease", daemon=True).start()
+        else:
+            self.elect()
+        return True
+
+    def elect(self):
+        self.elected.set()
+        log.info(f"Process {os.getpid()} elected as leader" + (" of the cluster" if self.cluster else ""))
+        # Background services are started once, and paused while not leader
+        if not self.started:
+            self.started = True
+            self.on_elected()
+
+    #
+    # Take the cluster leader lease when free, then renew it
+    # (every third of its duration)
+    #
+    def hold_lease(self):
+        holder = f"{CONFIG.NODE_ID}/{os.getpid()}"
+        while True:
+            now = time.time()
+            try:
+                acquired = self.cluster.acquire_lease("leader", holder, CONFIG.LEADER_LEASE_DURATION)
+            except Exception as e:
+                log.error(f"Cluster leader lease renewal failed: {e}")
+                acquired = False
+            if acquired:
+                self.lease_expires = now + CONFIG.LEADER_LEASE_DURATION
+                if not self.elected.is_set():
+                    self.elect()
+            elif self.elected.is_set() and not self.is_leader():
+                self.elected.clear()
+                log.error(f"Process {os.getpid()} lost the cluster leadership")
+            time.sleep(CONFIG.LEADER_LEASE_DURATION / 3)
@@ -0,0 +1,42 @@
+import sys
+import json
+import time
+import logging
+import apt.services.config as CONFIG
+
+# Attributes of every log record (the other ones are extra fields)
+RECORD_ATTRIBUTES = set(logging.makeLogRecord({}).__dict__) | {"message", "asctime"}
+
+#
+# Log records as JSON lines: time, level, logger, process, thread,
+# message and the extra fields given to the log call
+#
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        entry = {}
+        entry["time"] = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z"
+        entry["level"] = record.levelname
+        entry["logger"] = record.name
+        entry["process"] = record.process
+        entry["thread"] = record.threadName
+        entry["message"] = record.getMessage()
+        for key, value in record.__dict__.items():
+            if key not in RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+#
+# Configure the APT logs (standard output, LOG_LEVEL and LOG_FORMAT)
+#
+def setup():
+    handler = logging.StreamHandler(sys.stdout)
+    if CONFIG.LOG_FORMAT == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [%(process)d] %(name)s: %(message)s"))
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(CONFIG.LOG_LEVEL)
@@ -0,0 +1,249 @@
+import os
+import re
+import json
+import math
+import time
+import tempfile
+import threading
+import logging
+from contextlib import contextmanager
+import apt.services.config as CONFIG
+
+log = logging.getLogger(__name__)
+
+#
+# Metrics of the APT server, exposed in the Prometheus text format
+#
+# Recording is a dictionary update under a lock, in the memory of the
+# process. Each server process saves its metrics in METRICS_PATH every
+# METRICS_FLUSH_INTERVAL seconds, so the metrics returned by any worker
+# include the ones of all the workers (counters and histograms are summed,
+# the highest value of a gauge is kept, the gauges of the stopped workers
+# are ignored)
+#
+
+# Files of the metrics saved by the server processes (<pid>.json), and
+# prefix of their temporary files
+METRICS_FILE_PATTERN = re.compile(r"([0-9]+)\.json")
+METRICS_TMP_PREFIX = ".metrics-"
+
+# Histogram buckets (seconds)
+DURATION_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, math.inf]
+
+lock = threading.Lock()
+# Metric name -> type, help
+descriptions = {}
+# (name, labels) -> value (counters and gauges), or [bucket counts, sum, count] (histograms)
+values = {}
+
+#
+# Declare a metric (type: counter, gauge or histogram)
+#
+def describe(name, type, help):
+    descriptions[name] = (type, help)
+
+def inc(name, value=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with lock:
+        values[key] = values.get(key, 0) + value
+
+def set_gauge(name, value, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with lock:
+        values[key] = value
+
+def observe(name, value, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with lock:
+        histogram = values.get(key)
+        if histogram is None:
+            histogram = values[key] = [[0] * len(DURATION_BUCKETS), 0.0, 0]
+        for i, bound in enumerate(DURATION_BUCKETS):
+            if value <= bound:
+                histogram[0][i] += 1
+                break
+        histogram[1] += value
+        histogram[2] += 1
+
+#
+# Observe the duration of a block (with statement)
+#
+@contextmanager
+def timed(name, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+#
+# Remove the metrics saved by a previous server (called before the
+# workers are started), and forget the metrics of the parent process
+# in the forked workers
+#
+# Only the files of the metrics are removed, the other files of the
+# directory are kept
+#
+def reset():
+    os.makedirs(CONFIG.METRICS_PATH, exist_ok=True)
+    for f in os.listdir(CONFIG.METRICS_PATH):
+        if METRICS_FILE_PATTERN.fullmatch(f) or f.startswith(METRICS_TMP_PREFIX):
+            try:
+                os.remove(os.path.join(CONFIG.METRICS_PATH, f))
+            except FileNotFoundError:
+                pass
+
+def clear():
+    global lock
+    lock = threading.Lock()
+    values.clear()
+
+os.register_at_fork(after_in_child=clear)
+
+#
+# Save the metrics of this process (written in a temporary file then renamed)
+#
+def save():
+    with lock:
+        entries = [[name, list(labels), value] for (name, labels), value in values.items()]
+    os.makedirs(CONFIG.METRICS_PATH, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix=METRICS_TMP_PREFIX, dir=CONFIG.METRICS_PATH)
+    with os.fdopen(fd, "w") as f:
+        json.dump(entries, f)
+    os.replace(tmp_path, os.path.join(CONFIG.METRICS_PATH, f"{os.getpid()}.json"))
+
+#
+# Save the metrics of this process every METRICS_FLUSH_INTERVAL seconds
+#
+def start():
+    def run():
+        while True:
+            try:
+                save()
+            except Exception as e:
+                log.error(f"Metrics saving failed: {e}")
+            time.sleep(CONFIG.METRICS_FLUSH_INTERVAL)
+    threading.Thread(target=run, name="metrics", daemon=True).start()
+
+#
+# Render the metrics of all processes, with the given gauges
+# ((name, labels, value) computed at scrape time), in the Prometheus format
+#
+def render(gauges=()):
+    merged = {}
+    for entries, alive in load_processes():
+        for name, labels, value in entries:
+            # Gauges of a stopped process are obsolete (its counts are kept)
+            if not alive and descriptions.get(name, ("untyped",))[0] == "gauge":
+                continue
+            merge(merged, (name, tuple(tuple(label) for label in labels)), value)
+    with lock:
+        for key, value in values.items():
+            merge(merged, key, value)
+    for name, labels, value in gauges:
+        merged[(name, tuple(sorted(labels.items())))] = value
+
+    lines = []
+    for name in sorted(set(name for name, labels in merged)):
+        type, help = descriptions.get(name, ("untyped", name))
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {type}")
+        for (metric_name, labels), value in sorted(merged.items(), key=lambda item: item[0]):
+            if metric_name != name:
+                continue
+            if type == "histogram":
+                cumulated = 0
+                for bound, count in zip(DURATION_BUCKETS, value[0]):
+                    cumulated += count
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', format_bound(bound)),))} {cumulated}")
+                lines.append(f"{name}_sum{format_labels(labels)} {value[1]}")
+                lines.append(f"{name}_count{format_labels(labels)} {value[2]}")
+            else:
+                lines.append(f"{name}{format_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+#
+# APT metrics
+#
+describe("apt_http_request_duration_seconds", "histogram", "HTTP request duration, until the response is ready to be sent")
+describe("apt_http_received_bytes_total", "counter", "HTTP request body bytes received")
+describe("apt_http_sent_bytes_total", "counter", "HTTP response body bytes sent (when the length is known)")
+describe("apt_admission_rejected_total", "counter", "Requests rejected by the admission control by traffic class and reason (rate, saturated)")
+describe("apt_admission_wait_seconds", "histogram", "Wait for a free slot of a traffic class (requests queued)")
+describe("apt_upload_phase_duration_seconds", "histogram", "Dataset upload duration by phase (receive, validate, commit, catalog)")
+describe("apt_archive_index_cache_total", "counter", "Archive central directory lookups by result (hit, miss)")
+describe("apt_tiering_moves_total", "counter", "Dataset files moved between the storage tiers by direction (demote, promote)")
+describe("apt_tiering_bytes_total", "counter", "Bytes moved between the storage tiers by direction (demote, promote)")
+describe("apt_gbif_request_duration_seconds", "histogram", "GBIF registry call duration (with retries) by operation")
+describe("apt_gbif_request_errors_total", "counter", "GBIF registry calls failed (after retries) by operation")
+describe("apt_gbif_pages_total", "counter", "GBIF registry pages fetched by operation")
+describe("apt_registry_refresh_duration_seconds", "gauge", "Duration of the last full refresh of the GBIF registry state")
+describe("apt_registry_refresh_timestamp_seconds", "gauge", "Time of the last full refresh of the GBIF registry state")
+describe("apt_registry_syncs_total", "counter", "Synchronizations of the GBIF registry state")
+describe("apt_registry_sync_modified_datasets_total", "counter", "Modified GBIF datasets applied by the synchronizations")
+describe("apt_registry_datasets", "gauge", "Datasets of the GBIF registry state by status (published, deleted)")
+describe("apt_job_duration_seconds", "histogram", "GBIF registry job execution duration by action")
+describe("apt_job_failures_total", "counter", "GBIF registry job failed attempts by action")
+describe("apt_jobs", "gauge", "GBIF registry jobs by status")
+describe("apt_catalog_datasets", "gauge", "Datasets in the catalog")
+describe("apt_catalog_bytes", "gauge", "Total size of the datasets in the catalog")
+describe("apt_leader", "gauge", "1 if the process answering is the leader process (of the cluster in cluster mode)")
+describe("apt_cluster_nodes", "gauge", "Alive nodes of the cluster")
+describe("apt_cluster_pull_duration_seconds", "histogram", "Duration of the dataset pulls from another node of the cluster")
+describe("apt_cluster_pull_errors_total", "counter", "Dataset pulls from another node of the cluster failed")
+
+###################################
+#
+#   Internal Functions
+#
+###################################
+
+#
+# Metrics saved by the other processes, and if each process is alive
+#
+def load_processes():
+    try:
+        files = os.listdir(CONFIG.METRICS_PATH)
+    except FileNotFoundError:
+        return
+    for f in files:
+        match = METRICS_FILE_PATTERN.fullmatch(f)
+        if not match or int(match.group(1)) == os.getpid():
+            continue
+        try:
+            with open(os.path.join(CONFIG.METRICS_PATH, f)) as metrics_file:
+                yield json.load(metrics_file), is_alive(int(match.group(1)))
+        except (OSError, ValueError):
+            continue
+
+def is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def merge(merged, key, value):
+    current = merged.get(key)
+    type = descriptions.get(key[0], ("untyped",))[0]
+    if current is None:
+        merged[key] = [list(value[0]), value[1], value[2]] if type == "histogram" else value
+    elif type == "histogram":
+        merged[key] = [[a + b for a, b in zip(current[0], value[0])], current[1] + value[1], current[2] + value[2]]
+    elif type == "gauge":
+        merged[key] = max(current, value)
+    else:
+        merged[key] = current + value
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in labels) + "}"
+
+def format_bound(bound):
+    return "+Inf" if bound == math.inf else str(bound)
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
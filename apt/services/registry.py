@@ -1,40 +1,329 @@
-import requests
-from requests.auth import HTTPBasicAuth
+import os
+import json
+import time
+import zlib
+import tempfile
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
 import apt.services.config as CONFIG
+import apt.services.archive as apt_archive
+import apt.services.registry_client as apt_registry_client
+import apt.services.metrics as apt_metrics
 
+log = logging.getLogger(__name__)
+
+# Number of locks shared by the dataset ids (registry updates)
+ID_LOCK_STRIPES = 64
+
+#
+# Local state of the GBIF registry: maps of GBIF published and deleted
+# datasets (endpoint URL -> GBIF key)
+#
+# Concurrency model:
+# - the maps are never modified in place, a change replaces them with
+#   modified copies (under the state lock), so readers never block and
+#   can iterate a map while it is changed
+# - registry updates of a dataset are serialized by a lock of its id
+#   (striped locks), updates of other datasets run in parallel
+# - changes done while a refresh or a synchronization is fetching the
+#   GBIF registry are replayed on its result, they are never lost
+# - a change and the save of the snapshot are done under the snapshot lock,
+#   then the state lock (always taken in this order): a snapshot reload can
+#   not come between them
+#
 class Registry:
 
     def __init__(self):
+        self.client = apt_registry_client.RegistryClient()
         self.gbif_published_datasets = {}
         self.gbif_deleted_datasets = {}
-        self.init_gbif_published_datasets()
-        self.init_gbif_deleted_datasets()
+        # Datasets registered in GBIF whose endpoint is not added yet
+        # (endpoint URL -> GBIF key): a retry only adds the endpoint
+        self.registering_datasets = {}
+        self.state_lock = threading.Lock()
+        self.id_locks = [threading.Lock() for i in range(ID_LOCK_STRIPES)]
+        # Changes done during a refresh or a synchronization (None otherwise)
+        self.journal = None
+        self.snapshot_lock = threading.Lock()
+        self.snapshot_version = None
+        # Latest GBIF modification date seen, changes are synchronized from it
+        self.watermark = None
+        # Full refresh and synchronization are never run at the same time
+        self.sync_lock = threading.Lock()
+        # Incremented on each change of the GBIF datasets maps
+        self.generation = 0
+        # Start from the local snapshot if any (to be refreshed in background
+        # by the leader process), otherwise wait for the GBIF registry
+        self.loaded_from_snapshot = self.load_snapshot()
+        if not self.loaded_from_snapshot:
+            self.refresh()
+
+    #
+    # Rebuild the GBIF published and deleted datasets maps
+    # from the GBIF registry, then save them as local snapshot
+    #
+    def refresh(self):
+        start = time.time()
+        with self.sync_lock:
+            self.start_journal()
+            try:
+                self.watermark = None
+                published = self.init_gbif_published_datasets()
+                deleted = self.init_gbif_deleted_datasets()
+                if not self.replace_state(lambda current_published, current_deleted: (published, deleted)):
+                    # Unchanged, but the snapshot is saved with the new watermark
+                    self.save_snapshot()
+            finally:
+                self.journal = None
+        duration = time.time() - start
+        apt_metrics.set_gauge("apt_registry_refresh_duration_seconds", duration)
+        apt_metrics.set_gauge("apt_registry_refresh_timestamp_seconds", time.time())
+        log.info(f"GBIF registry state refreshed in {duration:.1f}s")
+
+    def refresh_in_background(self):
+        def run():
+            try:
+                self.refresh()
+            except Exception as e:
+                log.error(f"GBIF registry state refresh failed, keeping snapshot: {e}")
+        threading.Thread(target=run, name="registry-refresh", daemon=True).start()
+
+    #
+    # Synchronize the GBIF published and deleted datasets maps with
+    # the datasets modified in the GBIF registry since the watermark
+    # (datasets deleted or changed outside of APT)
+    #
+    def sync(self):
+        if not self.watermark:
+            log.info("No GBIF registry watermark, full refresh needed")
+            self.refresh()
+            return
+        with self.sync_lock:
+            self.start_journal()
+            try:
+                since = self.watermark[:10]
+                records = []
+                for data in fetch_all_pages(self.client, "modified_datasets_page", lambda offset, limit: modified_dataset_url(since, offset, limit)):
+                    records += data['results']
+                for data in fetch_all_pages(self.client, "modified_deleted_datasets_page", lambda offset, limit: modified_deleted_dataset_url(since, offset, limit)):
+                    records += [r for r in data['results'] if r['publishingOrganizationKey'] == CONFIG.PUBLISHER_KEY]
+                self.apply_changes(records)
+            finally:
+                self.journal = None
+
+    #
+    # Apply modified GBIF datasets to copies of the maps, then replace
+    # the maps at once: readers see either the old or the new state
+    #
+    def apply_changes(self, records):
+        # Latest state of each dataset only (it may be returned by both feeds)
+        latest = {}
+        for r in sorted(records, key=lambda r: r.get('modified') or ""):
+            latest[r['key']] = r
+            self.watermark = latest_modification(r, self.watermark)
+
+        def apply(current_published, current_deleted):
+            published = {url: key for url, key in current_published.items() if key not in latest}
+            deleted = {url: key for url, key in current_deleted.items() if key not in latest}
+            for key, r in latest.items():
+                for endpoint in r['endpoints']:
+                    endpoint_url = endpoint['url']
+                    if endpoint_url.startswith(CONFIG.APT_PUBLIC_URL):
+                        if r.get('deleted'):
+                            deleted[endpoint_url] = key
+                        else:
+                            published[endpoint_url] = key
+            return published, deleted
+
+        apt_metrics.inc("apt_registry_syncs_total")
+        apt_metrics.inc("apt_registry_sync_modified_datasets_total", len(latest))
+        if self.replace_state(apply):
+            log.info(f"GBIF registry state synchronized: {len(latest)} modified datasets")
+
+    #
+    # Record the changes done from now on, to replay them on
+    # the GBIF registry state being fetched
+    #
+    def start_journal(self):
+        with self.state_lock:
+            self.journal = []
+
+    #
+    # Replace the maps by build(published, deleted) -> (published, deleted),
+    # with the changes done meanwhile replayed on the result
+    #
+    # Return True if the maps changed
+    #
+    def replace_state(self, build):
+        with self.snapshot_lock:
+            with self.state_lock:
+                published, deleted = build(self.gbif_published_datasets, self.gbif_deleted_datasets)
+                for endpoint_url, gbif_key, is_deleted in self.journal or []:
+                    set_dataset_state(published, deleted, endpoint_url, gbif_key, is_deleted)
+                if published == self.gbif_published_datasets and deleted == self.gbif_deleted_datasets:
+                    return False
+                self.gbif_published_datasets = published
+                self.gbif_deleted_datasets = deleted
+                self.generation += 1
+            self.write_snapshot()
+        return True
+
+    #
+    # Record a registration (is_deleted False) or a deletion (is_deleted True)
+    # of a dataset in copies of the maps, then replace the maps
+    #
+    def set_state(self, endpoint_url, gbif_key, is_deleted):
+        with self.snapshot_lock:
+            with self.state_lock:
+                published = dict(self.gbif_published_datasets)
+                deleted = dict(self.gbif_deleted_datasets)
+                set_dataset_state(published, deleted, endpoint_url, gbif_key, is_deleted)
+                if self.journal is not None:
+                    self.journal.append((endpoint_url, gbif_key, is_deleted))
+                self.gbif_published_datasets = published
+                self.gbif_deleted_datasets = deleted
+                if endpoint_url in self.registering_datasets:
+                    self.registering_datasets = {url: key for url, key in self.registering_datasets.items() if url != endpoint_url}
+                self.generation += 1
+            self.write_snapshot()
+
+    #
+    # Record a dataset registered in GBIF, before its endpoint is added
+    #
+    def set_registering(self, endpoint_url, gbif_key):
+        with self.snapshot_lock:
+            with self.state_lock:
+                registering = dict(self.registering_datasets)
+                registering[endpoint_url] = gbif_key
+                self.registering_datasets = registering
+                self.generation += 1
+            self.write_snapshot()
+
+    #
+    # Synchronize the GBIF registry state every REGISTRY_SYNC_INTERVAL seconds
+    # (while active() returns True, if given)
+    #
+    def start_sync(self, active=None):
+        if CONFIG.REGISTRY_SYNC_INTERVAL <= 0:
+            return
+        def run():
+            while True:
+                time.sleep(CONFIG.REGISTRY_SYNC_INTERVAL)
+                if active and not active():
+                    continue
+                try:
+                    self.sync()
+                except Exception as e:
+                    log.error(f"GBIF registry state synchronization failed: {e}")
+        threading.Thread(target=run, name="registry-sync", daemon=True).start()
+
+    #
+    # Load GBIF published and deleted datasets maps from the local snapshot
+    # (ignored if it was built for another APT URL or publisher)
+    #
+    def load_snapshot(self):
+        try:
+            with open(CONFIG.REGISTRY_SNAPSHOT_PATH) as f:
+                version = snapshot_file_version(os.fstat(f.fileno()))
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            return False
+        self.snapshot_version = version
+        if snapshot.get("apt_public_url") != CONFIG.APT_PUBLIC_URL or snapshot.get("publisher_key") != CONFIG.PUBLISHER_KEY:
+            log.info("GBIF registry snapshot ignored (other APT URL or publisher)")
+            return False
+        with self.state_lock:
+            self.gbif_published_datasets = snapshot["published"]
+            self.gbif_deleted_datasets = snapshot["deleted"]
+            self.registering_datasets = snapshot.get("registering", {})
+        self.watermark = snapshot.get("watermark")
+        self.generation += 1
+        log.info(f"GBIF registry snapshot loaded: {len(self.gbif_published_datasets)} published, {len(self.gbif_deleted_datasets)} deleted datasets")
+        return True
+
+    #
+    # Reload the local snapshot if it was saved by another process
+    # (registry updates are done by the leader process only)
+    #
+    def reload_snapshot_if_changed(self):
+        try:
+            version = snapshot_file_version(os.stat(CONFIG.REGISTRY_SNAPSHOT_PATH))
+        except OSError:
+            return
+        if version != self.snapshot_version:
+            with self.snapshot_lock:
+                if version != self.snapshot_version:
+                    self.load_snapshot()
+
+    #
+    # Save GBIF published and deleted datasets maps as local snapshot
+    # (written in a temporary file then renamed, never half written)
+    #
+    def save_snapshot(self):
+        with self.snapshot_lock:
+            self.write_snapshot()
+
+    def write_snapshot(self):
+        # Called with the snapshot lock held
+        # The maps are never modified in place, no copy is needed
+        snapshot = {
+            "apt_public_url": CONFIG.APT_PUBLIC_URL,
+            "publisher_key": CONFIG.PUBLISHER_KEY,
+            "created": time.time(),
+            "watermark": self.watermark,
+            "published": self.gbif_published_datasets,
+            "deleted": self.gbif_deleted_datasets,
+            "registering": self.registering_datasets
+        }
+        snapshot_dir = os.path.dirname(CONFIG.REGISTRY_SNAPSHOT_PATH)
+        os.makedirs(snapshot_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix=".registry-", dir=snapshot_dir)
+        with os.fdopen(fd, "w") as f:
+            json.dump(snapshot, f)
+            # Version of the written file (not of a partly flushed one)
+            f.flush()
+            os.fsync(f.fileno())
+            self.snapshot_version = snapshot_file_version(os.fstat(f.fileno()))
+        os.replace(tmp_path, CONFIG.REGISTRY_SNAPSHOT_PATH)
 
     #
     # Entry point for the registry update:
     # Register, update or revive, according to current state of the dataset
+    # (a registered dataset is not crawled again if crawl is False)
     #
-    def update(self, id):
-        if self.check_already_registered(id):
-            gbif_key = self.get_gbif_key(id)
-            print(f"Dataset {id} already registered with key {gbif_key}. Trigger crawl...", flush=True)
-            return self.update_dataset(id, gbif_key)
-        elif self.check_deleted(id):
-            gbif_key = self.get_gbif_deleted_key(id)
-            print(f"Dataset {id} was registered and deleted with key {gbif_key}. Trigger registration...", flush=True)
-            return self.revive_dataset(id, gbif_key)
-        else:
-            print(f"Dataset {id} not yet registered. Trigger registration...", flush=True)
-            return self.register_new_dataset(id)
+    def update(self, id, metadata=None, crawl=True):
+        with self.id_lock(id):
+            if self.check_already_registered(id):
+                gbif_key = self.get_gbif_key(id)
+                if not crawl:
+                    log.info(f"Dataset {id} already registered with key {gbif_key}")
+                    return gbif_key
+                log.info(f"Dataset {id} already registered with key {gbif_key}. Trigger crawl...")
+                return self.update_dataset(id, gbif_key)
+            elif self.check_deleted(id):
+                gbif_key = self.get_gbif_deleted_key(id)
+                log.info(f"Dataset {id} was registered and deleted with key {gbif_key}. Trigger registration...")
+                return self.revive_dataset(id, gbif_key)
+            else:
+                log.info(f"Dataset {id} not yet registered. Trigger registration...")
+                return self.register_new_dataset(id, metadata)
 
     #
     # Entry point for the registry deletion
     #
     def delete(self, id):
-        if self.check_already_registered(id):
-            gbif_key = self.get_gbif_key(id)
-            print(f"Dataset {id} registered with key {gbif_key}. Trigger deletion...", flush=True)
-            self.delete_dataset(id, gbif_key)
+        with self.id_lock(id):
+            if self.check_already_registered(id):
+                gbif_key = self.get_gbif_key(id)
+                log.info(f"Dataset {id} registered with key {gbif_key}. Trigger deletion...")
+                return self.delete_dataset(id, gbif_key)
+
+    #
+    # Lock of the registry updates of a dataset
+    #
+    def id_lock(self, id):
+        return self.id_locks[zlib.crc32(id.encode()) % len(self.id_locks)]
 
     #
     # Check if the dataset URL (built from its id)
@@ -67,40 +356,28 @@ class Registry:
     # Filter the datasets using the endpoint URL, to keep only datasets
     # hosted on this APT
     #
-    # Store the GBIF key / endpoint URL results
-    # in GBIF published datasets map
+    # Return the GBIF key / endpoint URL results
+    # as GBIF published datasets map
     #
     def init_gbif_published_datasets(self):
-        print("Initializing GBIF published datsets list...", flush=True)
+        log.info("Initializing GBIF published datsets list...")
         local_gbif_published_datasets = {}
 
-        offset = 0
-        limit = 1000
-
-        while True:
-            url = published_dataset_url(offset, limit)
-            print(url, flush=True)
-            response = requests.get(url)
-            data = response.json()
-
+        for data in fetch_all_pages(self.client, "published_datasets_page", published_dataset_url):
             for r in data['results']:
                 key = r['key']
                 endpoints = r['endpoints']
+                self.watermark = latest_modification(r, self.watermark)
                 for endpoint in endpoints:
                     endpoint_url = endpoint['url']
                     if endpoint_url.startswith(CONFIG.APT_PUBLIC_URL):
                         if endpoint_url in local_gbif_published_datasets:
-                            print("ERROR - endpoint already registered "+endpoint_url, flush=True)
+                            log.error("endpoint already registered "+endpoint_url)
                         else:
                             local_gbif_published_datasets[endpoint_url] = key
 
-            if data['endOfRecords']:
-                break
-            else:
-                offset = offset + limit
-
-        self.gbif_published_datasets = local_gbif_published_datasets
-        print(f"{str(len(self.gbif_published_datasets))} GBIF published datasets found", flush=True)
+        log.info(f"{str(len(local_gbif_published_datasets))} GBIF published datasets found")
+        return local_gbif_published_datasets
 
     #
     # Call GBIF deleted datasets URL (page by page)
@@ -109,76 +386,75 @@ class Registry:
     # Filter the datasets using the endpoint URL, to keep only datasets
     # that were hosted on this APT
     #
-    # Store the GBIF key / endpoint URL results
-    # in GBIF deleted datasets map
+    # Return the GBIF key / endpoint URL results
+    # as GBIF deleted datasets map
     #
     def init_gbif_deleted_datasets(self):
-        print("Initializing GBIF deleted datsets list...", flush=True)
+        log.info("Initializing GBIF deleted datsets list...")
         local_gbif_deleted_datasets = {}
 
-        offset = 0
-        limit = 1000
-
-        while True:
-            url = deleted_dataset_url(offset, limit)
-            print(url, flush=True)
-            response = requests.get(url)
-            data = response.json()
-
+        for data in fetch_all_pages(self.client, "deleted_datasets_page", deleted_dataset_url):
             for r in data['results']:
                 publisher_key = r['publishingOrganizationKey']
                 key = r['key']
                 endpoints = r['endpoints']
 
                 if publisher_key == CONFIG.PUBLISHER_KEY:
+                    self.watermark = latest_modification(r, self.watermark)
                     for endpoint in endpoints:
                         endpoint_url = endpoint['url']
                         if endpoint_url.startswith(CONFIG.APT_PUBLIC_URL):
                             if endpoint_url in local_gbif_deleted_datasets:
-                                print("ERROR - endpoint already exists in deleted datasets "+endpoint_url, flush=True)
+                                log.error("endpoint already exists in deleted datasets "+endpoint_url)
                             else:
                                 local_gbif_deleted_datasets[endpoint_url] = key
 
-            if data['endOfRecords']:
-                break
-            else:
-                offset = offset + limit
-
-        self.gbif_deleted_datasets = local_gbif_deleted_datasets
-        print(f"{str(len(self.gbif_deleted_datasets))} GBIF deleted datasets found", flush=True)
+        log.info(f"{str(len(local_gbif_deleted_datasets))} GBIF deleted datasets found")
+        return local_gbif_deleted_datasets
 
     #
     # Register a new dataset
+    # (with the metadata of its archive if known, else default ones)
     #
-    def register_new_dataset(self, id):
-        register_dataset_body = {
-            "publishingOrganizationKey": CONFIG.PUBLISHER_KEY,
-            "installationKey": CONFIG.INSTALLATION_KEY,
-            "type": "OCCURRENCE",
-            "title": "Dataset "+id,
-            "description": "Dataset "+id,
-            "language": CONFIG.PUBLICATION_LANGUAGE,
-            "license": CONFIG.PUBLICATION_LICENSE
-        }
-
-        url = registry_dataset_url()
-        print(f"Calling {url} with body: {register_dataset_body}", flush=True)
-        response = requests.post(url, json = register_dataset_body, auth = HTTPBasicAuth(CONFIG.GBIF_REGISTRY_LOGIN, CONFIG.GBIF_REGISTRY_PASSWORD))
-        gbif_key = response.json()
-        print(f"Dataset {id} registered with GBIF ID {gbif_key}", flush=True)
-
+    # The GBIF key is recorded as soon as the dataset is registered: if adding
+    # its endpoint fails, the retry only adds the endpoint (a second
+    # registration would create another GBIF dataset)
+    #
+    def register_new_dataset(self, id, metadata=None):
         apt_endpoint_url = dataset_url(id)
+        gbif_key = self.registering_datasets.get(apt_endpoint_url)
+        if gbif_key:
+            log.info(f"Dataset {id} already registered with GBIF ID {gbif_key}, endpoint not added yet")
+        else:
+            metadata = metadata or {}
+            register_dataset_body = {
+                "publishingOrganizationKey": CONFIG.PUBLISHER_KEY,
+                "installationKey": CONFIG.INSTALLATION_KEY,
+                "type": "OCCURRENCE",
+                "title": metadata.get("title") or "Dataset "+id,
+                "description": metadata.get("description") or "Dataset "+id,
+                "language": apt_archive.gbif_language(metadata.get("language")) or CONFIG.PUBLICATION_LANGUAGE,
+                "license": metadata.get("license") or CONFIG.PUBLICATION_LICENSE
+            }
+
+            url = registry_dataset_url()
+            log.info(f"Calling {url} with body: {register_dataset_body}")
+            response = self.client.post("register", url, json = register_dataset_body)
+            gbif_key = response.json()
+            log.info(f"Dataset {id} registered with GBIF ID {gbif_key}")
+            self.set_registering(apt_endpoint_url, gbif_key)
+
         apt_endpoint = {
             "type": "DWC_ARCHIVE",
             "url": apt_endpoint_url
         }
         url = registry_dataset_endpoint_url(gbif_key)
-        print(f"Calling POST {url} with body: {apt_endpoint}", flush=True)
-        response = requests.post(url, json = apt_endpoint, auth = HTTPBasicAuth(CONFIG.GBIF_REGISTRY_LOGIN, CONFIG.GBIF_REGISTRY_PASSWORD))
-        print(f"Endpoint {apt_endpoint_url} added for dataset {id}", flush=True)
+        log.info(f"Calling POST {url} with body: {apt_endpoint}")
+        response = self.client.post("add_endpoint", url, json = apt_endpoint)
+        log.info(f"Endpoint {apt_endpoint_url} added for dataset {id}")
 
         # Update local GBIF Registry
-        self.gbif_published_datasets[apt_endpoint_url] = gbif_key
+        self.set_state(apt_endpoint_url, gbif_key, False)
 
         return gbif_key
 
@@ -187,10 +463,10 @@ class Registry:
     #
     def update_dataset(self, id, gbif_key):
         crawl_url = registry_dataset_crawl_url(gbif_key)
-        print(f"Calling {crawl_url}", flush=True)
-        response = requests.post(crawl_url, auth = HTTPBasicAuth(CONFIG.GBIF_REGISTRY_LOGIN, CONFIG.GBIF_REGISTRY_PASSWORD))
+        log.info(f"Calling {crawl_url}")
+        response = self.client.post("crawl", crawl_url)
 
-        print(f"Dataset {id} updated with GBIF ID {gbif_key}", flush=True)
+        log.info(f"Dataset {id} updated with GBIF ID {gbif_key}")
 
         return gbif_key
 
@@ -200,7 +476,7 @@ class Registry:
     def revive_dataset(self, id, gbif_key):
         # Get current dataset
         url = registry_dataset_revive_url(gbif_key)
-        response = requests.get(url)
+        response = self.client.get("get_dataset", url)
         dataset_json = response.json()
         del dataset_json["deleted"]
 
@@ -208,14 +484,13 @@ class Registry:
 
         # Update installation
         url = registry_dataset_revive_url(gbif_key)
-        print(f"Calling PUT {url}", flush=True)
-        response = requests.put(url, json = dataset_json, auth = HTTPBasicAuth(CONFIG.GBIF_REGISTRY_LOGIN, CONFIG.GBIF_REGISTRY_PASSWORD))
+        log.info(f"Calling PUT {url}")
+        response = self.client.put("revive", url, json = dataset_json)
 
         # Update local GBIF Registry
-        self.gbif_published_datasets[apt_endpoint_url] = gbif_key
-        del self.gbif_deleted_datasets[apt_endpoint_url]
+        self.set_state(apt_endpoint_url, gbif_key, False)
 
-        print(f"Dataset {id} revived with GBIF ID {gbif_key}", flush=True)
+        log.info(f"Dataset {id} revived with GBIF ID {gbif_key}")
 
         return gbif_key
 
@@ -224,16 +499,15 @@ class Registry:
     #
     def delete_dataset(self, id, gbif_key):
         delete_url = registry_dataset_delete_url(gbif_key)
-        print(f"Calling {delete_url}", flush=True)
-        response = requests.delete(delete_url, auth = HTTPBasicAuth(CONFIG.GBIF_REGISTRY_LOGIN, CONFIG.GBIF_REGISTRY_PASSWORD))
+        log.info(f"Calling {delete_url}")
+        response = self.client.delete("delete", delete_url)
 
         apt_endpoint_url = dataset_url(id)
 
         # Update local GBIF Registry
-        del self.gbif_published_datasets[apt_endpoint_url]
-        self.gbif_deleted_datasets[apt_endpoint_url] = gbif_key
+        self.set_state(apt_endpoint_url, gbif_key, True)
 
-        print(f"Dataset {id} deleted with GBIF ID {gbif_key}", flush=True)
+        log.info(f"Dataset {id} deleted with GBIF ID {gbif_key}")
 
         return gbif_key
 
@@ -243,6 +517,56 @@ class Registry:
 #
 ###################################
 
+#
+# Fetch all pages of a GBIF paged URL
+#
+# The first page gives the total count, the other pages are then
+# fetched concurrently (bounded pool) and returned in order
+#
+def fetch_all_pages(client, operation, page_url, limit=1000):
+    def fetch_page(offset):
+        apt_metrics.inc("apt_gbif_pages_total", operation=operation)
+        return client.get(operation, page_url(offset, limit)).json()
+    pages = [fetch_page(0)]
+    if pages[0]['endOfRecords']:
+        return pages
+    offsets = range(limit, pages[0].get('count', 0), limit)
+    with ThreadPoolExecutor(max_workers=CONFIG.REGISTRY_BOOTSTRAP_WORKERS) as executor:
+        pages += executor.map(fetch_page, offsets)
+    # Unknown count or records added while fetching: continue page by page
+    offset = offsets[-1] + limit if offsets else limit
+    while not pages[-1]['endOfRecords']:
+        pages.append(fetch_page(offset))
+        offset = offset + limit
+    return pages
+
+#
+# Move a dataset endpoint URL to the published or the deleted map
+#
+def set_dataset_state(published, deleted, endpoint_url, gbif_key, is_deleted):
+    if is_deleted:
+        published.pop(endpoint_url, None)
+        deleted[endpoint_url] = gbif_key
+    else:
+        deleted.pop(endpoint_url, None)
+        published[endpoint_url] = gbif_key
+
+#
+# Latest of the watermark and the GBIF modification date of a dataset
+# (ISO 8601 dates in the same time zone, compared as strings)
+#
+def latest_modification(dataset, watermark):
+    modified = dataset.get('modified')
+    if modified and (not watermark or modified > watermark):
+        return modified
+    return watermark
+
+#
+# Identify a version of the snapshot file (a new file is written on each save)
+#
+def snapshot_file_version(stat):
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
 def dataset_url(id):
     return CONFIG.APT_PUBLIC_URL + "/dataset/"+id
 
@@ -266,3 +590,9 @@ def published_dataset_url(offset, limit):
 
 def deleted_dataset_url(offset, limit):
     return CONFIG.GBIF_REGISTRY_URL + "/v1/dataset/deleted?offset=" + str(offset) + "&limit=" + str(limit)
+
+def modified_dataset_url(since, offset, limit):
+    return CONFIG.GBIF_REGISTRY_URL + "/v1/dataset?publishingOrg=" + CONFIG.PUBLISHER_KEY + "&modified=" + since + ",*&offset=" + str(offset) + "&limit=" + str(limit)
+
+def modified_deleted_dataset_url(since, offset, limit):
+    return CONFIG.GBIF_REGISTRY_URL + "/v1/dataset/deleted?modified=" + since + ",*&offset=" + str(offset) + "&limit=" + str(limit)
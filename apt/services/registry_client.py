@@ -0,0 +1,119 @@
+import os
+import time
+import threading
+import logging
+import requests
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPBasicAuth
+from urllib3.util.retry import Retry
+import apt.services.metrics as apt_metrics
+import apt.services.config as CONFIG
+
+log = logging.getLogger(__name__)
+
+#
+# Retry policy for GBIF registry calls
+#
+# 429 and 503 responses are retried for every method (the call was not
+# processed), other 5xx responses only for idempotent methods: retrying
+# a failed POST could register the same dataset twice. For the same reason,
+# a POST whose response is lost (read timeout, dropped connection) is not
+# retried, only a POST that could not connect
+#
+class RegistryRetry(Retry):
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if method.upper() == "POST" and status_code not in (429, 503):
+            return False
+        return super().is_retry(method, status_code, has_retry_after)
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        if error and method and method.upper() == "POST" and not self._is_connection_error(error):
+            raise error.with_traceback(_stacktrace)
+        return super().increment(method, url, response, error, _pool, _stacktrace)
+
+#
+# Shared HTTP client for all GBIF registry calls
+#
+# A single keep-alive session (connection pool), with timeouts,
+# retries with backoff and per-operation latency statistics
+#
+class RegistryClient:
+
+    def __init__(self):
+        self.auth = HTTPBasicAuth(CONFIG.GBIF_REGISTRY_LOGIN, CONFIG.GBIF_REGISTRY_PASSWORD)
+        self.timeout = (CONFIG.REGISTRY_CONNECT_TIMEOUT, CONFIG.REGISTRY_READ_TIMEOUT)
+        self.open_session()
+        # Connections of the pool can not be shared with forked processes
+        os.register_at_fork(after_in_child=self.open_session)
+        self.stats_lock = threading.Lock()
+        self.operation_stats = {}
+
+    def open_session(self):
+        self.session = requests.Session()
+        retry = RegistryRetry(
+            total=CONFIG.REGISTRY_RETRIES,
+            backoff_factor=CONFIG.REGISTRY_RETRY_BACKOFF,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=["GET", "POST", "PUT", "DELETE"],
+            respect_retry_after_header=True,
+            raise_on_status=False)
+        pool_size = max(CONFIG.REGISTRY_POOL_SIZE, CONFIG.REGISTRY_BOOTSTRAP_WORKERS, CONFIG.JOB_WORKERS, CONFIG.REPORT_GBIF_WORKERS)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def get(self, operation, url, authenticated=False, **kwargs):
+        return self.request(operation, "GET", url, authenticated, **kwargs)
+
+    def post(self, operation, url, authenticated=True, **kwargs):
+        return self.request(operation, "POST", url, authenticated, **kwargs)
+
+    def put(self, operation, url, authenticated=True, **kwargs):
+        return self.request(operation, "PUT", url, authenticated, **kwargs)
+
+    def delete(self, operation, url, authenticated=True, **kwargs):
+        return self.request(operation, "DELETE", url, authenticated, **kwargs)
+
+    #
+    # Call the GBIF registry, raise an error if the final response
+    # (after retries) is not successful
+    #
+    def request(self, operation, method, url, authenticated, **kwargs):
+        if authenticated:
+            kwargs["auth"] = self.auth
+        start = time.perf_counter()
+        error = True
+        try:
+            response = self.session.request(method, url, timeout=self.timeout, **kwargs)
+            duration = time.perf_counter() - start
+            log.info(f"GBIF {operation}: {method} {url} -> {response.status_code} in {duration * 1000:.0f}ms",
+                extra={"operation": operation, "method": method, "status": response.status_code, "duration": duration})
+            response.raise_for_status()
+            error = False
+            return response
+        finally:
+            self.record(operation, time.perf_counter() - start, error)
+
+    def record(self, operation, duration, error):
+        with self.stats_lock:
+            stats = self.operation_stats.setdefault(operation, {"calls": 0, "errors": 0, "total_time": 0.0, "max_time": 0.0})
+            stats["calls"] += 1
+            stats["total_time"] += duration
+            stats["max_time"] = max(stats["max_time"], duration)
+            if error:
+                stats["errors"] += 1
+        apt_metrics.observe("apt_gbif_request_duration_seconds", duration, operation=operation)
+        if error:
+            apt_metrics.inc("apt_gbif_request_errors_total", operation=operation)
+
+    #
+    # Get a copy of the per-operation latency statistics
+    #
+    def stats(self):
+        with self.stats_lock:
+            stats = {}
+            for operation, operation_stats in self.operation_stats.items():
+                stats[operation] = dict(operation_stats)
+                stats[operation]["average_time"] = operation_stats["total_time"] / operation_stats["calls"]
+            return stats
@@ -1,30 +1,240 @@
-import apt.services.dataset as apt_dataset
+import json
+import time
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 import apt.services.registry as apt_registry
+import apt.services.config as CONFIG
+
+# Date formats of the GBIF API (with and without milliseconds)
+GBIF_DATE_FORMATS = ["%Y-%m-%dT%H:%M:%S.%f%z", "%Y-%m-%dT%H:%M:%S%z"]
+
+# Crawls read by page of the crawl history of a dataset
+CRAWL_HISTORY_PAGE_SIZE = 10
 
 class Reporting:
 
-    def __init__(self, registry):
+    def __init__(self, registry, catalog):
         self.registry = registry
+        self.catalog = catalog
+        # Materialized reports: name -> (generation, report)
+        self.cache = {}
+        self.cache_lock = threading.Lock()
+        # GBIF information by dataset key: key -> (expiration, information)
+        # (expired entries removed when new ones are added)
+        self.gbif_cache = {}
+
+    #
+    # Get a report from the cache, built again only if the generation
+    # of its sources (registry, catalog) changed since it was built
+    #
+    def cached(self, name, generation, build):
+        entry = self.cache.get(name)
+        if entry and entry[0] == generation:
+            return entry[1]
+        with self.cache_lock:
+            entry = self.cache.get(name)
+            if entry and entry[0] == generation:
+                return entry[1]
+            report = build()
+            self.cache[name] = (generation, report)
+            return report
+
+    #
+    # Serialized list of GBIF published datasets hosted on this APT
+    #
+    def registered_report(self):
+        return self.cached("registered", self.registry.generation,
+            lambda: serialize(build_url_key_list(self.registry.gbif_published_datasets)))
+
+    #
+    # Serialized list of GBIF deleted datasets that were hosted on this APT
+    #
+    def deleted_report(self):
+        return self.cached("deleted", self.registry.generation,
+            lambda: serialize(build_url_key_list(self.registry.gbif_deleted_datasets)))
 
     #
+    # Map of APT dataset id -> GBIF key of the published datasets
+    #
+    def gbif_keys_by_id(self):
+        def build():
+            prefix = apt_registry.dataset_url("")
+            gbif_keys = {}
+            for url, key in self.registry.gbif_published_datasets.items():
+                if url.startswith(prefix):
+                    gbif_keys[url[len(prefix):]] = key
+            return gbif_keys
+        return self.cached("gbif_keys", self.registry.generation, build)
+
     #
+    # Build the APT dataset list from the catalog index
     #
-    def build_apt_list():
+    def build_apt_list(self):
         dataset_list = {}
-        datasets = apt_dataset.list_all()
-        for id in datasets:
-            dataset_path = apt_dataset.get_path(id)
-            dataset_url = apt_registry.dataset_url(id)
-            modification_date = apt_dataset.get_modification_date(dataset_path)
+        for entry in self.catalog.list_entries():
+            id = entry["id"]
             dataset = {}
             dataset["id"] = id
-            dataset["url"] = dataset_url
-            dataset["apt_modification_date"] = modification_date
+            dataset["url"] = apt_registry.dataset_url(id)
+            dataset["apt_modification_date"] = entry["installed"]
+            dataset["apt_size"] = entry["size"]
+            dataset_list[id] = dataset
+        return dataset_list
 
     #
+    # Build the GBIF information list of the given GBIF dataset keys:
+    # record count and last crawl
+    #
+    # Record counts are fetched in batches (one occurrence search faceted by
+    # dataset per batch), crawls concurrently (bounded pool), and results
+    # are kept in cache for REPORT_GBIF_TTL seconds
+    #
+    def build_gbif_list(self, gbif_keys):
+        now = time.time()
+        dataset_list = {}
+        missing_keys = []
+        for key in gbif_keys:
+            entry = self.gbif_cache.get(key)
+            if entry and entry[0] > now:
+                dataset_list[key] = entry[1]
+            else:
+                missing_keys.append(key)
+        if not missing_keys:
+            return dataset_list
+
+        batches = [missing_keys[i:i + CONFIG.REPORT_GBIF_BATCH_SIZE] for i in range(0, len(missing_keys), CONFIG.REPORT_GBIF_BATCH_SIZE)]
+        with ThreadPoolExecutor(max_workers=CONFIG.REPORT_GBIF_WORKERS) as executor:
+            record_counts = {}
+            for batch_counts in executor.map(self.fetch_record_counts, batches):
+                record_counts.update(batch_counts)
+            last_crawls = dict(zip(missing_keys, executor.map(self.fetch_last_crawl, missing_keys)))
+
+        now = time.time()
+        expires = now + CONFIG.REPORT_GBIF_TTL
+        gbif_cache = dict((key, entry) for key, entry in list(self.gbif_cache.items()) if entry[0] > now)
+        for key in missing_keys:
+            dataset = {}
+            dataset["gbif_key"] = key
+            dataset["gbif_record_count"] = record_counts.get(key, 0)
+            dataset["gbif_last_crawl"] = last_crawls[key]
+            gbif_cache[key] = (expires, dataset)
+            dataset_list[key] = dataset
+        self.gbif_cache = gbif_cache
+        return dataset_list
+
     #
+    # Get the occurrence record counts of a batch of GBIF dataset keys
     #
-    def build_gbif_list():       
-        
-        responseCount = requests.get('http://api.gbif.org/v1/occurrence/count?datasetKey='+key)
-        recordCount = responseCount.text
\ No newline at end of file
+    def fetch_record_counts(self, gbif_keys):
+        url = occurrence_counts_url(gbif_keys)
+        data = self.registry.client.get("occurrence_counts", url).json()
+        record_counts = {}
+        for facet in data.get("facets", []):
+            for count in facet["counts"]:
+                record_counts[count["name"]] = count["count"]
+        return record_counts
+
+    #
+    # Get the end date of the last finished crawl of a GBIF dataset
+    # (None if never crawled)
+    #
+    # The crawl history is paged from the latest crawl: the latest ones may
+    # not be finished yet
+    #
+    def fetch_last_crawl(self, gbif_key):
+        offset = 0
+        while True:
+            url = crawl_history_url(gbif_key, offset)
+            data = self.registry.client.get("crawl_history", url).json()
+            results = data.get("results", [])
+            for crawl in results:
+                if crawl.get("finishedCrawling"):
+                    return crawl["finishedCrawling"]
+            if data.get("endOfRecords", True) or not results:
+                return None
+            offset += len(results)
+
+    #
+    # Reconciliation of the APT datasets with the GBIF registry
+    #
+    # Each dataset (on APT, registered on GBIF, or both) gets a status:
+    # - ok: registered and crawled after its last upload
+    # - unregistered: on APT, not registered on GBIF
+    # - orphaned: registered on GBIF, no longer on APT
+    # - never_crawled: registered, never crawled by GBIF
+    # - stale: uploaded on APT after the last GBIF crawl
+    #
+    def build_reconciliation(self):
+        apt_list = self.build_apt_list()
+        gbif_keys = self.gbif_keys_by_id()
+        gbif_list = self.build_gbif_list(list(gbif_keys.values()))
+
+        datasets = []
+        summary = {"ok": 0, "unregistered": 0, "orphaned": 0, "never_crawled": 0, "stale": 0}
+        for id in sorted(set(apt_list) | set(gbif_keys)):
+            dataset = {}
+            dataset["id"] = id
+            dataset["url"] = apt_registry.dataset_url(id)
+            dataset["apt_modification_date"] = None
+            dataset["apt_size"] = None
+            dataset["gbif_key"] = gbif_keys.get(id)
+            dataset["gbif_record_count"] = None
+            dataset["gbif_last_crawl"] = None
+            dataset.update(apt_list.get(id, {}))
+            dataset.update(gbif_list.get(dataset["gbif_key"], {}))
+
+            if id not in apt_list:
+                status = "orphaned"
+            elif not dataset["gbif_key"]:
+                status = "unregistered"
+            elif not dataset["gbif_last_crawl"]:
+                status = "never_crawled"
+            elif dataset["apt_modification_date"] > parse_date(dataset["gbif_last_crawl"], 0):
+                status = "stale"
+            else:
+                status = "ok"
+            dataset["status"] = status
+            summary[status] += 1
+            datasets.append(dataset)
+
+        report = {}
+        report["summary"] = summary
+        report["datasets"] = datasets
+        return report
+
+###################################
+#
+#   Internal Functions
+#
+###################################
+
+def build_url_key_list(datasets):
+    dataset_list = []
+    for url, key in list(datasets.items()):
+        dataset = {}
+        dataset["url"] = url
+        dataset["key"] = key
+        dataset_list.append(dataset)
+    return dataset_list
+
+def serialize(report):
+    return json.dumps(report, separators=(",", ":"), sort_keys=True) + "\n"
+
+#
+# Parse a GBIF date (ISO 8601, e.g. 2026-10-18T22:08:27.000+0000) as timestamp
+# (datetime.fromisoformat only reads the "+0000" offsets from Python 3.11)
+#
+def parse_date(date, default=None):
+    for date_format in GBIF_DATE_FORMATS:
+        try:
+            return datetime.strptime(date, date_format).timestamp()
+        except ValueError:
+            pass
+    return default
+
+def occurrence_counts_url(gbif_keys):
+    return CONFIG.GBIF_REGISTRY_URL + "/v1/occurrence/search?limit=0&facet=datasetKey&facetLimit=" + str(len(gbif_keys)) + "".join("&datasetKey=" + key for key in gbif_keys)
+
+def crawl_history_url(gbif_key, offset=0):
+    return CONFIG.GBIF_REGISTRY_URL + "/v1/dataset/" + gbif_key + "/process?limit=" + str(CRAWL_HISTORY_PAGE_SIZE) + "&offset=" + str(offset)
@@ -1,6 +1,9 @@
+import logging
 from flask import Flask, request, abort
 import apt.services.config as CONFIG
 
+log = logging.getLogger(__name__)
+
 #
 # Verify required security constraints
 #
@@ -8,6 +11,15 @@ def verify(request):
     verify_api_key(request)
     verify_remote_addr(request)
 
+#
+# Identify the client of a request, for rate limiting:
+# the API Key if valid, else the IP address
+#
+def client_id(request):
+    if CONFIG.SECURITY_APY_KEY and request.headers.get("X-API-Key") == CONFIG.SECURITY_APY_KEY:
+        return "api-key"
+    return request.headers.get("X-Real-IP") or request.remote_addr
+
 #
 # Verify API Key header parameter
 #
@@ -15,7 +27,7 @@ def verify_api_key(request):
     if CONFIG.SECURITY_APY_KEY:
         apiKey = request.headers.get("X-API-Key")
         if apiKey != CONFIG.SECURITY_APY_KEY:
-            print(f"Unauthorized API Key {apiKey}", flush=True)
+            log.warning(f"Unauthorized API Key {apiKey}")
             abort(403)
 
 #
@@ -25,5 +37,5 @@ def verify_remote_addr(request):
     if CONFIG.SECURITY_AUTHORIZED_IP:
         remoteAddr = request.headers.get("X-Real-IP")
         if remoteAddr != CONFIG.SECURITY_AUTHORIZED_IP:
-            print(f"Unauthorized remote IP address {remoteAddr}", flush=True)
+            log.warning(f"Unauthorized remote IP address {remoteAddr}")
             abort(403)
\ No newline at end of file
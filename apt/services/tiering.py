@@ -0,0 +1,193 @@
+import os
+import time
+import threading
+import logging
+import apt.services.dataset as apt_dataset
+import apt.services.metrics as apt_metrics
+import apt.services.config as CONFIG
+
+log = logging.getLogger(__name__)
+
+#
+# Storage tiering of the dataset files: hot (RESOURCES_PATH) and cold
+# (COLD_STORAGE_PATH, a cheaper mount)
+#
+# The mover (run by the leader process of the node) moves to the cold storage
+# the datasets neither downloaded nor modified for TIERING_COLD_AFTER_DAYS days,
+# and the stored contents only used by old versions. Copies are throttled to
+# TIERING_RATE bytes per second
+#
+# A cold dataset is still served (from the cold storage). If TIERING_PROMOTE is
+# set, its download moves it back to the hot storage, in background. The cold
+# copy is removed TIERING_PROMOTE_GRACE seconds later, as the fronting server
+# (x-accel or x-sendfile download mode) may not have opened it yet
+#
+class Tiering:
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+        self.lock = threading.Lock()
+        # Datasets being promoted by this process
+        self.promoting = set()
+
+    #
+    # Move the unused datasets and versions to the cold storage
+    #
+    def run_once(self):
+        demoted = 0
+        for entry in self.catalog.list_unused(CONFIG.TIERING_COLD_AFTER_DAYS):
+            try:
+                if self.demote(entry):
+                    demoted += 1
+            except Exception as e:
+                log.error(f"Move of dataset {entry['id']} to the cold storage failed: {e}")
+        versions = 0
+        for checksum in self.catalog.list_version_checksums():
+            try:
+                if self.demote_blob(checksum):
+                    versions += 1
+            except Exception as e:
+                log.error(f"Move of content {checksum} to the cold storage failed: {e}")
+        if demoted or versions:
+            log.info(f"Storage tiering: {demoted} datasets and {versions} versions moved to the cold storage")
+
+    #
+    # Move a dataset (catalog entry) to the cold storage
+    # Return False if not moved (already cold, or modified meanwhile)
+    #
+    def demote(self, entry):
+        id = entry["id"]
+        path = apt_dataset.get_path(id)
+        if not path or apt_dataset.is_cold_path(path):
+            return False
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return False
+        if (stat.st_size, stat.st_mtime) != (entry["size"], entry["mtime"]):
+            return False
+        cold_path = apt_dataset.layout.get_path(id, CONFIG.COLD_STORAGE_PATH)
+        os.makedirs(os.path.dirname(cold_path), exist_ok=True)
+        apt_dataset.copy_file(path, cold_path, CONFIG.TIERING_RATE)
+        # The file replaced by an upload meanwhile is kept, the copy removed
+        if not apt_dataset.remove_if_unchanged(path, stat):
+            apt_dataset.delete_file(cold_path)
+            return False
+        if entry["checksum"]:
+            # Content kept for the versions in the cold blob store, and removed
+            # from the hot one if no other dataset uses it
+            apt_dataset.add_blob(cold_path, entry["checksum"], cold=True)
+            self.remove_hot_blob(entry["checksum"])
+        self.count("demote", stat.st_size)
+        return True
+
+    #
+    # Move a stored content (of old versions only) to the cold blob store
+    #
+    def demote_blob(self, checksum):
+        blob_path = apt_dataset.get_blob_path(checksum)
+        try:
+            stat = os.stat(blob_path)
+        except FileNotFoundError:
+            return False
+        if stat.st_nlink > 1 or stat.st_mtime > time.time() - CONFIG.TIERING_COLD_AFTER_DAYS * 86400:
+            return False
+        cold_blob_path = apt_dataset.get_blob_path(checksum, cold=True)
+        if not os.path.exists(cold_blob_path):
+            os.makedirs(os.path.dirname(cold_blob_path), exist_ok=True)
+            apt_dataset.copy_file(blob_path, cold_blob_path, CONFIG.TIERING_RATE)
+        self.remove_hot_blob(checksum)
+        self.count("demote", stat.st_size)
+        return True
+
+    #
+    # Remove a content from the hot blob store, unless a dataset file links to it
+    #
+    def remove_hot_blob(self, checksum):
+        blob_path = apt_dataset.get_blob_path(checksum)
+        try:
+            stat = os.stat(blob_path)
+        except FileNotFoundError:
+            return
+        if stat.st_nlink == 1:
+            apt_dataset.remove_if_unchanged(blob_path, stat)
+
+    #
+    # Move a cold dataset back to the hot storage
+    # Return False if not moved (not cold, or uploaded meanwhile)
+    #
+    def promote(self, id):
+        cold_path = apt_dataset.get_path(id)
+        if not cold_path or not apt_dataset.is_cold_path(cold_path):
+            return False
+        try:
+            stat = os.stat(cold_path)
+        except FileNotFoundError:
+            return False
+        # Not moved back if deleted meanwhile
+        entry = self.catalog.get(id)
+        if not entry:
+            return False
+        # Stored in the hot blob store if it is the current content
+        source_path = cold_path
+        if entry["checksum"] and (entry["size"], entry["mtime"]) == (stat.st_size, stat.st_mtime):
+            source_path = apt_dataset.add_blob(cold_path, entry["checksum"])
+        apt_dataset.init_path(id)
+        if apt_dataset.link_new_dataset(source_path, apt_dataset.get_storage_path(id)):
+            self.count("promote", stat.st_size)
+        self.remove_later(cold_path, stat)
+        return True
+
+    #
+    # Remove the cold copy of a promoted dataset after TIERING_PROMOTE_GRACE
+    # seconds, unless replaced meanwhile (moved to the cold storage again)
+    #
+    # A copy left by a stopped process is replaced by the next move of the
+    # dataset to the cold storage, or removed with the dataset
+    #
+    def remove_later(self, cold_path, stat):
+        def remove():
+            try:
+                apt_dataset.remove_if_unchanged(cold_path, stat)
+            except Exception as e:
+                log.error(f"Removal of the cold copy {cold_path} failed: {e}")
+        timer = threading.Timer(CONFIG.TIERING_PROMOTE_GRACE, remove)
+        timer.name = "tiering-remove"
+        timer.daemon = True
+        timer.start()
+
+    #
+    # Promote a cold dataset in background (once at a time per dataset)
+    #
+    def promote_in_background(self, id):
+        with self.lock:
+            if id in self.promoting:
+                return
+            self.promoting.add(id)
+        def run():
+            try:
+                if self.promote(id):
+                    log.info(f"Dataset {id} moved back to the hot storage")
+            except Exception as e:
+                log.error(f"Move of dataset {id} to the hot storage failed: {e}")
+            finally:
+                with self.lock:
+                    self.promoting.discard(id)
+        threading.Thread(target=run, name="tiering-promote", daemon=True).start()
+
+    def count(self, direction, size):
+        apt_metrics.inc("apt_tiering_moves_total", direction=direction)
+        apt_metrics.inc("apt_tiering_bytes_total", size, direction=direction)
+
+    #
+    # Run the mover every TIERING_INTERVAL seconds
+    #
+    def start(self):
+        def run():
+            while True:
+                time.sleep(CONFIG.TIERING_INTERVAL)
+                try:
+                    self.run_once()
+                except Exception as e:
+                    log.error(f"Storage tiering failed: {e}")
+        threading.Thread(target=run, name="tiering", daemon=True).start()
@@ -0,0 +1,230 @@
+import re
+import sys
+import json
+import time
+import uuid
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+#
+# Local stand-in of the GBIF registry API used by APT
+#
+# - GET  /v1/organization/<key>/publishedDataset (paged)
+# - GET  /v1/dataset/deleted (paged)
+# - GET  /v1/dataset?publishingOrg=<key>&modified=<date>,* (paged)
+# - POST /v1/dataset, GET / PUT / DELETE /v1/dataset/<key>
+# - POST /v1/dataset/<key>/endpoint, POST /v1/dataset/<key>/crawl
+# - GET  /v1/dataset/<key>/process, GET /v1/occurrence/search (reports)
+#
+# Every call waits for the configured latency. The registry starts with
+# generated published and deleted datasets of the publisher, hosted on
+# the given APT URL (ids bench-<n>, deleted ids bench-deleted-<n>)
+#
+class FakeRegistry:
+
+    def __init__(self, apt_url, publisher_key, published=0, deleted=0, latency=0.0, max_page_size=1000):
+        self.apt_url = apt_url
+        self.publisher_key = publisher_key
+        self.latency = latency
+        self.max_page_size = max_page_size
+        self.lock = threading.Lock()
+        # GBIF key -> dataset (ordered by creation)
+        self.datasets = {}
+        # Number of calls by operation
+        self.calls = {}
+        # GBIF key -> crawl history, latest first (one crawl finished now
+        # for the datasets not in it)
+        self.crawls = {}
+        for i in range(published):
+            self.create(self.apt_url + "/dataset/" + dataset_id(i))
+        for i in range(deleted):
+            dataset = self.create(self.apt_url + "/dataset/" + deleted_dataset_id(i))
+            dataset["deleted"] = now()
+
+    def create(self, endpoint_url=None, body=None):
+        dataset = dict(body or {})
+        dataset["key"] = str(uuid.uuid4())
+        dataset["publishingOrganizationKey"] = dataset.get("publishingOrganizationKey", self.publisher_key)
+        dataset["endpoints"] = [{"type": "DWC_ARCHIVE", "url": endpoint_url}] if endpoint_url else []
+        dataset["created"] = dataset["modified"] = now()
+        self.datasets[dataset["key"]] = dataset
+        return dataset
+
+    def count(self, operation):
+        with self.lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+
+    #
+    # Start the HTTP server in a background thread, return its URL
+    #
+    def start(self, port=0):
+        registry = self
+        class Handler(RegistryHandler):
+            pass
+        Handler.registry = registry
+        self.server = RegistryServer(("127.0.0.1", port), Handler)
+        threading.Thread(target=self.server.serve_forever, name="fake-registry", daemon=True).start()
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class RegistryServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    # Connections closed by a stopped APT server are expected
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+class RegistryHandler(BaseHTTPRequestHandler):
+
+    registry = None
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        registry = self.registry
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        time.sleep(registry.latency)
+        with registry.lock:
+            datasets = list(registry.datasets.values())
+        if re.fullmatch(r"/v1/organization/[^/]+/publishedDataset", url.path):
+            registry.count("published_datasets_page")
+            return self.send_page(query, [d for d in datasets if not d.get("deleted")])
+        if url.path == "/v1/dataset/deleted":
+            registry.count("deleted_datasets_page")
+            return self.send_page(query, [d for d in datasets if d.get("deleted")], query.get("modified"))
+        if url.path == "/v1/dataset":
+            registry.count("modified_datasets_page")
+            publisher_key = query.get("publishingOrg", [None])[0]
+            return self.send_page(query, [d for d in datasets if not d.get("deleted") and d["publishingOrganizationKey"] == publisher_key], query.get("modified"))
+        if url.path == "/v1/occurrence/search":
+            registry.count("occurrence_counts")
+            counts = [{"name": key, "count": 1000} for key in query.get("datasetKey", [])]
+            return self.send(200, {"count": 0, "results": [], "facets": [{"field": "DATASET_KEY", "counts": counts}]})
+        match = re.fullmatch(r"/v1/dataset/([^/]+)/process", url.path)
+        if match:
+            registry.count("crawl_history")
+            with registry.lock:
+                crawls = list(registry.crawls.get(match.group(1), [{"finishedCrawling": now()}]))
+            return self.send_page(query, crawls)
+        match = re.fullmatch(r"/v1/dataset/([^/]+)", url.path)
+        if match and match.group(1) in registry.datasets:
+            registry.count("get_dataset")
+            return self.send(200, registry.datasets[match.group(1)])
+        self.send(404, None)
+
+    def do_POST(self):
+        registry = self.registry
+        body = self.read_body()
+        time.sleep(registry.latency)
+        if self.path == "/v1/dataset":
+            registry.count("register")
+            with registry.lock:
+                dataset = registry.create(body=body)
+            return self.send(201, dataset["key"])
+        match = re.fullmatch(r"/v1/dataset/([^/]+)/endpoint", self.path)
+        if match and match.group(1) in registry.datasets:
+            registry.count("add_endpoint")
+            with registry.lock:
+                dataset = registry.datasets[match.group(1)]
+                dataset["endpoints"] = dataset["endpoints"] + [body]
+                dataset["modified"] = now()
+            return self.send(201, 1)
+        match = re.fullmatch(r"/v1/dataset/([^/]+)/crawl", self.path)
+        if match and match.group(1) in registry.datasets:
+            registry.count("crawl")
+            return self.send(204, None)
+        self.send(404, None)
+
+    def do_PUT(self):
+        registry = self.registry
+        body = self.read_body()
+        time.sleep(registry.latency)
+        match = re.fullmatch(r"/v1/dataset/([^/]+)", self.path)
+        if match and match.group(1) in registry.datasets:
+            registry.count("revive")
+            with registry.lock:
+                dataset = registry.datasets[match.group(1)]
+                dataset.update(body)
+                if "deleted" not in body:
+                    dataset.pop("deleted", None)
+                dataset["modified"] = now()
+            return self.send(204, None)
+        self.send(404, None)
+
+    def do_DELETE(self):
+        registry = self.registry
+        time.sleep(registry.latency)
+        match = re.fullmatch(r"/v1/dataset/([^/]+)", self.path)
+        if match and match.group(1) in registry.datasets:
+            registry.count("delete")
+            with registry.lock:
+                dataset = registry.datasets[match.group(1)]
+                dataset["deleted"] = dataset["modified"] = now()
+            return self.send(204, None)
+        self.send(404, None)
+
+    def send_page(self, query, datasets, modified=None):
+        if modified:
+            since = modified[0].split(",")[0]
+            datasets = [d for d in datasets if d["modified"] >= since]
+        offset = int(query.get("offset", ["0"])[0])
+        limit = min(int(query.get("limit", ["20"])[0]), self.registry.max_page_size)
+        page = {}
+        page["offset"] = offset
+        page["limit"] = limit
+        page["count"] = len(datasets)
+        page["endOfRecords"] = offset + limit >= len(datasets)
+        page["results"] = datasets[offset:offset + limit]
+        self.send(200, page)
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        content = self.rfile.read(length)
+        return json.loads(content) if content else None
+
+    def send(self, status, body):
+        content = json.dumps(body).encode() if body is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+def dataset_id(i):
+    return f"bench-{i:07d}"
+
+def deleted_dataset_id(i):
+    return f"bench-deleted-{i:07d}"
+
+def now():
+    return time.strftime("%Y-%m-%dT%H:%M:%S.000+0000", time.gmtime())
+
+#
+# Run the fake registry alone (to test an APT server by hand)
+#
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Local stand-in of the GBIF registry API used by APT")
+    parser.add_argument("--port", type=int, default=9090)
+    parser.add_argument("--apt-url", default="http://localhost:8080")
+    parser.add_argument("--publisher-key", default="bench-publisher")
+    parser.add_argument("--published", type=int, default=1000, help="published datasets hosted on the APT")
+    parser.add_argument("--deleted", type=int, default=1000, help="deleted datasets hosted on the APT")
+    parser.add_argument("--latency", type=float, default=0.05, help="latency of each call (seconds)")
+    parser.add_argument("--max-page-size", type=int, default=1000)
+    args = parser.parse_args()
+    registry = FakeRegistry(args.apt_url, args.publisher_key, args.published, args.deleted, args.latency, args.max_page_size)
+    print(f"Fake GBIF registry listening on {registry.start(args.port)}", flush=True)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        sys.exit(0)
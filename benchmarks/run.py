@@ -0,0 +1,339 @@
+import io
+import os
+import sys
+import json
+import time
+import types
+import signal
+import shutil
+import zipfile
+import argparse
+import platform
+import tempfile
+import threading
+import statistics
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+BENCHMARKS_PATH = os.path.dirname(os.path.abspath(__file__))
+REPO_PATH = os.path.dirname(BENCHMARKS_PATH)
+sys.path.insert(0, BENCHMARKS_PATH)
+import fake_registry
+
+PUBLISHER_KEY = "bench-publisher"
+API_KEY = "bench-api-key"
+
+#
+# APT benchmark suite
+#
+# Runs the APT server against a local fake GBIF registry and measures:
+# - startup: catalog rebuild and GBIF registry bootstrap (cold), then
+#   restart with the catalog and the registry snapshot (warm)
+# - GET /dataset (full list, with GBIF information, paged, NDJSON)
+#   for each catalog size
+# - download throughput (concurrent clients)
+# - upload throughput (concurrent clients, distinct archives)
+#
+# Results are written as JSON, to compare runs over time
+#
+def main():
+    parser = argparse.ArgumentParser(description="APT benchmark suite")
+    parser.add_argument("--sizes", default="1000,10000,100000", help="catalog sizes (datasets, published in GBIF)")
+    parser.add_argument("--deleted", type=int, default=1000, help="deleted GBIF datasets hosted on the APT")
+    parser.add_argument("--latency", type=float, default=0.05, help="fake GBIF registry latency (seconds)")
+    parser.add_argument("--max-page-size", type=int, default=1000, help="fake GBIF registry page size")
+    parser.add_argument("--repeat", type=int, default=20, help="requests per measured GET /dataset variant")
+    parser.add_argument("--server-mode", default="production", choices=["production", "development"])
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--download-size-mb", type=float, default=50)
+    parser.add_argument("--download-clients", type=int, default=8)
+    parser.add_argument("--downloads-per-client", type=int, default=4)
+    parser.add_argument("--upload-size-mb", type=float, default=5)
+    parser.add_argument("--upload-clients", type=int, default=8)
+    parser.add_argument("--uploads", type=int, default=64)
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--output", default=os.path.join(BENCHMARKS_PATH, "results", time.strftime("%Y%m%d-%H%M%S") + ".json"))
+    parser.add_argument("--keep", action="store_true", help="keep the data directories")
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        return serve(args.port)
+
+    results = {}
+    results["started"] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    results["environment"] = environment()
+    results["parameters"] = vars(args)
+    results["runs"] = []
+
+    sizes = [int(size) for size in args.sizes.split(",") if size]
+    for i, size in enumerate(sizes):
+        print(f"=== {size} datasets", flush=True)
+        run = {"datasets": size}
+        data_path = tempfile.mkdtemp(prefix=f"apt-bench-{size}-")
+        registry = fake_registry.FakeRegistry(f"http://127.0.0.1:{args.port}", PUBLISHER_KEY, size, args.deleted, args.latency, args.max_page_size)
+        registry_url = registry.start()
+        try:
+            create_datasets(data_path, size)
+            if i == 0:
+                create_archive(data_path, "bench-download", int(args.download_size_mb * 1024 * 1024))
+
+            # Cold start: catalog rebuild and GBIF registry bootstrap
+            server = Server(args, data_path, registry_url)
+            run["startup_cold"] = server.start()
+            run["startup_cold"]["gbif_calls"] = dict(registry.calls)
+            run["list"] = measure_list(server.url, args.repeat)
+            server.stop()
+
+            # Warm start: catalog and registry snapshot already there
+            registry.calls.clear()
+            server = Server(args, data_path, registry_url)
+            run["startup_warm"] = server.start()
+            run["startup_warm"]["gbif_calls"] = dict(registry.calls)
+            if i == 0:
+                run["download"] = measure_download(server.url, args)
+                run["upload"] = measure_upload(server.url, args)
+            server.stop()
+        finally:
+            registry.stop()
+            if not args.keep:
+                shutil.rmtree(data_path, ignore_errors=True)
+        results["runs"].append(run)
+        print(json.dumps(run, indent=2), flush=True)
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}", flush=True)
+
+#
+# APT server process, on a data directory
+#
+class Server:
+
+    def __init__(self, args, data_path, registry_url):
+        self.args = args
+        self.data_path = data_path
+        self.url = f"http://127.0.0.1:{args.port}"
+        self.env = dict(os.environ)
+        self.env.update({
+            "RESOURCES_PATH": data_path + "/",
+            "METRICS_PATH": os.path.join(data_path, ".apt", "metrics") + "/",
+            "APT_PUBLIC_URL": self.url,
+            "GBIF_REGISTRY_URL": registry_url,
+            "PUBLISHER_KEY": PUBLISHER_KEY,
+            "INSTALLATION_KEY": "bench-installation",
+            "GBIF_REGISTRY_LOGIN": "bench",
+            "GBIF_REGISTRY_PASSWORD": "bench",
+            "API_KEY": API_KEY,
+            "SERVER_MODE": args.server_mode,
+            "SERVER_WORKERS": str(args.workers),
+            "SERVER_THREADS": str(args.threads),
+            "LOG_LEVEL": "WARNING"
+        })
+
+    #
+    # Start the server, return the startup measures
+    #
+    def start(self):
+        start = time.perf_counter()
+        os.makedirs(os.path.join(self.data_path, ".apt"), exist_ok=True)
+        self.log = open(os.path.join(self.data_path, ".apt", "server.log"), "a")
+        self.process = subprocess.Popen([sys.executable, __file__, "--serve", "--port", str(self.args.port)],
+            env=self.env, stdout=self.log, stderr=subprocess.STDOUT, start_new_session=True)
+        while True:
+            if self.process.poll() is not None:
+                raise Exception(f"APT server exited, see {self.log.name}")
+            try:
+                if requests.get(self.url + "/dataset?limit=1", timeout=1).status_code == 200:
+                    break
+            except requests.RequestException:
+                pass
+            time.sleep(0.05)
+        startup = {}
+        startup["seconds"] = time.perf_counter() - start
+        metrics = read_metrics(self.url)
+        startup["registry_refresh_seconds"] = metrics.get("apt_registry_refresh_duration_seconds")
+        startup["gbif_pages"] = sum(value for name, value in metrics.items() if name.startswith("apt_gbif_pages_total"))
+        print(f"APT server started in {startup['seconds']:.2f}s", flush=True)
+        return startup
+
+    def stop(self):
+        # Quick shutdown (no wait for the idle keep-alive connections)
+        os.killpg(self.process.pid, signal.SIGINT)
+        self.process.wait(60)
+        self.log.close()
+
+#
+# Run the APT server (called in the server process)
+#
+def serve(port):
+    # The apt.py script shadows the apt package at the repository root
+    package = types.ModuleType("apt")
+    package.__path__ = [os.path.join(REPO_PATH, "apt")]
+    sys.modules["apt"] = package
+    sys.path.insert(0, REPO_PATH)
+    os.chdir(REPO_PATH)
+    import apt.services.log as apt_log
+    import apt.services.config as CONFIG
+    apt_log.setup()
+    if CONFIG.SERVER_MODE == "development":
+        import apt.defaultserver as apt_default_server
+        apt_default_server.create_server("apt", str(port))
+    else:
+        import apt.productionserver as apt_production_server
+        apt_production_server.create_server("apt", str(port))
+
+###################################
+#
+#   Measures
+#
+###################################
+
+def measure_list(url, repeat):
+    session = requests.Session()
+    measures = {}
+    for name, path in [("full", "/dataset"), ("gbif", "/dataset?gbif=true"), ("page", "/dataset?limit=1000&prefix=bench"), ("ndjson", "/dataset?format=ndjson")]:
+        durations = []
+        size = 0
+        for i in range(repeat + 1):
+            start = time.perf_counter()
+            response = session.get(url + path)
+            content = response.content
+            response.raise_for_status()
+            # First request not measured (cache warm up)
+            if i > 0:
+                durations.append(time.perf_counter() - start)
+            size = len(content)
+        measures[name] = summarize(durations)
+        measures[name]["bytes"] = size
+        print(f"GET {path}: median {measures[name]['median'] * 1000:.1f}ms", flush=True)
+    return measures
+
+def measure_download(url, args):
+    def download(client):
+        session = requests.Session()
+        durations = []
+        received = 0
+        for i in range(args.downloads_per_client):
+            start = time.perf_counter()
+            with session.get(url + "/dataset/bench-download", stream=True) as response:
+                response.raise_for_status()
+                for chunk in response.iter_content(1024 * 1024):
+                    received += len(chunk)
+            durations.append(time.perf_counter() - start)
+        return durations, received
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.download_clients) as executor:
+        outcomes = list(executor.map(download, range(args.download_clients)))
+    elapsed = time.perf_counter() - start
+    measures = summarize([duration for durations, received in outcomes for duration in durations])
+    total = sum(received for durations, received in outcomes)
+    measures["clients"] = args.download_clients
+    measures["bytes"] = total
+    measures["mb_per_second"] = total / elapsed / 1024 / 1024
+    print(f"Download: {measures['mb_per_second']:.1f} MB/s", flush=True)
+    return measures
+
+def measure_upload(url, args):
+    size = int(args.upload_size_mb * 1024 * 1024)
+    archives = [archive_content(f"bench-upload-{i:05d}", size) for i in range(args.uploads)]
+    def upload(i):
+        session = upload.sessions.setdefault(threading.get_ident(), requests.Session())
+        start = time.perf_counter()
+        response = session.post(url + f"/dataset/bench-upload-{i:05d}", headers={"X-API-Key": API_KEY},
+            files={"file": (f"bench-upload-{i:05d}.zip", archives[i])})
+        response.raise_for_status()
+        return time.perf_counter() - start
+    upload.sessions = {}
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.upload_clients) as executor:
+        durations = list(executor.map(upload, range(args.uploads)))
+    elapsed = time.perf_counter() - start
+    measures = summarize(durations)
+    measures["clients"] = args.upload_clients
+    measures["uploads_per_second"] = args.uploads / elapsed
+    measures["mb_per_second"] = args.uploads * size / elapsed / 1024 / 1024
+    print(f"Upload: {measures['uploads_per_second']:.1f} uploads/s, {measures['mb_per_second']:.1f} MB/s", flush=True)
+    return measures
+
+###################################
+#
+#   Internal Functions
+#
+###################################
+
+#
+# Create the dataset files of the published datasets, as stored by APT
+#
+def create_datasets(data_path, count):
+    content = archive_content("sample", 1024)
+    for i in range(count):
+        with open(dataset_path(data_path, fake_registry.dataset_id(i)), "wb") as f:
+            f.write(content)
+
+def create_archive(data_path, id, size):
+    with open(dataset_path(data_path, id), "wb") as f:
+        f.write(archive_content(id, size))
+
+# Path of a dataset file in the default storage layout (a/b/c/abc.zip)
+def dataset_path(data_path, id):
+    directory = os.path.join(data_path, id[0], id[1], id[2])
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, id + ".zip")
+
+#
+# Darwin Core Archive of about size bytes (random, stored data file)
+#
+def archive_content(id, size):
+    meta = ('<archive xmlns="http://rs.tdwg.org/dwc/text/" metadata="eml.xml">'
+        '<core rowType="http://rs.tdwg.org/dwc/terms/Occurrence"><files><location>occurrence.txt</location></files><id index="0"/></core>'
+        '</archive>')
+    eml = ('<eml:eml xmlns:eml="eml://ecoinformatics.org/eml-2.1.1"><dataset>'
+        f'<title>Benchmark dataset {id}</title><abstract><para>Benchmark dataset</para></abstract><language>eng</language>'
+        '</dataset></eml:eml>')
+    content = io.BytesIO()
+    with zipfile.ZipFile(content, "w", zipfile.ZIP_STORED) as archive:
+        archive.writestr("meta.xml", meta)
+        archive.writestr("eml.xml", eml)
+        data_size = max(size - 1024, 0)
+        archive.writestr("occurrence.txt", b"id\n" + os.urandom((data_size + 1) // 2).hex().encode()[:data_size])
+    return content.getvalue()
+
+#
+# Read the metrics of the APT server (name with labels -> value)
+#
+def read_metrics(url):
+    metrics = {}
+    for line in requests.get(url + "/metrics").text.splitlines():
+        if line and not line.startswith("#"):
+            name, value = line.rsplit(" ", 1)
+            metrics[name] = float(value)
+    return metrics
+
+def summarize(durations):
+    durations = sorted(durations)
+    summary = {}
+    summary["count"] = len(durations)
+    summary["min"] = durations[0]
+    summary["median"] = statistics.median(durations)
+    summary["p95"] = durations[min(len(durations) - 1, int(len(durations) * 0.95))]
+    summary["max"] = durations[-1]
+    summary["mean"] = statistics.mean(durations)
+    return summary
+
+def environment():
+    env = {}
+    env["python"] = platform.python_version()
+    env["platform"] = platform.platform()
+    env["cpus"] = os.cpu_count()
+    try:
+        env["commit"] = subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_PATH, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        env["commit"] = None
+    return env
+
+if __name__ == '__main__':
+    main()
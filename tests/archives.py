@@ -0,0 +1,25 @@
+import io
+import zipfile
+
+META = ('<archive xmlns="http://rs.tdwg.org/dwc/text/" metadata="eml.xml">'
+    '<core rowType="http://rs.tdwg.org/dwc/terms/Occurrence"><files><location>occurrence.txt</location></files><id index="0"/></core>'
+    '</archive>')
+
+EML = ('<eml:eml xmlns:eml="eml://ecoinformatics.org/eml-2.1.1"><dataset>'
+    '<title xml:lang="en">{title}</title><language>{language}</language>'
+    '<abstract><para>Test dataset.</para></abstract>'
+    '</dataset></eml:eml>')
+
+#
+# Darwin Core Archive of a test dataset (same content for the same arguments)
+#
+def dwca(records="1", title="Test dataset", language="eng"):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as archive:
+        archive.writestr(zipfile.ZipInfo("meta.xml", (2026, 1, 1, 0, 0, 0)), META)
+        archive.writestr(zipfile.ZipInfo("eml.xml", (2026, 1, 1, 0, 0, 0)), EML.format(title=title, language=language))
+        archive.writestr(zipfile.ZipInfo("occurrence.txt", (2026, 1, 1, 0, 0, 0)), "id\n" + records + "\n")
+    return buffer.getvalue()
+
+def upload(client, id, content):
+    return client.post("/dataset/" + id, data={"file": (io.BytesIO(content), id + ".zip")})
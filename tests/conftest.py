@@ -0,0 +1,103 @@
+import os
+import sys
+import json
+import types
+import pytest
+import functools
+
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The apt.py script shadows the apt package at the repository root
+package = types.ModuleType("apt")
+package.__path__ = [os.path.join(REPO_PATH, "apt")]
+sys.modules["apt"] = package
+
+sys.path.insert(0, os.path.join(REPO_PATH, "benchmarks"))
+import fake_registry
+
+import apt.services.config as CONFIG
+import apt.services.registry as apt_registry
+import apt.defaultserver as apt_server
+
+API_KEY = "key"
+
+#
+# Storage and state of APT in a temporary directory, for every test
+#
+@pytest.fixture(autouse=True)
+def config(tmp_path, monkeypatch):
+    resources_path = os.path.join(str(tmp_path), "data", "")
+    state_path = os.path.join(resources_path, ".apt", "")
+    settings = {
+        "RESOURCES_PATH": resources_path,
+        "STATE_PATH": state_path,
+        "CATALOG_PATH": state_path + "catalog.db",
+        "BLOBS_PATH": state_path + "blobs/",
+        "STAGING_PATH": state_path + "staging/",
+        "JOBS_PATH": state_path + "jobs.db",
+        "LEADER_LOCK_PATH": state_path + "leader.lock",
+        "REGISTRY_SNAPSHOT_PATH": state_path + "registry.json",
+        "METRICS_PATH": os.path.join(str(tmp_path), "metrics", ""),
+        "APT_PUBLIC_URL": "http://apt",
+        "PUBLISHER_KEY": "publisher",
+        "INSTALLATION_KEY": "installation",
+        "GBIF_REGISTRY_LOGIN": "login",
+        "GBIF_REGISTRY_PASSWORD": "password",
+        "SECURITY_APY_KEY": API_KEY,
+        "CRAWL_COALESCE_WINDOW": 0
+    }
+    for name, value in settings.items():
+        monkeypatch.setattr(CONFIG, name, value)
+    os.makedirs(state_path)
+
+@pytest.fixture
+def registry():
+    # Started from a snapshot, without calling the GBIF registry
+    snapshot = {
+        "apt_public_url": "http://apt",
+        "publisher_key": "publisher",
+        "published": {},
+        "deleted": {}
+    }
+    with open(CONFIG.REGISTRY_SNAPSHOT_PATH, "w") as f:
+        json.dump(snapshot, f)
+    return apt_registry.Registry()
+
+#
+# Local stand-in of the GBIF registry (benchmarks/fake_registry.py)
+#
+@pytest.fixture
+def gbif(monkeypatch):
+    fake = fake_registry.FakeRegistry("http://apt", "publisher")
+    monkeypatch.setattr(CONFIG, "GBIF_REGISTRY_URL", fake.start())
+    yield fake
+    fake.stop()
+
+#
+# APT application, without its background services: the GBIF registry
+# jobs are run by run_jobs
+#
+@pytest.fixture
+def app(gbif):
+    return apt_server.create_app("apt-test")
+
+#
+# Test client closing the responses (and so releasing their admission
+# slots) once read, as the WSGI server does
+#
+@pytest.fixture
+def client(app):
+    client = app.test_client()
+    client.environ_base["HTTP_X_API_KEY"] = API_KEY
+    client.open = functools.partial(client.open, buffered=True)
+    return client
+
+@pytest.fixture
+def run_jobs(app):
+    jobs = app.extensions["apt.jobs"]
+    def run():
+        job = jobs.claim()
+        while job:
+            jobs.execute(job)
+            job = jobs.claim()
+    return run
@@ -0,0 +1,91 @@
+import io
+import runpy
+import pytest
+from werkzeug.wsgi import FileWrapper
+import apt.services.config as CONFIG
+import apt.services.admission as apt_admission
+import apt.defaultserver as apt_server
+from archives import dwca, upload
+from conftest import API_KEY
+
+#
+# Every endpoint but the home page and the metrics is under admission control
+#
+def test_endpoints_have_a_traffic_class(app):
+    endpoints = set(rule.endpoint for rule in app.url_map.iter_rules())
+    assert endpoints - set(apt_server.TRAFFIC_CLASSES) == {"home", "get_metrics", "static"}
+
+#
+# The default concurrency limits share the server threads, one being left
+# for the other endpoints
+#
+@pytest.mark.parametrize("threads", [8, 16, 32])
+def test_default_concurrency_within_threads(monkeypatch, threads):
+    for name in ("ADMISSION_DOWNLOAD_CONCURRENCY", "ADMISSION_UPLOAD_CONCURRENCY", "ADMISSION_ADMIN_CONCURRENCY"):
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setenv("SERVER_THREADS", str(threads))
+    config = runpy.run_path(CONFIG.__file__)
+    limits = [config["ADMISSION_DOWNLOAD_CONCURRENCY"], config["ADMISSION_UPLOAD_CONCURRENCY"], config["ADMISSION_ADMIN_CONCURRENCY"]]
+    assert min(limits) >= 1
+    assert sum(limits) == threads - 1
+
+@pytest.fixture
+def limited_client(gbif, monkeypatch):
+    monkeypatch.setattr(CONFIG, "ADMISSION_DOWNLOAD_CONCURRENCY", 1)
+    monkeypatch.setattr(CONFIG, "ADMISSION_ADMIN_CONCURRENCY", 1)
+    client = apt_server.create_app("apt-test").test_client()
+    client.environ_base["HTTP_X_API_KEY"] = API_KEY
+    return client
+
+#
+# The slot of a download is released once the response is closed (sent),
+# not when the view returns
+#
+def test_slot_released_on_response_close(limited_client):
+    upload(limited_client, "dataset1", dwca()).close()
+    download = limited_client.get("/dataset/dataset1")
+    response = limited_client.get("/dataset/dataset1")
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+    assert download.data == dwca()
+    download.close()
+    response = limited_client.get("/dataset/dataset1")
+    assert response.status_code == 200
+    response.close()
+
+def test_slot_released_after_streamed_list(limited_client):
+    for id in ["dataset1", "dataset2"]:
+        upload(limited_client, id, dwca()).close()
+    stream = limited_client.get("/dataset?format=ndjson")
+    assert next(stream.response) == b'{"id": "dataset1", "url": "http://apt/dataset/dataset1"}\n'
+    assert limited_client.get("/dataset/dataset1/versions").status_code == 503
+    stream.close()
+    response = limited_client.get("/dataset/dataset1/versions")
+    assert response.status_code == 200
+    response.close()
+
+#
+# File responses sent with the server file wrapper also release their slot
+#
+def test_slot_released_with_file_wrapper():
+    released = []
+    def app(environ, start_response):
+        environ[apt_admission.ON_CLOSE].append(lambda: released.append(True))
+        start_response("200 OK", [])
+        return environ["wsgi.file_wrapper"](io.BytesIO(b"content"))
+    environ = {"wsgi.file_wrapper": FileWrapper}
+    iterable = apt_admission.OnCloseMiddleware(app)(environ, lambda status, headers: None)
+    assert isinstance(iterable, FileWrapper)
+    assert b"".join(iterable) == b"content"
+    assert not released
+    iterable.close()
+    assert released == [True]
+
+def test_rate_limit(gbif, monkeypatch):
+    monkeypatch.setattr(CONFIG, "ADMISSION_ADMIN_RATE", 0.1)
+    monkeypatch.setattr(CONFIG, "ADMISSION_ADMIN_BURST", 1)
+    client = apt_server.create_app("apt-test").test_client()
+    assert client.get("/report/registered").status_code == 200
+    response = client.get("/report/registered")
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "10"
@@ -0,0 +1,77 @@
+import os
+import zipfile
+import pytest
+import apt.services.archive as apt_archive
+from archives import dwca, upload
+
+def test_gbif_language():
+    assert apt_archive.gbif_language("eng") == "eng"
+    assert apt_archive.gbif_language("en_US") == "eng"
+    assert apt_archive.gbif_language("fre") == "fra"
+    assert apt_archive.gbif_language("English") == "eng"
+    assert apt_archive.gbif_language(" Français ") == "fra"
+    assert apt_archive.gbif_language("Klingon") is None
+    assert apt_archive.gbif_language(None) is None
+
+def write_zip(path, members, compression=zipfile.ZIP_STORED):
+    with zipfile.ZipFile(path, "w", compression) as archive:
+        for name, content in members.items():
+            archive.writestr(name, content)
+    return path
+
+#
+# A member is read from its local header, stored or compressed
+#
+@pytest.mark.parametrize("compression", [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED])
+def test_open_member(tmp_path, compression):
+    content = b"id\n" + b"1\n" * 100000
+    path = write_zip(str(tmp_path / "archive.zip"), {"meta.xml": b"<archive/>", "occurrence.txt": content}, compression)
+    members = apt_archive.list_members(path)
+    assert [info.filename for info in members] == ["meta.xml", "occurrence.txt"]
+    with apt_archive.open_member(path, members[1]) as member:
+        assert member.read() == content
+
+def test_open_member_invalid(tmp_path):
+    path = write_zip(str(tmp_path / "archive.zip"), {"occurrence.txt": b"id\n"})
+    info = apt_archive.list_members(path)[0]
+    info.header_offset += 1
+    with pytest.raises(apt_archive.ArchiveError):
+        apt_archive.open_member(path, info)
+    info.header_offset -= 1
+    info.flag_bits |= 0x1
+    with pytest.raises(apt_archive.ArchiveError):
+        apt_archive.open_member(path, info)
+    with open(str(tmp_path / "other.zip"), "wb") as f:
+        f.write(b"not a zip file")
+    with pytest.raises(apt_archive.ArchiveError):
+        apt_archive.list_members(str(tmp_path / "other.zip"))
+
+#
+# The central directory is read again once the file is replaced
+#
+def test_index_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(apt_archive, "index_cache", apt_archive.IndexCache(1))
+    path = write_zip(str(tmp_path / "archive.zip"), {"a.txt": b"a"})
+    other_path = write_zip(str(tmp_path / "other.zip"), {"b.txt": b"b"})
+    members = apt_archive.list_members(path)
+    assert apt_archive.list_members(path) is members
+    write_zip(path + ".new", {"a.txt": b"a", "c.txt": b"c"})
+    os.replace(path + ".new", path)
+    assert [info.filename for info in apt_archive.list_members(path)] == ["a.txt", "c.txt"]
+    # Least recently used entry evicted
+    apt_archive.list_members(other_path)
+    assert list(apt_archive.index_cache.entries) == [other_path]
+
+def test_dataset_files(client):
+    upload(client, "dataset1", dwca("1"))
+    files = client.get("/dataset/dataset1/files").json
+    assert [file["name"] for file in files] == ["meta.xml", "eml.xml", "occurrence.txt"]
+    assert files[2]["size"] == len("id\n1\n")
+    assert files[2]["modified"] == "2026-01-01T00:00:00"
+    assert files[2]["url"] == "http://apt/dataset/dataset1/files/occurrence.txt"
+    response = client.get("/dataset/dataset1/files/occurrence.txt")
+    assert response.data == b"id\n1\n"
+    assert response.mimetype == "text/plain"
+    assert client.get("/dataset/dataset1/files/occurrence.txt", headers={"If-None-Match": response.headers["ETag"]}).status_code == 304
+    assert client.get("/dataset/dataset1/files/other.txt").status_code == 404
+    assert client.get("/dataset/dataset2/files").status_code == 404
@@ -0,0 +1,63 @@
+import io
+import os
+import apt.services.config as CONFIG
+from archives import dwca, upload
+
+def results_by_id(response):
+    return dict((result["id"], result) for result in response.json["results"])
+
+#
+# Multipart bulk upload: each file is stored or reported in error, without
+# failing the others
+#
+def test_bulk_upload(client, run_jobs, gbif):
+    upload(client, "dataset1", dwca())
+    files = [
+        (io.BytesIO(dwca()), "dataset1.zip"),
+        (io.BytesIO(dwca("2")), "dataset2.zip"),
+        (io.BytesIO(b"not a zip file"), "dataset3.zip"),
+        (io.BytesIO(dwca()), "dataset4.txt")
+    ]
+    response = client.post("/bulk/dataset", data={"file": files})
+    assert response.status_code == 200
+    assert response.json["summary"] == {"unchanged": 1, "stored": 1, "error": 2}
+    results = results_by_id(response)
+    assert results["dataset1"]["status"] == "unchanged"
+    assert results["dataset2"]["status"] == "stored"
+    assert results["dataset2"]["job_url"]
+    assert results["dataset3"]["status"] == "error"
+    assert results["dataset4.txt"]["error"] == "invalid dataset file name"
+    assert client.get("/dataset/dataset2").data == dwca("2")
+    assert client.get("/dataset/dataset3").status_code == 404
+    run_jobs()
+    assert gbif.calls.get("register") == 2
+
+def test_bulk_upload_staged(client):
+    os.makedirs(CONFIG.STAGING_PATH)
+    with open(os.path.join(CONFIG.STAGING_PATH, "dataset1.zip"), "wb") as f:
+        f.write(dwca())
+    response = client.post("/bulk/dataset", json={"ids": ["dataset1", "dataset2", "a/b", "dataset1"]})
+    results = results_by_id(response)
+    assert results["dataset1"]["status"] == "stored"
+    assert results["dataset2"]["error"] == "dataset file not found in staging area"
+    assert results["a/b"]["error"] == "invalid dataset id"
+    assert len(response.json["results"]) == 3
+    assert not os.path.exists(os.path.join(CONFIG.STAGING_PATH, "dataset1.zip"))
+    assert client.get("/dataset/dataset1").data == dwca()
+
+def test_bulk_delete(client, run_jobs, gbif):
+    upload(client, "dataset1", dwca())
+    run_jobs()
+    response = client.delete("/bulk/dataset", json={"ids": ["dataset1", "dataset2", "a/b"]})
+    assert response.json["summary"] == {"deleted": 1, "error": 2}
+    results = results_by_id(response)
+    assert results["dataset1"]["job_url"]
+    assert results["dataset2"]["error"] == "dataset not found"
+    assert results["a/b"]["error"] == "invalid dataset id"
+    assert client.get("/dataset/dataset1").status_code == 404
+    run_jobs()
+    assert gbif.calls.get("delete") == 1
+
+def test_bulk_invalid_manifest(client):
+    assert client.delete("/bulk/dataset", json={"id": "dataset1"}).status_code == 400
+    assert client.post("/bulk/dataset", json=["dataset1"]).status_code == 400
@@ -0,0 +1,77 @@
+import os
+import hashlib
+import threading
+import pytest
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import apt.services.config as CONFIG
+import apt.services.catalog as apt_catalog
+import apt.services.cluster as apt_cluster
+import apt.services.dataset as apt_dataset
+from archives import dwca
+
+#
+# Peer node sending the given dataset contents (id -> content)
+#
+@pytest.fixture
+def peer():
+    contents = {}
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+        def do_GET(self):
+            content = contents[self.path.rsplit("/", 1)[-1]]
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    server.contents = contents
+    server.url = f"http://127.0.0.1:{server.server_port}"
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def cluster(tmp_path):
+    return apt_cluster.Cluster(str(tmp_path / "cluster.db"))
+
+def store(id, content):
+    upload = apt_dataset.DatasetUpload(id)
+    try:
+        upload.write(content)
+        upload.commit()
+    finally:
+        upload.discard()
+    return upload.hexdigest()
+
+#
+# A pulled dataset gets the modification date of the catalog, without
+# changing the one of the datasets of this node with the same content
+#
+def test_pull_keeps_local_datasets_with_same_content(cluster, peer, tmp_path):
+    catalog = apt_catalog.Catalog(str(tmp_path / "catalog.db"))
+    shared = dwca("1")
+    shared_checksum = store("dataset1", shared)
+    os.utime(apt_dataset.get_path("dataset1"), (1000, 1000))
+    catalog.add("dataset1", apt_dataset.get_path("dataset1"), shared_checksum)
+
+    new = dwca("2")
+    peer.contents["dataset2"] = shared
+    peer.contents["dataset3"] = new
+    cluster.pull_from(peer.url, "dataset2", {"checksum": shared_checksum, "mtime": 2000})
+    cluster.pull_from(peer.url, "dataset3", {"checksum": hashlib.sha256(new).hexdigest(), "mtime": 3000})
+
+    assert os.stat(apt_dataset.get_path("dataset1")).st_mtime == 1000
+    assert os.stat(apt_dataset.get_path("dataset3")).st_mtime == 3000
+    assert cluster.holds("dataset2", shared_checksum)
+
+#
+# The stores shared by the nodes do not use the WAL mode (single host only)
+#
+def test_shared_stores_journal_mode(tmp_path, monkeypatch):
+    monkeypatch.setattr(CONFIG, "CLUSTER_PATH", str(tmp_path / "shared") + os.sep)
+    shared = apt_catalog.Catalog(str(tmp_path / "shared" / "catalog.db"))
+    local = apt_catalog.Catalog(str(tmp_path / "local" / "catalog.db"))
+    assert shared.connection().execute("PRAGMA journal_mode").fetchone()[0] == "delete"
+    assert local.connection().execute("PRAGMA journal_mode").fetchone()[0] == "wal"
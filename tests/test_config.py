@@ -0,0 +1,37 @@
+import runpy
+import apt.services.config as CONFIG
+
+PATH_SETTINGS = ["RESOURCES_PATH", "STATE_PATH", "CLUSTER_PATH", "COLD_STORAGE_PATH", "COLD_BLOBS_PATH", "BLOBS_PATH", "STAGING_PATH",
+    "CATALOG_PATH", "JOBS_PATH", "LEADER_LOCK_PATH", "CLUSTER_DB_PATH", "REGISTRY_SNAPSHOT_PATH"]
+
+#
+# Settings read from the given environment variables
+#
+def load_config(monkeypatch, **environment):
+    for name in PATH_SETTINGS:
+        monkeypatch.delenv(name, raising=False)
+    for name, value in environment.items():
+        monkeypatch.setenv(name, value)
+    return runpy.run_path(CONFIG.__file__)
+
+def test_directories_without_separator(monkeypatch):
+    config = load_config(monkeypatch, RESOURCES_PATH="/data", STATE_PATH="/data/.apt", COLD_STORAGE_PATH="/mnt/cold")
+    assert config["RESOURCES_PATH"] == "/data/"
+    assert config["BLOBS_PATH"] == "/data/.apt/blobs/"
+    assert config["STAGING_PATH"] == "/data/.apt/staging/"
+    assert config["LEADER_LOCK_PATH"] == "/data/.apt/leader.lock"
+    assert config["CATALOG_PATH"] == "/data/.apt/catalog.db"
+    assert config["COLD_STORAGE_PATH"] == "/mnt/cold/"
+    assert config["COLD_BLOBS_PATH"] == "/mnt/cold/.blobs/"
+
+def test_state_in_resources(monkeypatch):
+    config = load_config(monkeypatch, RESOURCES_PATH="/data")
+    assert config["STATE_PATH"] == "/data/.apt/"
+    assert config["JOBS_PATH"] == "/data/.apt/jobs.db"
+
+def test_cluster_shared_state(monkeypatch):
+    config = load_config(monkeypatch, CLUSTER_PATH="/mnt/shared")
+    assert config["CATALOG_PATH"] == "/mnt/shared/catalog.db"
+    assert config["CLUSTER_DB_PATH"] == "/mnt/shared/cluster.db"
+    assert config["REGISTRY_SNAPSHOT_PATH"] == "/mnt/shared/registry.json"
+    assert config["LEADER_LOCK_PATH"] == "/usr/data/.apt/leader.lock"
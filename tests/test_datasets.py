@@ -0,0 +1,96 @@
+import json
+import hashlib
+from archives import dwca, upload
+
+IDS = ["aaa1", "aaa2", "aaa3", "bbb1", "bbb2"]
+
+def store_datasets(client):
+    for id in IDS:
+        assert upload(client, id, dwca()).status_code == 202
+
+def test_list_all(client):
+    store_datasets(client)
+    response = client.get("/dataset")
+    assert [dataset["id"] for dataset in response.json] == IDS
+    assert response.json[0]["url"] == "http://apt/dataset/aaa1"
+
+def test_list_prefix(client):
+    store_datasets(client)
+    response = client.get("/dataset?prefix=aaa")
+    assert [dataset["id"] for dataset in response.json] == ["aaa1", "aaa2", "aaa3"]
+
+#
+# Cursor paging: each page gives the cursor of the next one, until the
+# last (incomplete) page
+#
+def test_list_cursor_pages(client):
+    store_datasets(client)
+    ids = []
+    cursor = ""
+    while True:
+        response = client.get("/dataset?limit=2&cursor=" + cursor)
+        ids += [dataset["id"] for dataset in response.json]
+        if "X-Next-Cursor" not in response.headers:
+            break
+        cursor = response.headers["X-Next-Cursor"]
+    assert ids == IDS
+    assert client.get("/dataset?prefix=bbb&cursor=bbb1").json == [{"id": "bbb2", "url": "http://apt/dataset/bbb2"}]
+
+def test_list_offset(client):
+    store_datasets(client)
+    response = client.get("/dataset?offset=1&limit=2")
+    assert [dataset["id"] for dataset in response.json] == ["aaa2", "aaa3"]
+
+def test_list_invalid_parameters(client):
+    assert client.get("/dataset?limit=-1").status_code == 400
+    assert client.get("/dataset?prefix=../aaa").status_code == 400
+
+def test_list_ndjson(client):
+    store_datasets(client)
+    response = client.get("/dataset?format=ndjson&prefix=aaa")
+    assert response.mimetype == "application/x-ndjson"
+    assert [json.loads(line)["id"] for line in response.get_data(as_text=True).splitlines()] == ["aaa1", "aaa2", "aaa3"]
+    response = client.get("/dataset?limit=1", headers={"Accept": "application/x-ndjson"})
+    assert response.get_data(as_text=True) == json.dumps({"id": "aaa1", "url": "http://apt/dataset/aaa1"}) + "\n"
+
+def test_list_registered(client, run_jobs):
+    store_datasets(client)
+    run_jobs()
+    response = client.get("/dataset?gbif=true&prefix=bbb")
+    assert len(response.json) == 2
+    assert all(dataset["registered"] and dataset["gbif_key"] for dataset in response.json)
+
+#
+# Conditional downloads: the ETag is the dataset checksum, Range requests
+# are served
+#
+def test_download_etag(client):
+    content = dwca()
+    upload(client, "dataset1", content)
+    response = client.get("/dataset/dataset1")
+    assert response.data == content
+    assert response.headers["Accept-Ranges"] == "bytes"
+    etag = response.headers["ETag"]
+    last_modified = response.headers["Last-Modified"]
+    assert etag == '"' + hashlib.sha256(content).hexdigest() + '"'
+    response = client.get("/dataset/dataset1", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert not response.data
+    response = client.get("/dataset/dataset1", headers={"If-Modified-Since": last_modified})
+    assert response.status_code == 304
+    upload(client, "dataset1", dwca("2"))
+    assert client.get("/dataset/dataset1", headers={"If-None-Match": etag}).status_code == 200
+
+def test_download_range(client):
+    content = dwca()
+    upload(client, "dataset1", content)
+    response = client.get("/dataset/dataset1", headers={"Range": "bytes=10-19"})
+    assert response.status_code == 206
+    assert response.data == content[10:20]
+    assert response.headers["Content-Range"] == f"bytes 10-19/{len(content)}"
+    response = client.get("/dataset/dataset1", headers={"Range": f"bytes={len(content)}-"})
+    assert response.status_code == 416
+
+def test_download_missing(client):
+    assert client.get("/dataset/dataset1").status_code == 404
+    assert client.get("/dataset/a").status_code == 400
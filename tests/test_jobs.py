@@ -0,0 +1,84 @@
+import pytest
+import requests
+import apt.services.config as CONFIG
+import apt.services.jobs as apt_jobs
+
+#
+# Only the running jobs of stopped processes are executed again: the jobs
+# of this process and of the processes of other nodes alive are kept
+#
+def test_requeue_abandoned_keeps_jobs_of_alive_holders(tmp_path):
+    jobs = apt_jobs.JobQueue({}, path=str(tmp_path / "jobs.db"), is_alive=lambda holder: holder == "node2/20")
+    holders = {
+        "own": apt_jobs.job_holder(),
+        "alive": "node2/20",
+        "dead": "node2/21",
+        "local": f"{CONFIG.NODE_ID}/0",
+        "unknown": None
+    }
+    for dataset_id in holders:
+        jobs.enqueue("update", dataset_id)
+    with jobs.connection() as connection:
+        for dataset_id, holder in holders.items():
+            connection.execute("UPDATE jobs SET status = 'running', holder = ? WHERE dataset_id = ?", (holder, dataset_id))
+
+    jobs.requeue_abandoned()
+
+    statuses = dict((row["dataset_id"], row["status"]) for row in jobs.connection().execute("SELECT dataset_id, status FROM jobs"))
+    assert statuses == {"own": "running", "alive": "running", "dead": "pending", "local": "pending", "unknown": "pending"}
+
+def http_error(status):
+    response = requests.Response()
+    response.status_code = status
+    return requests.HTTPError(f"{status} error", response=response)
+
+@pytest.fixture
+def queue(tmp_path, monkeypatch):
+    monkeypatch.setattr(CONFIG, "JOB_RETRY_DELAY", 0)
+    monkeypatch.setattr(CONFIG, "JOB_MAX_ATTEMPTS", 3)
+    errors = {}
+    def update(dataset_id):
+        if dataset_id in errors:
+            raise errors[dataset_id]
+        return {}
+    queue = apt_jobs.JobQueue({"update": update}, path=str(tmp_path / "jobs.db"))
+    queue.errors = errors
+    return queue
+
+def run(queue):
+    job = queue.claim()
+    while job:
+        queue.execute(job)
+        job = queue.claim()
+
+#
+# A request rejected by the GBIF registry is not retried, and the next jobs
+# of the dataset are run
+#
+def test_rejected_job_fails(queue):
+    queue.errors["dataset1"] = http_error(400)
+    rejected = queue.enqueue("update", "dataset1")
+    queue.execute(queue.claim())
+    del queue.errors["dataset1"]
+    next_job = queue.enqueue("update", "dataset1")
+    run(queue)
+    assert queue.get(rejected["id"])["status"] == "failed"
+    assert queue.get(rejected["id"])["attempts"] == 1
+    assert queue.get(next_job["id"])["status"] == "done"
+    assert [job["id"] for job in queue.list_failed()] == [rejected["id"]]
+
+def test_failed_job_is_retried(queue):
+    for error in (http_error(503), http_error(429), Exception("connection lost")):
+        queue.errors["dataset1"] = error
+        job = queue.enqueue("update", "dataset1")
+        queue.execute(queue.claim())
+        assert queue.get(job["id"])["status"] == "pending"
+        del queue.errors["dataset1"]
+        run(queue)
+
+def test_job_fails_after_max_attempts(queue):
+    queue.errors["dataset1"] = http_error(500)
+    job = queue.enqueue("update", "dataset1")
+    run(queue)
+    assert queue.get(job["id"])["status"] == "failed"
+    assert queue.get(job["id"])["attempts"] == 3
@@ -0,0 +1,76 @@
+import os
+import pytest
+import apt.services.config as CONFIG
+import apt.services.dataset as apt_dataset
+
+def test_layout_paths():
+    root = CONFIG.RESOURCES_PATH
+    assert apt_dataset.Layout(3, 1).get_path("abcdef") == root + "a/b/c/abcdef.zip"
+    assert apt_dataset.Layout(2, 2).get_path("abcdef") == root + "ab/cd/abcdef.zip"
+    assert apt_dataset.Layout(0, 1).get_path("abcdef") == root + "abcdef.zip"
+    # Short ids are padded, ".." directories replaced
+    assert apt_dataset.Layout(2, 2).get_path("abc") == root + "ab/c_/abc.zip"
+    assert apt_dataset.Layout(1, 2).get_path("...") == root + "__/....zip"
+    assert str(apt_dataset.parse_layout("2x2")) == "2x2"
+    assert apt_dataset.parse_layout("") is None
+    with pytest.raises(ValueError):
+        apt_dataset.Layout(1, 0)
+
+#
+# Dataset files stored with the 3x1 layout, moved to the 2x2 one
+#
+@pytest.fixture
+def migration(monkeypatch):
+    monkeypatch.setattr(CONFIG, "DATASET_MIGRATION_RATE", 0)
+    monkeypatch.setattr(apt_dataset, "layout", apt_dataset.Layout(2, 2))
+    monkeypatch.setattr(apt_dataset, "previous_layout", apt_dataset.Layout(3, 1))
+    paths = {}
+    for id in ["abcdef", "abcxyz", "xyz"]:
+        paths[id] = apt_dataset.previous_layout.get_path(id)
+        os.makedirs(os.path.dirname(paths[id]), exist_ok=True)
+        with open(paths[id], "w") as f:
+            f.write(id)
+    return paths
+
+def test_files_found_before_migration(migration):
+    assert apt_dataset.get_path("abcdef") == migration["abcdef"]
+    assert sorted(apt_dataset.list_all()) == ["abcdef", "abcxyz", "xyz"]
+    # New files go to the current layout
+    assert apt_dataset.get_path("newdataset") == CONFIG.RESOURCES_PATH + "ne/wd/newdataset.zip"
+
+def test_migrate_layout(migration):
+    apt_dataset.migrate_layout()
+    for id, previous_path in migration.items():
+        assert not os.path.exists(previous_path)
+        path = apt_dataset.get_path(id)
+        assert path == apt_dataset.layout.get_path(id)
+        with open(path) as f:
+            assert f.read() == id
+    assert sorted(apt_dataset.list_all()) == ["abcdef", "abcxyz", "xyz"]
+
+#
+# A file uploaded at the new place during the migration is not overwritten
+#
+def test_migrate_layout_keeps_new_files(migration):
+    new_path = apt_dataset.layout.get_path("abcdef")
+    os.makedirs(os.path.dirname(new_path))
+    with open(new_path, "w") as f:
+        f.write("uploaded")
+    apt_dataset.migrate_layout()
+    with open(new_path) as f:
+        assert f.read() == "uploaded"
+    assert not os.path.exists(migration["abcdef"])
+
+#
+# A file outside of the places of its id (current or previous layout) is
+# not a dataset, and is not moved
+#
+def test_migrate_layout_ignores_other_files(migration):
+    other_path = CONFIG.RESOURCES_PATH + "other/abcdef.zip"
+    os.makedirs(os.path.dirname(other_path))
+    with open(other_path, "w") as f:
+        f.write("other")
+    apt_dataset.migrate_layout()
+    assert os.path.exists(other_path)
+    with open(apt_dataset.get_path("abcdef")) as f:
+        assert f.read() == "abcdef"
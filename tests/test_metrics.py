@@ -0,0 +1,32 @@
+import os
+import sys
+import json
+import subprocess
+import apt.services.config as CONFIG
+import apt.services.metrics as apt_metrics
+
+def save_process_metrics(pid, entries):
+    os.makedirs(CONFIG.METRICS_PATH, exist_ok=True)
+    with open(os.path.join(CONFIG.METRICS_PATH, f"{pid}.json"), "w") as f:
+        json.dump(entries, f)
+
+def test_reset_keeps_other_files():
+    save_process_metrics(12345, [])
+    with open(os.path.join(CONFIG.METRICS_PATH, "notes.txt"), "w") as f:
+        f.write("kept")
+    apt_metrics.reset()
+    assert os.listdir(CONFIG.METRICS_PATH) == ["notes.txt"]
+
+#
+# The gauges of a stopped process are ignored, its counters are kept
+#
+def test_render_ignores_gauges_of_stopped_processes():
+    apt_metrics.clear()
+    stopped = subprocess.Popen([sys.executable, "-c", "pass"])
+    stopped.wait()
+    save_process_metrics(stopped.pid, [["apt_leader", [], 1], ["apt_job_failures_total", [["action", "update"]], 2]])
+    save_process_metrics(os.getppid(), [["apt_cluster_nodes", [], 3]])
+    metrics = apt_metrics.render().splitlines()
+    assert "apt_leader 1" not in metrics
+    assert 'apt_job_failures_total{action="update"} 2' in metrics
+    assert "apt_cluster_nodes 3" in metrics
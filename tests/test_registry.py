@@ -0,0 +1,56 @@
+import threading
+import time
+import pytest
+import apt.services.registry as apt_registry
+
+#
+# A registry update and a snapshot reload running at the same time
+# must not wait for each other's lock forever
+#
+def test_set_state_and_snapshot_reload_do_not_deadlock(registry):
+    stop = time.time() + 2
+    errors = []
+
+    def update():
+        try:
+            i = 0
+            while time.time() < stop:
+                registry.set_state(apt_registry.dataset_url(f"dataset{i % 10}"), f"key{i}", i % 2 == 0)
+                i += 1
+        except Exception as e:
+            errors.append(e)
+
+    def reload():
+        try:
+            while time.time() < stop:
+                # Snapshot taken as saved by another process
+                registry.snapshot_version = None
+                registry.reload_snapshot_if_changed()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=update, daemon=True), threading.Thread(target=reload, daemon=True)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    assert not any(thread.is_alive() for thread in threads), "deadlock between set_state and reload_snapshot_if_changed"
+    assert not errors
+
+#
+# The version recorded on save is the one of the written file
+# (the process does not reload its own snapshot)
+#
+def test_saved_snapshot_is_not_reloaded(registry, monkeypatch):
+    registry.set_state(apt_registry.dataset_url("dataset1"), "key1", False)
+    monkeypatch.setattr(registry, "load_snapshot", lambda: pytest.fail("own snapshot reloaded"))
+    registry.reload_snapshot_if_changed()
+
+#
+# A change is never undone by a reload of the snapshot
+#
+def test_reload_keeps_saved_changes(registry):
+    registry.set_state(apt_registry.dataset_url("dataset1"), "key1", False)
+    registry.snapshot_version = None
+    registry.reload_snapshot_if_changed()
+    assert registry.get_gbif_key("dataset1") == "key1"
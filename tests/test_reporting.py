@@ -0,0 +1,58 @@
+import time
+import pytest
+import fake_registry
+import apt.services.config as CONFIG
+import apt.services.catalog as apt_catalog
+import apt.services.registry as apt_registry
+import apt.services.reporting as apt_reporting
+
+@pytest.fixture
+def reporting(registry, gbif, tmp_path):
+    catalog = apt_catalog.Catalog(str(tmp_path / "catalog.db"))
+    return apt_reporting.Reporting(registry, catalog)
+
+def add_dataset(reporting, id, installed, gbif_key=None):
+    dataset_path = reporting.catalog.path + "." + id
+    with open(dataset_path, "wb") as f:
+        f.write(id.encode())
+    reporting.catalog.add(id, dataset_path, checksum=id, installed=installed)
+    if gbif_key:
+        reporting.registry.set_state(apt_registry.dataset_url(id), gbif_key, False)
+
+def statuses(report):
+    return dict((dataset["id"], dataset["status"]) for dataset in report["datasets"])
+
+def test_parse_gbif_date():
+    assert apt_reporting.parse_date("2026-10-18T22:08:27.000+0000") == 1792361307
+    assert apt_reporting.parse_date("2026-10-18T22:08:27Z") == 1792361307
+    assert apt_reporting.parse_date(fake_registry.now()) == pytest.approx(time.time(), abs=2)
+    assert apt_reporting.parse_date("yesterday", 0) == 0
+
+#
+# The crawl dates of the GBIF registry are compared with the upload dates
+#
+def test_reconciliation_with_gbif_dates(reporting):
+    add_dataset(reporting, "crawled", time.time() - 3600, "key1")
+    add_dataset(reporting, "uploaded", time.time() + 3600, "key2")
+    add_dataset(reporting, "local", time.time())
+    assert statuses(reporting.build_reconciliation()) == {"crawled": "ok", "uploaded": "stale", "local": "unregistered"}
+
+#
+# Crawls not finished yet are skipped, on several pages of the crawl history
+#
+def test_last_crawl_skips_unfinished_crawls(reporting, gbif):
+    gbif.crawls["key1"] = [{"startedCrawling": fake_registry.now()}] * 15 + [{"finishedCrawling": "2020-01-01T00:00:00.000+0000"}]
+    gbif.crawls["key2"] = [{"startedCrawling": fake_registry.now()}]
+    add_dataset(reporting, "recrawled", 0, "key1")
+    add_dataset(reporting, "crawling", 0, "key2")
+    report = reporting.build_reconciliation()
+    assert statuses(report) == {"recrawled": "ok", "crawling": "never_crawled"}
+    assert report["datasets"][1]["gbif_last_crawl"] == "2020-01-01T00:00:00.000+0000"
+
+def test_expired_gbif_information_is_removed(reporting, monkeypatch):
+    monkeypatch.setattr(CONFIG, "REPORT_GBIF_TTL", 0)
+    reporting.build_gbif_list(["key1", "key2"])
+    monkeypatch.setattr(CONFIG, "REPORT_GBIF_TTL", 3600)
+    reporting.build_gbif_list(["key3"])
+    reporting.build_gbif_list(["key3", "key4"])
+    assert sorted(reporting.gbif_cache) == ["key3", "key4"]
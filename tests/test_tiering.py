@@ -0,0 +1,92 @@
+import os
+import time
+import pytest
+import apt.services.config as CONFIG
+import apt.services.dataset as apt_dataset
+import apt.services.tiering as apt_tiering
+from archives import dwca, upload
+
+@pytest.fixture
+def cold(tmp_path, monkeypatch):
+    cold_path = os.path.join(str(tmp_path), "cold", "")
+    monkeypatch.setattr(CONFIG, "COLD_STORAGE_PATH", cold_path)
+    monkeypatch.setattr(CONFIG, "COLD_BLOBS_PATH", cold_path + ".blobs/")
+    monkeypatch.setattr(CONFIG, "TIERING_RATE", 0)
+    return cold_path
+
+@pytest.fixture
+def tiering(app, cold):
+    return apt_tiering.Tiering(app.extensions["apt.catalog"])
+
+def wait_for(condition, timeout=5):
+    limit = time.time() + timeout
+    while not condition():
+        assert time.time() < limit, "timeout"
+        time.sleep(0.05)
+
+#
+# A download sent by nginx from the cold storage can still open the cold
+# copy while the dataset is moved back to the hot storage
+#
+def test_cold_copy_kept_after_promotion(client, tiering, cold, monkeypatch):
+    monkeypatch.setattr(CONFIG, "DOWNLOAD_MODE", "x-accel")
+    monkeypatch.setattr(CONFIG, "TIERING_PROMOTE_GRACE", 0.5)
+    upload(client, "dataset1", dwca())
+    tiering.demote(tiering.catalog.get("dataset1"))
+    cold_path = apt_dataset.layout.get_path("dataset1", cold)
+
+    response = client.get("/dataset/dataset1")
+    assert response.headers["X-Accel-Redirect"] == "/protected-cold-datasets/d/a/t/dataset1.zip"
+    wait_for(lambda: os.path.exists(apt_dataset.layout.get_path("dataset1")))
+    assert os.path.exists(cold_path)
+    assert client.get("/dataset/dataset1").headers["X-Accel-Redirect"] == "/protected-datasets/d/a/t/dataset1.zip"
+    wait_for(lambda: not os.path.exists(cold_path))
+
+#
+# The datasets unused for TIERING_COLD_AFTER_DAYS days are moved to the cold
+# storage, with their content, and still served
+#
+def test_demote_unused(client, tiering, cold, monkeypatch):
+    monkeypatch.setattr(CONFIG, "TIERING_COLD_AFTER_DAYS", 0)
+    monkeypatch.setattr(CONFIG, "TIERING_PROMOTE", False)
+    upload(client, "dataset1", dwca())
+    checksum = tiering.catalog.get("dataset1")["checksum"]
+    tiering.run_once()
+    assert apt_dataset.get_path("dataset1") == apt_dataset.layout.get_path("dataset1", cold)
+    assert not os.path.exists(apt_dataset.layout.get_path("dataset1"))
+    assert apt_dataset.find_blob(checksum) == apt_dataset.get_blob_path(checksum, cold=True)
+    assert not os.path.exists(apt_dataset.get_blob_path(checksum))
+    assert client.get("/dataset/dataset1").data == dwca()
+    # Already cold
+    assert not tiering.demote(tiering.catalog.get("dataset1"))
+
+#
+# A dataset uploaded while it is copied to the cold storage stays hot
+#
+def test_demote_modified(client, tiering, cold):
+    upload(client, "dataset1", dwca())
+    entry = tiering.catalog.get("dataset1")
+    upload(client, "dataset1", dwca("2"))
+    assert not tiering.demote(entry)
+    assert apt_dataset.get_path("dataset1") == apt_dataset.layout.get_path("dataset1")
+    assert not os.path.exists(apt_dataset.layout.get_path("dataset1", cold))
+
+def test_promote(client, tiering, cold, monkeypatch):
+    monkeypatch.setattr(CONFIG, "TIERING_PROMOTE_GRACE", 0)
+    upload(client, "dataset1", dwca())
+    entry = tiering.catalog.get("dataset1")
+    tiering.demote(entry)
+    assert tiering.promote("dataset1")
+    assert apt_dataset.get_path("dataset1") == apt_dataset.layout.get_path("dataset1")
+    assert os.path.exists(apt_dataset.get_blob_path(entry["checksum"]))
+    wait_for(lambda: not os.path.exists(apt_dataset.layout.get_path("dataset1", cold)))
+    assert client.get("/dataset/dataset1").data == dwca()
+    # Already hot
+    assert not tiering.promote("dataset1")
+
+def test_promote_deleted(client, tiering, cold):
+    upload(client, "dataset1", dwca())
+    tiering.demote(tiering.catalog.get("dataset1"))
+    tiering.catalog.remove("dataset1")
+    assert not tiering.promote("dataset1")
+    assert apt_dataset.get_path("dataset1") == apt_dataset.layout.get_path("dataset1", cold)
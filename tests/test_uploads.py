@@ -0,0 +1,43 @@
+from archives import dwca, upload
+
+def test_upload_registers_dataset(client, run_jobs, gbif):
+    response = upload(client, "dataset1", dwca())
+    assert response.status_code == 202
+    assert not response.json["unchanged"]
+    run_jobs()
+    assert client.get(response.json["job_url"][len("http://apt"):]).json["status"] == "done"
+    assert gbif.calls.get("register") == 1
+
+#
+# An unchanged upload during the registration of the dataset registers it
+# (once), without crawling it
+#
+def test_unchanged_upload_during_registration_does_not_crawl(app, client, run_jobs, gbif):
+    jobs = app.extensions["apt.jobs"]
+    upload(client, "dataset1", dwca())
+    registration = jobs.claim()
+    response = upload(client, "dataset1", dwca())
+    assert response.json["unchanged"]
+    jobs.execute(registration)
+    run_jobs()
+    assert gbif.calls.get("register") == 1
+    assert "crawl" not in gbif.calls
+
+def test_changed_upload_crawls(client, run_jobs, gbif):
+    upload(client, "dataset1", dwca("1"))
+    run_jobs()
+    assert upload(client, "dataset1", dwca("1")).status_code == 200
+    upload(client, "dataset1", dwca("2"))
+    run_jobs()
+    assert gbif.calls.get("crawl") == 1
+
+#
+# The EML language is registered as a language code, the default language
+# if unknown (GBIF rejects the other values)
+#
+def test_registered_language(client, run_jobs, gbif):
+    upload(client, "dataset1", dwca(language="français"))
+    upload(client, "dataset2", dwca(language="Klingon"))
+    run_jobs()
+    languages = dict((d["endpoints"][0]["url"], d["language"]) for d in gbif.datasets.values())
+    assert languages == {"http://apt/dataset/dataset1": "fra", "http://apt/dataset/dataset2": "eng"}
@@ -0,0 +1,68 @@
+import time
+import types
+import apt.services.config as CONFIG
+import apt.services.catalog as apt_catalog
+import apt.services.dataset as apt_dataset
+from archives import dwca, upload
+
+def checksum(client, id):
+    return client.get("/dataset/" + id).headers["ETag"].strip('"')
+
+#
+# Blob store garbage collection, the blobs being older than the grace
+# period of the recent uploads
+#
+def collect_garbage(app, monkeypatch):
+    now = time.time()
+    monkeypatch.setattr(apt_catalog, "time", types.SimpleNamespace(time=lambda: now + 7200))
+    app.extensions["apt.catalog"].collect_garbage()
+
+def test_rollback(client, run_jobs):
+    upload(client, "dataset1", dwca("1"))
+    upload(client, "dataset1", dwca("2"))
+    versions = client.get("/dataset/dataset1/versions").json
+    assert [(version["version"], version["current"]) for version in versions] == [(2, True), (1, False)]
+    response = client.post("/dataset/dataset1/rollback")
+    assert response.status_code == 202
+    assert response.json["version"] == 1
+    assert client.get("/dataset/dataset1").data == dwca("1")
+    versions = client.get("/dataset/dataset1/versions").json
+    assert [(version["version"], version["current"]) for version in versions] == [(3, True), (2, False), (1, True)]
+    # Explicit version
+    assert client.post("/dataset/dataset1/rollback?version=2").json["version"] == 2
+    assert client.get("/dataset/dataset1").data == dwca("2")
+    assert client.post("/dataset/dataset1/rollback?version=9").status_code == 404
+    assert client.post("/dataset/dataset2/rollback").status_code == 404
+
+#
+# A content shared by several datasets is stored once, and kept by the
+# garbage collection while a dataset or a kept version uses it
+#
+def test_shared_blob_garbage_collection(app, client, monkeypatch):
+    monkeypatch.setattr(CONFIG, "VERSION_RETENTION", 1)
+    upload(client, "dataset1", dwca("1"))
+    upload(client, "dataset2", dwca("1"))
+    shared = checksum(client, "dataset1")
+    assert [blob[0] for blob in apt_dataset.list_blobs()] == [shared]
+    upload(client, "dataset1", dwca("2"))
+    replaced = checksum(client, "dataset1")
+    # Still the content of dataset2
+    collect_garbage(app, monkeypatch)
+    assert apt_dataset.find_blob(shared)
+    # Neither a dataset nor a kept version
+    upload(client, "dataset2", dwca("3"))
+    collect_garbage(app, monkeypatch)
+    assert not apt_dataset.find_blob(shared)
+    assert apt_dataset.find_blob(replaced)
+    assert client.post("/dataset/dataset1/rollback").status_code == 404
+    assert client.get("/dataset/dataset1").data == dwca("2")
+
+#
+# An unused blob linked less than an hour ago may be used by an upload
+#
+def test_recent_blob_kept(app, client, monkeypatch):
+    monkeypatch.setattr(CONFIG, "VERSION_RETENTION", 1)
+    upload(client, "dataset1", dwca("1"))
+    upload(client, "dataset1", dwca("2"))
+    app.extensions["apt.catalog"].collect_garbage()
+    assert len(list(apt_dataset.list_blobs())) == 2